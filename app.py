@@ -1,7 +1,7 @@
 import os
 import logging
 from datetime import datetime
-from flask import session, render_template
+from flask import session, render_template, request
 from flask_login import UserMixin, current_user
 from werkzeug.middleware.proxy_fix import ProxyFix
 
@@ -11,12 +11,20 @@ from config import create_app, db, login_manager
 app = create_app()
 app.wsgi_app = ProxyFix(app.wsgi_app, x_proto=1, x_host=1)
 
+# Count SQL statements per request (X-Query-Count header) to catch N+1
+# patterns; debug mode or QUERY_COUNTER=1 only
+from utils.query_counter import init_query_counter
+with app.app_context():
+    init_query_counter(app, db.engine)
+
 # Import and register blueprints
 from controllers.profile_controller import profile_bp
 from controllers import (
     auth_controller, book_controller, social_controller, review_controller
 )
 from controllers.api_controller import api_bp
+from utils.header_counts import get_header_counts
+from utils.presence import presence
 
 # Register all blueprints
 app.register_blueprint(profile_bp)
@@ -36,6 +44,15 @@ logging.basicConfig(level=logging.DEBUG)
 def load_user(user_id):
     return User.query.get(int(user_id))
 
+# Presence heartbeat + coalesced last_activity, once per request (no DB write)
+@app.before_request
+def track_activity():
+    if request.endpoint != 'static' and current_user.is_authenticated:
+        current_user.update_activity()
+
+# Batched online lookups for templates: {% set online = who_is_online(ids) %}
+app.jinja_env.globals['who_is_online'] = presence.who_is_online
+
 # Context processor
 @app.context_processor
 def inject_borrowed_count():
@@ -45,22 +62,10 @@ def inject_borrowed_count():
     notification_count = 0
 
     if current_user.is_authenticated:
-        try:
-            current_user.update_activity()
-            db.session.commit()
-        except Exception as e:
-            db.session.rollback()
-            logging.error(f"Error updating activity: {e}")
-
-        borrowed_count = len(book_controller.get_borrowed_books())
-        try:
-            notification_count = Notification.query.filter_by(
-                user_id=current_user.id,
-                is_read=False
-            ).count()
-        except Exception as e:
-            logging.error(f"Error getting notification count: {e}")
-            notification_count = 0
+        # ✅ Bộ đếm trên header lấy từ cache (0 truy vấn khi trúng cache)
+        counts = get_header_counts(current_user.id)
+        borrowed_count = counts['borrowed_count']
+        notification_count = counts['notification_count']
 
     return dict(
         borrowed_count=borrowed_count,
@@ -150,6 +155,10 @@ def get_discussion_messages():
 def book_discussion(book_id):
     return social_controller.book_discussion(book_id)
 
+@app.route("/api/book/<int:book_id>/discussion/messages")
+def get_book_discussion_messages(book_id):
+    return social_controller.get_book_discussion_messages(book_id)
+
 @app.route("/chat/<int:recipient_id>")
 @app.route("/chat/<int:recipient_id>/<int:book_id>")
 def private_chat(recipient_id, book_id=None):
@@ -163,6 +172,10 @@ def send_private_message(recipient_id):
 def get_chat_messages(recipient_id):
     return social_controller.get_chat_messages(recipient_id)
 
+@app.route("/api/chat/gateway-token")
+def chat_gateway_token():
+    return social_controller.chat_gateway_token()
+
 @app.route("/notifications")
 def notifications():
     return social_controller.notifications()
@@ -175,6 +188,10 @@ def mark_notification_read(notification_id):
 def mark_all_notifications_read():
     return social_controller.mark_all_notifications_read()
 
+@app.route("/api/notifications/stream")
+def notification_stream():
+    return social_controller.notification_stream()
+
 @app.route("/api/notifications/count")
 def get_unread_notifications_count():
     return social_controller.get_unread_notifications_count()
@@ -221,6 +238,9 @@ def terms():
 # Setup pytz for templates
 import pytz
 app.jinja_env.globals['pytz'] = pytz
+# {{ dt|local_time }}: naive UTC -> dd/mm/YYYY HH:MM giờ Việt Nam
+from utils.timefmt import format_local
+app.jinja_env.filters['local_time'] = format_local
 
 # Background image
 from flask import send_from_directory
@@ -243,5 +263,49 @@ with app.app_context():
         print("⚠️ Skip alter table:", e)
         db.session.rollback()
 
+    # Columns added to models after their tables were first created.
+    # Missing indexes are built by migrate_indexes.py as a deploy step, not
+    # here: every worker would race on the same CREATE INDEX CONCURRENTLY.
+    from utils.schema import add_missing_columns
+    added_columns = add_missing_columns()
+
+    # Rating aggregates start at zero on existing books; fill them from reviews
+    if 'books.rating_count' in added_columns:
+        try:
+            Book.recompute_ratings()
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            logging.error(f"Error backfilling book ratings: {e}")
+
+    # Unread counters start at zero on existing users; fill them from notifications
+    if 'users.unread_notifications' in added_columns:
+        try:
+            User.recompute_unread_notifications()
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            logging.error(f"Error backfilling unread notification counters: {e}")
+
+    # Inbox rows for conversations that predate the conversations table
+    try:
+        from models import Conversation
+        if Conversation.query.first() is None and PrivateMessage.query.first() is not None:
+            Conversation.rebuild()
+            db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        logging.error(f"Error backfilling conversations: {e}")
+
+    # Cached counts and feeds are per worker unless a shared store is set
+    from utils.shared_store import warn_if_not_shared
+    warn_if_not_shared()
+
+    # Pick the full-text and trigram search engines; their schema is
+    # installed by migrate_indexes.py and old rows are backfilled by
+    # repair_counters.py
+    from utils.search import detect_search_backend
+    detect_search_backend()
+
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=5000, debug=True)
\ No newline at end of file
@@ -0,0 +1,27 @@
+import argparse
+
+from app import app
+from utils.retention import ARCHIVE_BATCH_SIZE, archive_cold_rows, retention_policies
+
+# Chuyển thông báo đã đọc, tin nhắn riêng và thảo luận cũ sang các bảng
+# *_archive theo từng lô. Chạy định kỳ (cron); chạy lại nhiều lần vẫn an toàn.
+# Ngưỡng tuổi: NOTIFICATION_RETENTION_DAYS, MESSAGE_RETENTION_DAYS,
+# DISCUSSION_RETENTION_DAYS (xem utils/retention.py).
+#
+#   python archive_old_rows.py --batch-size 1000
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Lưu trữ dữ liệu cũ khỏi các bảng đang dùng')
+    parser.add_argument('--batch-size', type=int, default=ARCHIVE_BATCH_SIZE, help='Số dòng mỗi lô')
+    parser.add_argument('--max-batches', type=int, default=None, help='Giới hạn số lô mỗi bảng trong lần chạy này')
+    args = parser.parse_args()
+
+    with app.app_context():
+        for policy in retention_policies():
+            print(f"🔄 {policy.name}: lưu trữ dữ liệu cũ hơn {policy.days} ngày")
+        try:
+            moved = archive_cold_rows(args.batch_size, args.max_batches)
+            for name, count in moved.items():
+                print(f"✅ {name}: đã chuyển {count} dòng sang bảng lưu trữ")
+        except Exception as e:
+            print("❌ Lỗi khi lưu trữ dữ liệu cũ:", e)
@@ -0,0 +1,357 @@
+"""
+Asyncio WebSocket gateway for private chat.
+
+Runs alongside the Flask app (``python chat_gateway.py``) and pushes
+committed private messages to open chat pages, so idle chats hold no
+Flask worker and run no queries. An idle connection costs one coroutine
+and a small read buffer; one process handles tens of thousands of them
+(raise ``ulimit -n`` accordingly).
+
+Flow: the chat page asks ``/api/chat/gateway-token`` for a short-lived
+signed token, opens ``CHAT_GATEWAY_URL?token=...``, and receives
+``{'type': 'private_message', 'message': {...}}`` frames. Events arrive
+from the web workers over the chat bus (see ``utils/chat_bus.py``): Redis
+pub/sub when ``REDIS_URL`` is set, otherwise loopback UDP on
+``CHAT_BUS_ADDR``, which supports a single gateway process.
+
+Settings (environment): ``CHAT_GATEWAY_HOST`` / ``CHAT_GATEWAY_PORT``
+(listen address, default ``127.0.0.1:8765``), ``CHAT_GATEWAY_ORIGINS``
+(comma-separated allowed ``Origin`` values; when empty only the app's own
+origin, recorded in the token by ``/api/chat/gateway-token``, is accepted),
+``SESSION_SECRET`` (must match the Flask app).
+"""
+import asyncio
+import base64
+import hashlib
+import json
+import logging
+import os
+import signal
+import struct
+import time
+from collections import defaultdict
+from urllib.parse import parse_qs, urlsplit
+
+from utils.chat_bus import CHANNEL, bus_address, decode_event, load_gateway_token
+
+WS_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+HANDSHAKE_TIMEOUT = 10
+MAX_HEADER_BYTES = 8192
+# Clients only send control frames and small pings; a message split into
+# continuation frames is limited as a whole
+MAX_CLIENT_MESSAGE = 4096
+MAX_CONTROL_PAYLOAD = 125
+PING_INTERVAL = 30
+IDLE_TIMEOUT = 75
+# A client this far behind is dropped instead of buffering without bound
+MAX_WRITE_BUFFER = 256 * 1024
+
+OP_CONTINUATION, OP_TEXT, OP_BINARY = 0x0, 0x1, 0x2
+OP_CLOSE, OP_PING, OP_PONG = 0x8, 0x9, 0xA
+
+# Close codes (RFC 6455 section 7.4.1)
+CLOSE_NORMAL, CLOSE_GOING_AWAY, CLOSE_PROTOCOL_ERROR, CLOSE_TOO_BIG = 1000, 1001, 1002, 1009
+
+# Same fallback as config.create_app
+SECRET_KEY = os.environ.get('SESSION_SECRET') or 'a secret key'
+
+
+class ConnectionClosed(Exception):
+    """The client broke the protocol; ``code`` is sent in the close frame"""
+
+    def __init__(self, code=CLOSE_PROTOCOL_ERROR):
+        super().__init__(code)
+        self.code = code
+
+
+def encode_frame(opcode, payload=b''):
+    """Server frames are final and unmasked"""
+    header = bytes([0x80 | opcode])
+    length = len(payload)
+    if length < 126:
+        header += bytes([length])
+    elif length < 1 << 16:
+        header += bytes([126]) + struct.pack('!H', length)
+    else:
+        header += bytes([127]) + struct.pack('!Q', length)
+    return header + payload
+
+
+class Connection:
+    """One open WebSocket; everything except the socket lives in the gateway"""
+
+    __slots__ = ('user_id', 'reader', 'writer', 'last_seen', 'closed', 'fragment_opcode', 'fragments')
+
+    def __init__(self, user_id, reader, writer):
+        self.user_id = user_id
+        self.reader = reader
+        self.writer = writer
+        self.last_seen = time.monotonic()
+        self.closed = False
+        # Data message being received in continuation frames
+        self.fragment_opcode = None
+        self.fragments = []
+
+    def send(self, opcode, payload=b''):
+        if self.closed:
+            return
+        if self.writer.transport.get_write_buffer_size() > MAX_WRITE_BUFFER:
+            logging.info(f"Dropping slow chat client of user {self.user_id}")
+            self.close()
+            return
+        self.writer.write(encode_frame(opcode, payload))
+
+    def send_json(self, data):
+        self.send(OP_TEXT, json.dumps(data, ensure_ascii=False).encode('utf-8'))
+
+    def close(self, code=CLOSE_NORMAL):
+        if self.closed:
+            return
+        try:
+            self.writer.write(encode_frame(OP_CLOSE, struct.pack('!H', code)))
+        except Exception:
+            pass
+        self.closed = True
+        self.writer.close()
+
+    async def read_frame(self):
+        """``(fin, opcode, payload)`` of the next client frame"""
+        head = await self.reader.readexactly(2)
+        fin = head[0] & 0x80
+        opcode = head[0] & 0x0F
+        masked = head[1] & 0x80
+        length = head[1] & 0x7F
+        if head[0] & 0x70 or not masked:
+            # No extensions are negotiated, and clients must mask
+            raise ConnectionClosed()
+        if opcode >= OP_CLOSE and (not fin or length > MAX_CONTROL_PAYLOAD):
+            raise ConnectionClosed()
+        if length == 126:
+            length = struct.unpack('!H', await self.reader.readexactly(2))[0]
+        elif length == 127:
+            length = struct.unpack('!Q', await self.reader.readexactly(8))[0]
+        if length > MAX_CLIENT_MESSAGE:
+            raise ConnectionClosed(CLOSE_TOO_BIG)
+        mask = await self.reader.readexactly(4)
+        payload = bytearray(await self.reader.readexactly(length))
+        for i in range(length):
+            payload[i] ^= mask[i % 4]
+        self.last_seen = time.monotonic()
+        return fin, opcode, bytes(payload)
+
+    async def read_message(self):
+        """``(opcode, payload)`` of the next control frame or whole data message.
+
+        Fragments of a data message are joined; control frames may arrive
+        between them and are returned as they come.
+        """
+        while True:
+            fin, opcode, payload = await self.read_frame()
+            if opcode >= OP_CLOSE:
+                if opcode not in (OP_CLOSE, OP_PING, OP_PONG):
+                    raise ConnectionClosed()
+                return opcode, payload
+            if opcode == OP_CONTINUATION:
+                if self.fragment_opcode is None:
+                    raise ConnectionClosed()
+            elif opcode in (OP_TEXT, OP_BINARY) and self.fragment_opcode is None:
+                self.fragment_opcode = opcode
+            else:
+                # Unknown opcode, or a new message before the last one ended
+                raise ConnectionClosed()
+            self.fragments.append(payload)
+            if sum(map(len, self.fragments)) > MAX_CLIENT_MESSAGE:
+                raise ConnectionClosed(CLOSE_TOO_BIG)
+            if fin:
+                message = self.fragment_opcode, b''.join(self.fragments)
+                self.fragment_opcode, self.fragments = None, []
+                return message
+
+
+class ChatGateway:
+    """Accepts WebSockets and fans bus events out to each user's sockets"""
+
+    def __init__(self, secret_key, allowed_origins=()):
+        self.secret_key = secret_key
+        self.allowed_origins = set(allowed_origins)
+        self.connections = defaultdict(set)
+        self.connection_count = 0
+
+    def deliver(self, user_id, data):
+        connections = self.connections.get(user_id)
+        if not connections:
+            return
+        payload = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        for connection in list(connections):
+            connection.send(OP_TEXT, payload)
+
+    def deliver_raw(self, raw):
+        event = decode_event(raw)
+        if event is not None:
+            self.deliver(*event)
+
+    def origin_allowed(self, origin, token_origin):
+        """Configured origins, else only the origin the token was issued to"""
+        if not origin:
+            return False
+        if self.allowed_origins:
+            return origin in self.allowed_origins
+        return origin == token_origin
+
+    async def handle(self, reader, writer):
+        try:
+            request = await asyncio.wait_for(self._read_request(reader), HANDSHAKE_TIMEOUT)
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError):
+            writer.close()
+            return
+
+        path, query, headers = request
+        if path == '/healthz':
+            body = json.dumps({'connections': self.connection_count, 'users': len(self.connections)}).encode()
+            self._respond(writer, '200 OK', body, 'application/json')
+            return
+
+        token = load_gateway_token(self.secret_key, (query.get('token') or [''])[0])
+        if headers.get('upgrade', '').lower() != 'websocket' or 'sec-websocket-key' not in headers:
+            self._respond(writer, '400 Bad Request', b'WebSocket upgrade expected')
+            return
+        if token is None:
+            self._respond(writer, '401 Unauthorized', b'Invalid or expired token')
+            return
+        user_id, token_origin = token
+        if not self.origin_allowed(headers.get('origin'), token_origin):
+            self._respond(writer, '403 Forbidden', b'Origin not allowed')
+            return
+
+        accept = base64.b64encode(
+            hashlib.sha1((headers['sec-websocket-key'] + WS_GUID).encode()).digest()
+        ).decode()
+        writer.write((
+            'HTTP/1.1 101 Switching Protocols\r\n'
+            'Upgrade: websocket\r\n'
+            'Connection: Upgrade\r\n'
+            f'Sec-WebSocket-Accept: {accept}\r\n\r\n'
+        ).encode())
+
+        connection = Connection(user_id, reader, writer)
+        self.connections[user_id].add(connection)
+        self.connection_count += 1
+        close_code = CLOSE_NORMAL
+        try:
+            await self._serve(connection)
+        except ConnectionClosed as e:
+            close_code = e.code
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.connection_count -= 1
+            connections = self.connections.get(user_id)
+            if connections is not None:
+                connections.discard(connection)
+                if not connections:
+                    del self.connections[user_id]
+            connection.close(close_code)
+
+    async def _serve(self, connection):
+        while not connection.closed:
+            opcode, payload = await connection.read_message()
+            if opcode == OP_CLOSE:
+                connection.close()
+            elif opcode == OP_PING:
+                connection.send(OP_PONG, payload)
+            elif opcode == OP_TEXT and payload == b'ping':
+                # Browsers cannot send control frames; answer app-level pings
+                connection.send_json({'type': 'pong'})
+
+    async def _read_request(self, reader):
+        raw = await reader.readuntil(b'\r\n\r\n')
+        if len(raw) > MAX_HEADER_BYTES:
+            raise ValueError('headers too large')
+        lines = raw.decode('latin-1').split('\r\n')
+        method, target, _ = lines[0].split(' ', 2)
+        if method != 'GET':
+            raise ValueError('GET expected')
+        headers = {}
+        for line in lines[1:]:
+            if ':' in line:
+                name, value = line.split(':', 1)
+                headers[name.strip().lower()] = value.strip()
+        url = urlsplit(target)
+        return url.path, parse_qs(url.query), headers
+
+    def _respond(self, writer, status, body, content_type='text/plain'):
+        writer.write((
+            f'HTTP/1.1 {status}\r\n'
+            f'Content-Type: {content_type}\r\n'
+            f'Content-Length: {len(body)}\r\n'
+            'Connection: close\r\n\r\n'
+        ).encode() + body)
+        writer.close()
+
+    async def keepalive(self):
+        """One task pings every socket and reaps the silent ones"""
+        ping = encode_frame(OP_PING)
+        while True:
+            await asyncio.sleep(PING_INTERVAL)
+            cutoff = time.monotonic() - IDLE_TIMEOUT
+            for connections in list(self.connections.values()):
+                for connection in list(connections):
+                    if connection.last_seen < cutoff:
+                        connection.close(CLOSE_GOING_AWAY)
+                    elif not connection.closed:
+                        connection.writer.write(ping)
+
+
+class _DatagramSubscriber(asyncio.DatagramProtocol):
+    def __init__(self, gateway):
+        self.gateway = gateway
+
+    def datagram_received(self, data, addr):
+        self.gateway.deliver_raw(data)
+
+
+async def subscribe_redis(gateway, url):
+    import redis.asyncio as aioredis
+    while True:
+        try:
+            client = aioredis.Redis.from_url(url)
+            pubsub = client.pubsub(ignore_subscribe_messages=True)
+            await pubsub.subscribe(CHANNEL)
+            async for message in pubsub.listen():
+                gateway.deliver_raw(message['data'])
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error(f"Chat bus subscription lost, retrying: {e}")
+            await asyncio.sleep(1)
+
+
+async def main():
+    logging.basicConfig(level=logging.INFO)
+    origins = [origin.strip() for origin in os.environ.get('CHAT_GATEWAY_ORIGINS', '').split(',') if origin.strip()]
+    gateway = ChatGateway(SECRET_KEY, origins)
+    loop = asyncio.get_running_loop()
+
+    redis_url = os.environ.get('REDIS_URL')
+    if redis_url:
+        loop.create_task(subscribe_redis(gateway, redis_url))
+        logging.info("Chat gateway subscribed to Redis channel %s", CHANNEL)
+    else:
+        await loop.create_datagram_endpoint(lambda: _DatagramSubscriber(gateway), local_addr=bus_address())
+        logging.info("Chat gateway listening for the local chat bus on %s:%s", *bus_address())
+
+    host = os.environ.get('CHAT_GATEWAY_HOST', '127.0.0.1')
+    port = int(os.environ.get('CHAT_GATEWAY_PORT', '8765'))
+    server = await asyncio.start_server(gateway.handle, host, port, limit=MAX_HEADER_BYTES, backlog=1024)
+    loop.create_task(gateway.keepalive())
+    logging.info("Chat gateway accepting WebSockets on %s:%s", host, port)
+
+    stop = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    async with server:
+        await stop.wait()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,38 @@
+import argparse
+from datetime import datetime, timedelta
+
+from app import app
+from config import db
+from models import Notification
+from utils.header_counts import invalidate_header_counts
+from utils.notification_hub import notify_count_changed
+
+# Chế độ digest: gộp các thông báo cũ hơn N ngày có cùng (người nhận, loại,
+# đối tượng liên quan, trạng thái đọc) thành một dòng mang tổng số lần.
+# Chạy định kỳ (cron); chạy lại nhiều lần vẫn an toàn.
+#
+#   python compact_notifications.py --days 7
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Gộp thông báo cũ thành bản tóm tắt')
+    parser.add_argument('--days', type=int, default=7, help='Chỉ gộp thông báo cũ hơn số ngày này (mặc định 7)')
+    args = parser.parse_args()
+
+    before = datetime.utcnow() - timedelta(days=args.days)
+    with app.app_context():
+        print(f"🔄 Đang gộp thông báo tạo trước {before:%d/%m/%Y %H:%M} (UTC)...")
+        total = 0
+        try:
+            while True:
+                deleted, unread_users = Notification.compact(before)
+                db.session.commit()
+                invalidate_header_counts(*unread_users)
+                # Trang đang mở nhận lại số chưa đọc (qua Redis nếu có)
+                notify_count_changed(*unread_users)
+                total += deleted
+                if not deleted:
+                    break
+            print(f"✅ Đã gộp và xóa {total} thông báo trùng lặp")
+        except Exception as e:
+            db.session.rollback()
+            print("❌ Lỗi khi gộp thông báo:", e)
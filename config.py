@@ -28,6 +28,8 @@ def create_app():
         "pool_recycle": 300,
         "pool_pre_ping": True,
     }
+    # Per-request SQL counter (X-Query-Count header); debug aid, off in production
+    app.config["QUERY_COUNTER"] = os.environ.get("QUERY_COUNTER", "").lower() in ("1", "true")
     
     # Initialize extensions
     db.init_app(app)
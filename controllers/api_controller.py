@@ -4,12 +4,25 @@ Provides RESTful web services for all models following standard REST conventions
 """
 from flask import Blueprint, request, jsonify, abort
 from flask_login import login_required, current_user
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
+from sqlalchemy.orm import joinedload, selectinload
 from config import db
 from models import (
     User, Book, BorrowedBook, BookReview, 
-    Discussion, PrivateMessage, Notification
+    Discussion, PrivateMessage, Notification, Conversation,
+    ArchivedNotification
 )
+from controllers.book_controller import BOOK_SORT_OPTIONS
+from utils import search as book_search
+from utils.book_cards import load_book_cards, pending_requests_stamp
+from utils.facets import catalog_facets
+from utils.header_counts import invalidate_header_counts
+from utils.http_cache import conditional_response, make_etag, newest, table_stamp
+from utils.notification_hub import notify_count_changed
+from utils.pagination import keyset_page
+from utils.presence import presence
+from utils.suggest import book_suggestions
+from utils.timefmt import request_formatter
 import logging
 
 # Create API blueprint
@@ -25,6 +38,46 @@ def success_response(data=None, message='Success', status_code=200):
         response['data'] = data
     return jsonify(response), status_code
 
+def paginate_list(query, keys, default_per_page=20, descending=True):
+    """Paginate a list endpoint and return ``(items, pagination)``.
+
+    Offset mode (``?page=&per_page=``) keeps the query's own ordering.
+    Cursor mode (``?cursor=&limit=``, or just ``?limit=`` for the first page)
+    orders by ``keys`` and pages with keyset comparisons. The total count is
+    computed only with ``include_total=true`` in cursor mode and skipped with
+    ``include_total=false`` in offset mode. Raises ValueError for a bad cursor.
+    """
+    include_total = request.args.get('include_total')
+
+    if 'cursor' in request.args or 'limit' in request.args:
+        return keyset_page(
+            query, keys,
+            limit=request.args.get('limit', default_per_page, type=int),
+            cursor=request.args.get('cursor') or None,
+            descending=descending,
+            include_total=(include_total or 'false').lower() == 'true'
+        )
+
+    page = request.args.get('page', 1, type=int)
+    per_page = request.args.get('per_page', default_per_page, type=int)
+    with_count = (include_total or 'true').lower() == 'true'
+
+    pages = query.paginate(page=page, per_page=per_page, error_out=False, count=with_count)
+    pagination = {
+        'page': pages.page,
+        'per_page': pages.per_page,
+        'has_prev': pages.has_prev,
+    }
+    if with_count:
+        pagination.update({
+            'pages': pages.pages,
+            'total': pages.total,
+            'has_next': pages.has_next,
+        })
+    else:
+        pagination['has_next'] = len(pages.items) == pages.per_page
+    return pages.items, pagination
+
 # Helper function to serialize datetime objects
 def serialize_datetime(obj):
     if isinstance(obj, datetime):
@@ -39,22 +92,16 @@ def serialize_datetime(obj):
 def get_users():
     """GET /api/v1/users - List all users with optional filtering"""
     try:
-        page = request.args.get('page', 1, type=int)
-        per_page = request.args.get('per_page', 20, type=int)
         search = request.args.get('search', '')
         
         query = User.query
         
         if search:
-            query = query.filter(
-                User.username.ilike(f'%{search}%') |
-                User.email.ilike(f'%{search}%') |
-                User.first_name.ilike(f'%{search}%') |
-                User.last_name.ilike(f'%{search}%')
-            )
+            # Accent-insensitive, typo-tolerant match on username/name/email
+            query = query.filter(book_search.fuzzy_filter(User.search_norm, search))
         
-        users = query.paginate(
-            page=page, per_page=per_page, error_out=False
+        users, pagination = paginate_list(
+            query, (User.created_at, User.id), descending=False
         )
         
         result = {
@@ -67,23 +114,38 @@ def get_users():
                 'full_name': user.get_full_name(),
                 'active': user.active,
                 'created_at': user.created_at.isoformat() if user.created_at else None
-            } for user in users.items],
-            'pagination': {
-                'page': users.page,
-                'pages': users.pages,
-                'per_page': users.per_page,
-                'total': users.total,
-                'has_next': users.has_next,
-                'has_prev': users.has_prev
-            }
+            } for user in users],
+            'pagination': pagination
         }
         
         return success_response(result)
         
+    except ValueError as e:
+        return error_response(str(e))
     except Exception as e:
         logging.error(f"Error fetching users: {e}")
         return error_response('Failed to fetch users', 500)
 
+@api_bp.route('/users/presence', methods=['GET'])
+@login_required
+def get_users_presence():
+    """GET /api/v1/users/presence?ids=1,2,3 - Which of the given users are online"""
+    try:
+        user_ids = [int(part) for part in request.args.get('ids', '').split(',') if part.strip()]
+        if len(user_ids) > 100:
+            return error_response('At most 100 ids per request')
+        
+        return success_response({
+            'online': sorted(presence.who_is_online(user_ids)),
+            'ttl': presence.ttl
+        })
+        
+    except ValueError:
+        return error_response('ids must be a comma-separated list of integers')
+    except Exception as e:
+        logging.error(f"Error fetching presence: {e}")
+        return error_response('Failed to fetch presence', 500)
+
 @api_bp.route('/users/<int:user_id>', methods=['GET'])
 def get_user(user_id):
     """GET /api/v1/users/{id} - Get specific user by ID"""
@@ -213,22 +275,21 @@ def update_user(user_id):
 
 @api_bp.route('/books', methods=['GET'])
 def get_books():
-    """GET /api/v1/books - List all books with optional filtering"""
+    """GET /api/v1/books - List all books with optional filtering
+
+    In cursor mode results are always newest first, also when searching.
+    """
     try:
-        page = request.args.get('page', 1, type=int)
-        per_page = request.args.get('per_page', 20, type=int)
         search = request.args.get('search', '')
         category = request.args.get('category', '')
         available_only = request.args.get('available_only', 'false').lower() == 'true'
+        sort = request.args.get('sort', '')
         
         query = Book.query
+        rank = None
         
         if search:
-            query = query.filter(
-                Book.title.ilike(f'%{search}%') |
-                Book.author.ilike(f'%{search}%') |
-                Book.description.ilike(f'%{search}%')
-            )
+            query, rank = book_search.apply_search(query, search)
         
         if category:
             query = query.filter(Book.category == category)
@@ -236,49 +297,106 @@ def get_books():
         if available_only:
             query = query.filter(Book.available == True)
         
-        books = query.paginate(
-            page=page, per_page=per_page, error_out=False
-        )
-        
-        result = {
-            'books': [book.to_dict() for book in books.items],
-            'pagination': {
-                'page': books.page,
-                'pages': books.pages,
-                'per_page': books.per_page,
-                'total': books.total,
-                'has_next': books.has_next,
-                'has_prev': books.has_prev
+        # Explicit sort if given, else most relevant first when searching,
+        # newest first otherwise
+        if sort in BOOK_SORT_OPTIONS:
+            query = query.order_by(*BOOK_SORT_OPTIONS[sort])
+        elif rank is not None:
+            query = query.order_by(rank.desc(), Book.id.desc())
+        else:
+            query = query.order_by(Book.created_at.desc(), Book.id.desc())
+        
+        viewer_id = current_user.id if current_user.is_authenticated else None
+        count, last_modified = table_stamp(query, Book.last_modified_expr())
+        etag = make_etag(count, last_modified, viewer_id, pending_requests_stamp(viewer_id))
+        
+        def build():
+            books, pagination = paginate_list(query, (Book.created_at, Book.id))
+            
+            cards = load_book_cards([book.id for book in books], viewer_id=viewer_id)
+            books_data = [book.to_dict(card=cards[book.id]) for book in books]
+            if search:
+                highlights = book_search.highlight_books(books, search)
+                for book_data in books_data:
+                    highlight = highlights.get(book_data['id'])
+                    if highlight:
+                        book_data['highlight'] = {key: str(value) for key, value in highlight.items()}
+            
+            result = {
+                'books': books_data,
+                'pagination': pagination
             }
-        }
+            
+            return success_response(result)
         
-        return success_response(result)
+        # ETag only: deleting a book never advances the newest update time,
+        # so Last-Modified would answer If-Modified-Since with a stale 304
+        return conditional_response(etag, None, build, private=viewer_id is not None)
         
+    except ValueError as e:
+        return error_response(str(e))
     except Exception as e:
         logging.error(f"Error fetching books: {e}")
         return error_response('Failed to fetch books', 500)
 
+@api_bp.route('/books/facets', methods=['GET'])
+def get_book_facets():
+    """GET /api/v1/books/facets - Categories and locations with book counts"""
+    try:
+        return success_response(catalog_facets.get())
+        
+    except Exception as e:
+        logging.error(f"Error fetching book facets: {e}")
+        return error_response('Failed to fetch book facets', 500)
+
+@api_bp.route('/books/suggest', methods=['GET'])
+def suggest_books():
+    """GET /api/v1/books/suggest?q= - Typeahead suggestions for titles and authors
+
+    Served from the in-memory prefix index; no database query per keystroke.
+    """
+    try:
+        query = request.args.get('q', '')
+        limit = request.args.get('limit', 8, type=int)
+        
+        return success_response({
+            'query': query,
+            'suggestions': book_suggestions.suggest(query, limit=limit)
+        })
+        
+    except Exception as e:
+        logging.error(f"Error fetching book suggestions: {e}")
+        return error_response('Failed to fetch suggestions', 500)
+
 @api_bp.route('/books/<int:book_id>', methods=['GET'])
 def get_book(book_id):
     """GET /api/v1/books/{id} - Get specific book by ID"""
     try:
-        book = Book.query.get(book_id)
-        if not book:
+        # Version stamp first; the full row is only loaded when it changed
+        stamp = db.session.query(Book.id, Book.last_modified_expr()).filter(Book.id == book_id).first()
+        if not stamp:
             return error_response('Book not found', 404)
-        
-        book_data = book.to_dict()
-        book_data['average_rating'] = book.get_average_rating()
-        book_data['review_count'] = book.get_review_count()
-        
-        # Add poster information
-        if book.poster:
-            book_data['poster_info'] = {
-                'id': book.poster.id,
-                'username': book.poster.username,
-                'full_name': book.poster.get_full_name()
-            }
-        
-        return success_response(book_data)
+        last_modified = stamp[1]
+        
+        def build():
+            book = Book.query.options(joinedload(Book.poster)).get(book_id)
+            if not book:
+                return error_response('Book not found', 404)
+            
+            book_data = book.to_dict()
+            book_data['rating_histogram'] = book.get_rating_histogram()
+            
+            # Add poster information
+            if book.poster:
+                book_data['poster_info'] = {
+                    'id': book.poster.id,
+                    'username': book.poster.username,
+                    'full_name': book.poster.get_full_name()
+                }
+            
+            return success_response(book_data)
+        
+        return conditional_response(make_etag(book_id, last_modified), last_modified, build)
         
     except Exception as e:
         logging.error(f"Error fetching book {book_id}: {e}")
@@ -318,6 +436,8 @@ def create_book():
         
         db.session.add(book)
         db.session.commit()
+        catalog_facets.invalidate()
+        book_suggestions.add(book)
         
         return success_response(book.to_dict(), 'Book created successfully', 201)
         
@@ -363,6 +483,9 @@ def update_book(book_id):
             book.available = data['available']
         
         db.session.commit()
+        catalog_facets.invalidate()
+        if 'title' in data or 'author' in data:
+            book_suggestions.add(book)
         
         return success_response(book.to_dict(), 'Book updated successfully')
         
@@ -386,6 +509,8 @@ def delete_book(book_id):
         
         db.session.delete(book)
         db.session.commit()
+        catalog_facets.invalidate()
+        book_suggestions.remove(book_id)
         
         return success_response(message='Book deleted successfully')
         
@@ -403,7 +528,9 @@ def delete_book(book_id):
 def get_borrowed_books():
     """GET /api/v1/borrowed-books - Get current user's borrowed books"""
     try:
-        borrowed_books = BorrowedBook.query.filter_by(
+        borrowed_books = BorrowedBook.query.options(
+            joinedload(BorrowedBook.book).joinedload(Book.poster)
+        ).filter_by(
             user_id=current_user.id,
             is_returned=False
         ).all()
@@ -455,6 +582,7 @@ def borrow_book(book_id):
         book.available = False
         db.session.add(borrowed_book)
         db.session.commit()
+        catalog_facets.invalidate()
         
         return success_response({
             'id': borrowed_book.id,
@@ -488,6 +616,7 @@ def return_book(borrow_id):
         borrowed_book.book.available = True
         
         db.session.commit()
+        catalog_facets.invalidate()
         
         return success_response(message='Book returned successfully')
         
@@ -508,28 +637,35 @@ def get_book_reviews(book_id):
         if not book:
             return error_response('Book not found', 404)
         
-        page = request.args.get('page', 1, type=int)
-        per_page = request.args.get('per_page', 10, type=int)
-        
-        reviews = BookReview.query.filter_by(book_id=book_id).paginate(
-            page=page, per_page=per_page, error_out=False
-        )
-        
-        result = {
-            'reviews': [review.to_dict() for review in reviews.items],
-            'pagination': {
-                'page': reviews.page,
-                'pages': reviews.pages,
-                'per_page': reviews.per_page,
-                'total': reviews.total,
-                'has_next': reviews.has_next,
-                'has_prev': reviews.has_prev
-            },
-            'average_rating': book.get_average_rating()
-        }
+        reviews_query = BookReview.query.filter_by(book_id=book_id)
+        count, last_modified = table_stamp(reviews_query, BookReview.updated_at)
+        # Review deletes bump the book's updated_at (Book.adjust_rating)
+        last_modified = newest(last_modified, book.updated_at or book.created_at)
+        etag = make_etag(count, last_modified)
+        
+        def build():
+            reviews, pagination = paginate_list(
+                reviews_query.options(selectinload(BookReview.user)),
+                (BookReview.created_at, BookReview.id),
+                default_per_page=10
+            )
+            fmt = request_formatter()
+            
+            result = {
+                'reviews': [review.to_dict(fmt) for review in reviews],
+                'pagination': pagination,
+                'average_rating': book.get_average_rating(),
+                'review_count': book.get_review_count(),
+                'rating_histogram': book.get_rating_histogram()
+            }
+            
+            return success_response(result)
         
-        return success_response(result)
+        # Weak: the body carries relative "time ago" strings
+        return conditional_response(etag, last_modified, build, weak=True)
         
+    except ValueError as e:
+        return error_response(str(e))
     except Exception as e:
         logging.error(f"Error fetching reviews for book {book_id}: {e}")
         return error_response('Failed to fetch reviews', 500)
@@ -572,6 +708,7 @@ def create_book_review(book_id):
         review.review_text = data.get('review_text')
         
         db.session.add(review)
+        Book.adjust_rating(book_id, new_rating=rating)
         db.session.commit()
         
         return success_response(review.to_dict(), 'Review created successfully', 201)
@@ -602,6 +739,7 @@ def update_review(review_id):
             rating = data['rating']
             if not isinstance(rating, int) or rating < 1 or rating > 5:
                 return error_response('Rating must be an integer between 1 and 5')
+            Book.adjust_rating(review.book_id, old_rating=review.rating, new_rating=rating)
             review.rating = rating
         
         if 'review_text' in data:
@@ -629,6 +767,7 @@ def delete_review(review_id):
         if review.user_id != current_user.id:
             return error_response('Access denied', 403)
         
+        Book.adjust_rating(review.book_id, old_rating=review.rating)
         db.session.delete(review)
         db.session.commit()
         
@@ -647,8 +786,6 @@ def delete_review(review_id):
 def get_discussions():
     """GET /api/v1/discussions - List all discussions"""
     try:
-        page = request.args.get('page', 1, type=int)
-        per_page = request.args.get('per_page', 20, type=int)
         book_id = request.args.get('book_id', type=int)
         
         query = Discussion.query
@@ -656,24 +793,21 @@ def get_discussions():
         if book_id:
             query = query.filter_by(book_id=book_id)
         
-        discussions = query.order_by(Discussion.timestamp.desc()).paginate(
-            page=page, per_page=per_page, error_out=False
+        discussions, pagination = paginate_list(
+            query.order_by(Discussion.created_at.desc(), Discussion.id.desc()),
+            (Discussion.created_at, Discussion.id)
         )
+        fmt = request_formatter()
         
         result = {
-            'discussions': [discussion.to_dict() for discussion in discussions.items],
-            'pagination': {
-                'page': discussions.page,
-                'pages': discussions.pages,
-                'per_page': discussions.per_page,
-                'total': discussions.total,
-                'has_next': discussions.has_next,
-                'has_prev': discussions.has_prev
-            }
+            'discussions': [discussion.to_dict(fmt) for discussion in discussions],
+            'pagination': pagination
         }
         
         return success_response(result)
         
+    except ValueError as e:
+        return error_response(str(e))
     except Exception as e:
         logging.error(f"Error fetching discussions: {e}")
         return error_response('Failed to fetch discussions', 500)
@@ -707,42 +841,74 @@ def create_discussion():
         db.session.rollback()
         return error_response('Failed to create discussion', 500)
 
+# ============================================================================
+# PRIVATE MESSAGES API ENDPOINTS
+# ============================================================================
+
+@api_bp.route('/conversations', methods=['GET'])
+@login_required
+def get_conversations():
+    """GET /api/v1/conversations - Inbox: latest conversations first"""
+    try:
+        query = Conversation.query.options(
+            joinedload(Conversation.peer)
+        ).filter_by(user_id=current_user.id)
+
+        if request.args.get('unread_only', 'false').lower() == 'true':
+            query = query.filter(Conversation.unread_count > 0)
+
+        conversations, pagination = paginate_list(
+            query.order_by(Conversation.last_message_at.desc(), Conversation.id.desc()),
+            (Conversation.last_message_at, Conversation.id)
+        )
+        fmt = request_formatter()
+
+        return success_response({
+            'conversations': [conversation.to_dict(fmt) for conversation in conversations],
+            'pagination': pagination
+        })
+
+    except ValueError as e:
+        return error_response(str(e))
+    except Exception as e:
+        logging.error(f"Error fetching conversations: {e}")
+        return error_response('Failed to fetch conversations', 500)
+
 # ============================================================================
 # NOTIFICATIONS API ENDPOINTS
 # ============================================================================
 
+def notifications_query(model, user_id, unread_only=False):
+    """A user's notifications (live or archived ``model``), newest first"""
+    query = model.query.filter_by(user_id=user_id)
+    if unread_only:
+        query = query.filter_by(is_read=False)
+    return query.order_by(model.created_at.desc(), model.id.desc())
+
 @api_bp.route('/notifications', methods=['GET'])
 @login_required
 def get_notifications():
     """GET /api/v1/notifications - Get user's notifications"""
     try:
-        page = request.args.get('page', 1, type=int)
-        per_page = request.args.get('per_page', 20, type=int)
         unread_only = request.args.get('unread_only', 'false').lower() == 'true'
+        # Read notifications past retention live in the archive table
+        model = ArchivedNotification if request.args.get('archived', 'false').lower() == 'true' else Notification
         
-        query = Notification.query.filter_by(user_id=current_user.id)
-        
-        if unread_only:
-            query = query.filter_by(is_read=False)
-        
-        notifications = query.order_by(Notification.created_at.desc()).paginate(
-            page=page, per_page=per_page, error_out=False
+        notifications, pagination = paginate_list(
+            notifications_query(model, current_user.id, unread_only),
+            (model.created_at, model.id)
         )
+        fmt = request_formatter()
         
         result = {
-            'notifications': [notification.to_dict() for notification in notifications.items],
-            'pagination': {
-                'page': notifications.page,
-                'pages': notifications.pages,
-                'per_page': notifications.per_page,
-                'total': notifications.total,
-                'has_next': notifications.has_next,
-                'has_prev': notifications.has_prev
-            }
+            'notifications': [notification.to_dict(fmt) for notification in notifications],
+            'pagination': pagination
         }
         
         return success_response(result)
         
+    except ValueError as e:
+        return error_response(str(e))
     except Exception as e:
         logging.error(f"Error fetching notifications: {e}")
         return error_response('Failed to fetch notifications', 500)
@@ -769,6 +935,43 @@ def mark_notification_read(notification_id):
         db.session.rollback()
         return error_response('Failed to mark notification as read', 500)
 
+@api_bp.route('/notifications/read', methods=['PUT'])
+@login_required
+def mark_notifications_read():
+    """PUT /api/v1/notifications/read - Mark unread notifications as read in bulk"""
+    try:
+        data = request.get_json(silent=True) or {}
+        filters = {}
+        for field in ('book_id', 'related_user_id'):
+            if data.get(field) is not None:
+                try:
+                    filters[field] = int(data[field])
+                except (TypeError, ValueError):
+                    return error_response(f'{field} must be an integer')
+        if data.get('type'):
+            filters['type'] = str(data['type'])
+        if data.get('before'):
+            try:
+                before = datetime.fromisoformat(str(data['before']).replace('Z', '+00:00'))
+            except ValueError:
+                return error_response('before must be an ISO 8601 timestamp')
+            if before.tzinfo is not None:
+                before = before.astimezone(timezone.utc).replace(tzinfo=None)
+            filters['before'] = before
+
+        marked = Notification.mark_read(current_user.id, **filters)
+        db.session.commit()
+        if marked:
+            invalidate_header_counts(current_user.id)
+            notify_count_changed(current_user.id)
+
+        return success_response({'marked_count': marked}, 'Notifications marked as read')
+
+    except Exception as e:
+        logging.error(f"Error marking notifications as read: {e}")
+        db.session.rollback()
+        return error_response('Failed to mark notifications as read', 500)
+
 # Register error handlers
 @api_bp.errorhandler(404)
 def not_found(error):
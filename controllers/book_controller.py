@@ -7,58 +7,74 @@ from flask_login import login_required, current_user
 from config import db
 from models import Book, BorrowedBook, User, Notification
 from datetime import datetime, timedelta
+from sqlalchemy import case
+from sqlalchemy.orm import joinedload
 from utils.image_upload import upload_book_cover
+from utils import search as book_search
+from utils.book_cards import load_book_cards
+from utils.facets import catalog_facets
+from utils.suggest import book_suggestions
 import logging
 
+# Number of book cards rendered per catalog page / infinite-scroll batch
+CATALOG_PER_PAGE = 24
+
+
 def index():
     """Home page with book catalog"""
-    from models.book import BorrowedBook
-
-    books = load_books()
     search_query = request.args.get('search', '').strip()
     category_filter = request.args.get('category', '').strip()
     location_filter = request.args.get('location', '').strip()
+    sort = request.args.get('sort', '').strip() or ('relevance' if search_query else 'newest')
+    page = request.args.get('page', 1, type=int)
+
+    # ✅ Lọc, sắp xếp và phân trang ngay trong SQL
+    query = build_book_query(
+        search=search_query,
+        category=category_filter,
+        location=location_filter,
+        sort=sort
+    )
+    pagination = query.paginate(page=page, per_page=CATALOG_PER_PAGE, error_out=False)
+    books = pagination.items
+    highlights = book_search.highlight_books(books, search_query) if search_query else {}
+
+    # ✅ Người đăng, đánh giá và yêu cầu đang chờ cho cả trang (mỗi thuộc tính một truy vấn)
+    cards = load_book_cards(
+        [book.id for book in books],
+        viewer_id=current_user.id if current_user.is_authenticated else None
+    )
+    pending_requests = [book_id for book_id, card in cards.items() if card['pending_request']]
+
+    # Infinite scroll only needs the next batch of cards
+    if request.args.get('partial') == '1':
+        return render_template(
+            'book_cards.html',
+            books=books,
+            pagination=pagination,
+            highlights=highlights,
+            cards=cards,
+            pending_requests=pending_requests
+        )
 
-    # ✅ Lọc theo từ khóa
-    if search_query:
-        books = [
-            book for book in books
-            if search_query.lower() in book.title.lower()
-            or search_query.lower() in book.author.lower()
-            or (book.description and search_query.lower() in book.description.lower())
-        ]
-
-    # ✅ Lọc theo thể loại
-    if category_filter:
-        books = [book for book in books if category_filter.lower() in book.category.lower()]
-
-    # ✅ Lọc theo vị trí
-    if location_filter:
-        books = [book for book in books if location_filter.lower() in book.location.lower()]
-
-    # ✅ Lấy danh sách thể loại và vị trí duy nhất để hiển thị gợi ý hoặc dropdown
-    all_books = load_books()
-    categories = sorted(list(set(book.category for book in all_books if book.category)))
-    locations = sorted(list(set(book.location for book in all_books if book.location)))
-
-    # ✅ Lấy các yêu cầu mượn đang chờ duyệt
-    pending_requests = []
-    if current_user.is_authenticated:
-        pending_requests = BorrowedBook.query.filter_by(
-            user_id=current_user.id,
-            is_returned=False,
-            is_agreed=False
-        ).all()
-        pending_requests = [req.book_id for req in pending_requests]
+    # ✅ Thể loại và vị trí (kèm số lượng sách) lấy từ bộ nhớ đệm facet
+    facets = catalog_facets.get()
+    categories = facets['categories']
+    locations = facets['locations']
 
     return render_template(
         'index.html',
         books=books,
+        pagination=pagination,
+        total_books=pagination.total,
         search_query=search_query,
         category_filter=category_filter,
         location_filter=location_filter,
+        sort=sort,
         categories=categories,
         locations=locations,
+        highlights=highlights,
+        cards=cards,
         pending_requests=pending_requests
     )
 
@@ -246,6 +262,8 @@ def post_book():
         try:
             db.session.add(book)
             db.session.commit()
+            catalog_facets.invalidate()
+            book_suggestions.add(book)
             flash('Đăng sách thành công!', 'success')
             return render_template('post_book.html', show_success_modal=True, book_title=title)
         except Exception as e:
@@ -273,6 +291,7 @@ def update_book_status(book_id):
         # Toggle availability
         book.available = not book.available
         db.session.commit()
+        catalog_facets.invalidate()
 
         status_text = "có sẵn để cho mượn" if book.available else "không còn cho mượn"
         return jsonify({
@@ -316,6 +335,8 @@ def delete_book(book_id):
         book_title = book.title
         db.session.delete(book)
         db.session.commit()
+        catalog_facets.invalidate()
+        book_suggestions.remove(book_id)
 
         return jsonify({
             'success': True, 
@@ -334,24 +355,23 @@ def dashboard():
         flash('Please login to view your dashboard', 'error')
         return redirect(url_for('login'))
 
-    # Get borrowed books
-    borrowed_books = get_borrowed_books()
+    # Get borrowed books (approved, not yet returned) with their books in one query
+    borrow_records = BorrowedBook.query.options(
+        joinedload(BorrowedBook.book)
+    ).filter_by(
+        user_id=current_user.id,
+        is_returned=False,
+        is_agreed=True
+    ).all()
     borrowed_book_objects = []
 
-    for book_id in borrowed_books:
-        book = get_book_by_id(book_id)
+    for borrow_record in borrow_records:
+        book = borrow_record.book
         if book:
-            borrow_record = BorrowedBook.query.filter_by(
-                book_id=book_id,
-                user_id=current_user.id,
-                is_returned=False
-            ).first()
-
-            if borrow_record:
-                # Add borrow record info to book object
-                book.due_date = borrow_record.due_date.strftime('%d/%m/%Y') if borrow_record.due_date else None
-                book.is_overdue = borrow_record.due_date < datetime.now() if borrow_record.due_date else False
-                borrowed_book_objects.append(book)
+            # Add borrow record info to book object
+            book.due_date = borrow_record.due_date.strftime('%d/%m/%Y') if borrow_record.due_date else None
+            book.is_overdue = borrow_record.due_date < datetime.now() if borrow_record.due_date else False
+            borrowed_book_objects.append(book)
 
     # Get books posted by current user
     posted_books = Book.query.filter_by(posted_by=current_user.id).all()
@@ -359,10 +379,17 @@ def dashboard():
     # Get pending borrow requests
     pending_requests = get_pending_borrow_requests()
 
+    # Ratings and poster names for every book shown, batched
+    cards = load_book_cards(
+        [book.id for book in borrowed_book_objects + posted_books] +
+        [item['book'].id for item in pending_requests]
+    )
+
     return render_template('dashboard.html', 
                          borrowed_books=borrowed_book_objects,
                          posted_books=posted_books,
-                         pending_requests=pending_requests)
+                         pending_requests=pending_requests,
+                         cards=cards)
 
 
 def seed_books():
@@ -410,17 +437,46 @@ def seed_books():
 
 
 # Helper functions
-def load_books():
-    """Load books from database"""
-    try:
-        books = Book.query.order_by(Book.created_at.desc()).all()
-        for book in books:
-            if book.posted_by:
-                poster = User.query.get(book.posted_by)
-        return books
-    except Exception as e:
-        logging.error(f"Error loading books: {e}")
-        return []
+# Catalog sort options exposed to the home page and the API
+BOOK_SORT_OPTIONS = {
+    'newest': (Book.created_at.desc(), Book.id.desc()),
+    'oldest': (Book.created_at.asc(), Book.id.asc()),
+    'title': (Book.title.asc(), Book.id.asc()),
+    'rating': (
+        case((Book.rating_count > 0, Book.rating_sum * 1.0 / Book.rating_count), else_=0).desc(),
+        Book.rating_count.desc(),
+        Book.id.desc()
+    ),
+}
+
+
+def build_book_query(search='', category='', location='', sort='newest', available_only=False):
+    """Build a catalog query with filtering and ordering done in the database.
+
+    ``search`` goes through the full-text and fuzzy indexes (title, author,
+    description) and ``sort='relevance'`` orders by their rank. ``location``
+    is matched accent-insensitively; ``category`` keeps the catalog page's
+    case-insensitive substring matching.
+    """
+    query = Book.query
+    rank = None
+
+    if search:
+        query, rank = book_search.apply_search(query, search)
+
+    if category:
+        query = query.filter(Book.category.ilike(f'%{category}%'))
+
+    if location:
+        query = query.filter(book_search.fuzzy_filter(Book.location_norm, location))
+
+    if available_only:
+        query = query.filter(Book.available == True)
+
+    if sort == 'relevance' and rank is not None:
+        return query.order_by(rank.desc(), Book.id.desc())
+
+    return query.order_by(*BOOK_SORT_OPTIONS.get(sort, BOOK_SORT_OPTIONS['newest']))
 
 
 def get_book_by_id(book_id):
@@ -455,7 +511,9 @@ def get_pending_borrow_requests():
         return []
 
     try:
-        pending_requests = BorrowedBook.query.filter_by(
+        pending_requests = BorrowedBook.query.options(
+            joinedload(BorrowedBook.book)
+        ).filter_by(
             user_id=current_user.id,
             is_returned=False,
             is_agreed=False
@@ -463,7 +521,7 @@ def get_pending_borrow_requests():
 
         requests_with_books = []
         for request in pending_requests:
-            book = get_book_by_id(request.book_id)
+            book = request.book
             if book:
                 requests_with_books.append({
                     'request': request,
@@ -517,16 +575,13 @@ def create_borrow_notification(book, borrower_name, proposed_due_date=None):
 
     due_date_str = proposed_due_date.strftime('%Y-%m-%d') if proposed_due_date else 'Not specified'
 
-    notification = Notification(
-        user_id=book.posted_by,
-        book_id=book.id,
-        type='borrow_request',
+    Notification.notify(
+        book.posted_by, 'borrow_request',
         title='New Borrow Request',
         message=f'{borrower_name} wants to borrow "{book.title}" (due: {due_date_str})',
+        book_id=book.id,
         related_user_id=current_user.id
     )
-
-    db.session.add(notification)
     db.session.commit()
 
     logging.info(f"Notification created for user {book.posted_by} about book {book.id}")
@@ -554,5 +609,6 @@ def remove_borrowed_book(book_id):
         book.available = True
 
     db.session.commit()
+    catalog_facets.invalidate()
 
     logging.info(f"Book {book_id} returned by user {current_user.id}")
\ No newline at end of file
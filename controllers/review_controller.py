@@ -7,6 +7,9 @@ from flask_login import login_required, current_user
 from config import db
 from models import BookReview, Book
 from datetime import datetime
+from sqlalchemy.orm import selectinload
+from utils.http_cache import conditional_response, make_etag, newest, table_stamp
+from utils.timefmt import request_formatter
 import logging
 
 
@@ -37,6 +40,7 @@ def add_review(book_id):
         
         if existing_review:
             # Update existing review
+            Book.adjust_rating(book_id, old_rating=existing_review.rating, new_rating=rating)
             existing_review.rating = rating
             existing_review.review_text = review_text
             existing_review.updated_at = datetime.utcnow()
@@ -48,6 +52,7 @@ def add_review(book_id):
             review.rating = rating
             review.review_text = review_text
             db.session.add(review)
+            Book.adjust_rating(book_id, new_rating=rating)
         
         db.session.commit()
         
@@ -57,6 +62,7 @@ def add_review(book_id):
         })
         
     except Exception as e:
+        db.session.rollback()
         logging.error(f"Error saving review: {e}")
         return jsonify({'success': False, 'error': 'Failed to save review'}), 500
 
@@ -64,16 +70,27 @@ def add_review(book_id):
 def get_reviews(book_id):
     """Get all reviews for a book"""
     try:
-        reviews = BookReview.query.filter_by(book_id=book_id).order_by(BookReview.created_at.desc()).all()
+        reviews_query = BookReview.query.filter_by(book_id=book_id)
+        count, last_modified = table_stamp(reviews_query, BookReview.updated_at)
+        # Review deletes bump the book's updated_at (Book.adjust_rating)
+        book_modified = db.session.query(Book.last_modified_expr()).filter(Book.id == book_id).scalar()
+        last_modified = newest(last_modified, book_modified)
         
-        reviews_data = []
-        for review in reviews:
-            reviews_data.append(review.to_dict())
+        def build():
+            reviews = reviews_query.options(
+                selectinload(BookReview.user)
+            ).order_by(BookReview.created_at.desc()).all()
+            
+            fmt = request_formatter()
+            reviews_data = [review.to_dict(fmt) for review in reviews]
+            
+            return jsonify({
+                'success': True,
+                'reviews': reviews_data
+            })
         
-        return jsonify({
-            'success': True,
-            'reviews': reviews_data
-        })
+        # Weak: the body carries relative "time ago" strings
+        return conditional_response(make_etag(count, last_modified), last_modified, build, weak=True)
         
     except Exception as e:
         logging.error(f"Error fetching reviews: {e}")
@@ -93,6 +110,7 @@ def delete_review(review_id):
         if review.user_id != current_user.id:
             return jsonify({'success': False, 'error': 'Unauthorized'}), 403
         
+        Book.adjust_rating(review.book_id, old_rating=review.rating)
         db.session.delete(review)
         db.session.commit()
         
@@ -102,5 +120,6 @@ def delete_review(review_id):
         })
         
     except Exception as e:
+        db.session.rollback()
         logging.error(f"Error deleting review: {e}")
         return jsonify({'success': False, 'error': 'Failed to delete review'}), 500
\ No newline at end of file
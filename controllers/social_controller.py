@@ -2,12 +2,60 @@
 Social Controller
 Handles social features like discussions, private messages, and user profiles.
 """
-from flask import render_template, request, redirect, url_for, flash, session, jsonify
+from flask import render_template, request, redirect, url_for, flash, session, jsonify, Response, stream_with_context, current_app
 from flask_login import login_required, current_user
+from sqlalchemy import tuple_
 from config import db
-from models import Discussion, PrivateMessage, User, Book, Notification, BorrowedBook
+from models import Discussion, PrivateMessage, User, Book, Notification, BorrowedBook, ArchivedDiscussion, ArchivedPrivateMessage
 from datetime import datetime
+from utils.facets import catalog_facets
+from utils.header_counts import get_header_counts, invalidate_header_counts
+from utils.notification_hub import notification_hub, notify_count_changed
+from utils.chat_bus import gateway_url, make_gateway_token
+from utils.discussion_feed import discussion_feed
+from utils.timefmt import request_formatter, TimeFormatter
+import json
 import logging
+import queue
+
+# Seconds between keep-alive comments on idle notification streams
+STREAM_KEEPALIVE_SECONDS = 25
+# Messages rendered on chat/discussion pages and per scrollback request
+SCROLLBACK_PAGE_SIZE = 50
+
+
+def _latest_page(query, *order_by, limit=SCROLLBACK_PAGE_SIZE, archive=None):
+    """Newest ``limit`` rows of ``query`` (``order_by`` descending), returned
+    oldest first, plus whether older rows remain.
+
+    ``archive`` is ``(query, order_by)`` over the matching archive table;
+    archived rows are all older than live ones (utils.retention), so a page
+    that runs out of live rows continues there.
+    """
+    rows = query.order_by(*order_by).limit(limit + 1).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if archive is not None and not has_more:
+        archive_query, archive_order_by = archive
+        need = limit - len(rows)
+        older = archive_query.order_by(*archive_order_by).limit(need + 1).all()
+        has_more = len(older) > need
+        rows += older[:need]
+    return list(reversed(rows)), has_more
+
+
+def _chat_between(model, user_id, peer_id):
+    return model.query.filter(
+        ((model.sender_id == user_id) & (model.recipient_id == peer_id)) |
+        ((model.sender_id == peer_id) & (model.recipient_id == user_id))
+    )
+
+
+def chat_poll_query(user_id, peer_id, after_id):
+    """Messages of a conversation newer than ``after_id``, oldest first"""
+    return _chat_between(PrivateMessage, user_id, peer_id).filter(
+        PrivateMessage.id > after_id
+    ).order_by(PrivateMessage.id.asc())
 
 
 def discussion():
@@ -37,21 +85,21 @@ def discussion():
         
         return redirect(url_for('discussion'))
     
-    # GET request - show discussion page
-    return render_template('discussion.html')
+    # GET request - show discussion page (latest messages from the in-memory feed)
+    return render_template('discussion.html', messages=discussion_feed.since())
 
 
 def get_discussion_messages():
     """API endpoint to get discussion messages for real-time updates"""
     try:
-        messages = Discussion.query.filter_by(book_id=None).order_by(Discussion.created_at.desc()).limit(50).all()
-        messages_data = []
-        for msg in messages:
-            messages_data.append(msg.to_dict())
+        # ✅ Phục vụ từ bộ đệm vòng trong bộ nhớ; after_id chỉ trả về tin mới
+        after_id = request.args.get('after_id', type=int)
+        messages = discussion_feed.since(after_id)
         
         return jsonify({
             'success': True,
-            'messages': list(reversed(messages_data))
+            'messages': messages,
+            'last_id': messages[-1]['id'] if messages else after_id
         })
     except Exception as e:
         logging.error(f"Error fetching discussion messages: {e}")
@@ -89,30 +137,69 @@ def book_discussion(book_id):
     
     # GET request - show book discussion page
     try:
-        # Fetch messages for this book
-        messages = Discussion.query.filter_by(book_id=book_id).order_by(Discussion.created_at.asc()).all()
+        # ✅ Chỉ hiển thị N tin mới nhất; tin cũ hơn tải thêm khi cuộn lên (before_id)
+        messages, has_more = _latest_page(
+            Discussion.query.filter_by(book_id=book_id),
+            Discussion.created_at.desc(), Discussion.id.desc(),
+            archive=(
+                ArchivedDiscussion.query.filter_by(book_id=book_id),
+                (ArchivedDiscussion.created_at.desc(), ArchivedDiscussion.id.desc())
+            )
+        )
         
         # Add Vietnam timezone formatting for each message
+        fmt = TimeFormatter()
         for message in messages:
-            if message.created_at:
-                from pytz import timezone
-                vn_tz = timezone('Asia/Ho_Chi_Minh')
-                local_time = message.created_at.replace(tzinfo=timezone('UTC')).astimezone(vn_tz)
-                message.vietnam_time = local_time.strftime('%d/%m/%Y %H:%M')
-            else:
-                message.vietnam_time = 'Unknown time'
-        
-        return render_template('book_discussion.html', book=book, messages=messages)
+            message.vietnam_time = fmt.format(message.created_at) if message.created_at else 'Unknown time'
+        
+        return render_template('book_discussion.html', book=book, messages=messages, has_more=has_more)
     except Exception as e:
         logging.error(f"Error loading book discussion messages: {e}")
-        return render_template('book_discussion.html', book=book, messages=[])
+        return render_template('book_discussion.html', book=book, messages=[], has_more=False)
+
+
+def get_book_discussion_messages(book_id):
+    """Older book discussion messages for scrollback (``?before_id=``)"""
+    try:
+        before_id = request.args.get('before_id', type=int)
+        fmt = request_formatter()
+        query = Discussion.query.filter_by(book_id=book_id)
+        archived = ArchivedDiscussion.query.filter_by(book_id=book_id)
+
+        if before_id is not None:
+            # Tin mốc có thể đã nằm trong bảng lưu trữ
+            anchor = None
+            for model in (Discussion, ArchivedDiscussion):
+                anchor = db.session.query(model.created_at, model.id).filter_by(
+                    id=before_id, book_id=book_id
+                ).first()
+                if anchor is not None:
+                    break
+            if anchor is None:
+                return jsonify({'success': False, 'error': 'Invalid before_id'}), 400
+            # Keyset theo (created_at, id), khớp với thứ tự hiển thị
+            query = query.filter(tuple_(Discussion.created_at, Discussion.id) < tuple(anchor))
+            archived = archived.filter(tuple_(ArchivedDiscussion.created_at, ArchivedDiscussion.id) < tuple(anchor))
+
+        messages, has_more = _latest_page(
+            query, Discussion.created_at.desc(), Discussion.id.desc(),
+            archive=(archived, (ArchivedDiscussion.created_at.desc(), ArchivedDiscussion.id.desc()))
+        )
+
+        return jsonify({
+            'success': True,
+            'messages': [message.to_dict(fmt) for message in messages],
+            'has_more': has_more
+        })
+    except Exception as e:
+        logging.error(f"Error fetching book discussion messages: {e}")
+        return jsonify({'success': False, 'error': 'Failed to fetch messages'}), 500
 
 
 from flask import render_template, redirect, url_for, flash
 from flask_login import current_user
-from models import User, Book, PrivateMessage
+from models import User, Book, PrivateMessage, Conversation
 from datetime import datetime, timezone
-from pytz import timezone as pytz_timezone
 from config import db
 import logging
 
@@ -122,60 +209,40 @@ def private_chat(recipient_id, book_id=None):
         flash('Please login to access private chat', 'error')
         return redirect(url_for('login'))
 
+    # Mark messages as read and reset this conversation's unread count
+    # (before loading the page's rows, so the commit does not expire them)
+    try:
+        Conversation.mark_read(current_user.id, recipient_id)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        logging.error(f"Error marking messages as read: {e}")
+
     recipient = User.query.get_or_404(recipient_id)
 
     # Get book context if provided
     book = Book.query.get(book_id) if book_id else None
 
-    # Get existing messages between users
-    messages = PrivateMessage.query.filter(
-        ((PrivateMessage.sender_id == current_user.id) & (PrivateMessage.recipient_id == recipient_id)) |
-        ((PrivateMessage.sender_id == recipient_id) & (PrivateMessage.recipient_id == current_user.id))
-    ).order_by(PrivateMessage.timestamp.asc()).all()
-
-    # Add time_ago field for template compatibility
-    vn_tz = pytz_timezone('Asia/Ho_Chi_Minh')
-    now_utc = datetime.utcnow().replace(tzinfo=timezone.utc)
-
+    # Latest messages between users; older ones load on scroll (before_id)
+    messages, has_more = _latest_page(
+        _chat_between(PrivateMessage, current_user.id, recipient_id),
+        PrivateMessage.id.desc(),
+        archive=(
+            _chat_between(ArchivedPrivateMessage, current_user.id, recipient_id),
+            (ArchivedPrivateMessage.id.desc(),)
+        )
+    )
+
+    # Add time_ago field for template compatibility (one "now" for the page)
+    fmt = TimeFormatter()
     for message in messages:
-        # Convert timestamp safely
-        if message.timestamp.tzinfo is None:
-            local_time = message.timestamp.replace(tzinfo=timezone.utc).astimezone(vn_tz)
-            time_diff = now_utc - message.timestamp.replace(tzinfo=timezone.utc)
-        else:
-            local_time = message.timestamp.astimezone(vn_tz)
-            time_diff = now_utc - message.timestamp.astimezone(timezone.utc)
-
-        # Format time ago
-        if time_diff.days > 0:
-            message.time_ago = f"{time_diff.days}d ago"
-        elif time_diff.seconds > 3600:
-            message.time_ago = f"{time_diff.seconds // 3600}h ago"
-        elif time_diff.seconds > 60:
-            message.time_ago = f"{time_diff.seconds // 60}m ago"
-        else:
-            message.time_ago = "just now"
-
-    # Mark messages as read using ORM instances
-    unread_messages = PrivateMessage.query.filter_by(
-        sender_id=recipient_id,
-        recipient_id=current_user.id,
-        is_read=False
-    ).all()
-
-    for msg in unread_messages:
-        msg.is_read = True
-
-    try:
-        db.session.commit()
-    except Exception as e:
-        db.session.rollback()
-        logging.error(f"Error marking messages as read: {e}")
+        message.time_ago = fmt.time_ago(message.timestamp)
 
     return render_template('private_chat.html', 
                            recipient=recipient, 
                            book=book,
-                           messages=messages)
+                           messages=messages,
+                           has_more=has_more)
 
 
 def send_private_message(recipient_id):
@@ -203,33 +270,14 @@ def send_private_message(recipient_id):
 
         db.session.add(message)
 
-        # ✅ KIỂM TRA XEM ĐÃ CÓ THÔNG BÁO CHƯA ĐỌC TỪ NGƯỜI NÀY CHƯA
-        existing_notification = Notification.query.filter_by(
-            user_id=recipient_id,
-            type='private_message',
-            related_user_id=current_user.id,
-            is_read=False
-        ).first()
-
-        if existing_notification:
-            # ✅ CẬP NHẬT THỜI GIAN THÔNG BÁO (đẩy lên đầu danh sách)
-            existing_notification.created_at = datetime.utcnow()
-            logging.info(f"Cập nhật thời gian thông báo từ {current_user.id} đến {recipient_id}")
-        else:
-            # ✅ TẠO THÔNG BÁO MỚI - KHÔNG NHẮC ĐÉN SÁCH
-            notification_message = f'{current_user.get_full_name() or current_user.username} đã gửi tin nhắn cho bạn'
-            notification_title = 'Tin nhắn riêng mới'
-
-            notification = Notification()
-            notification.user_id = recipient_id
-            notification.type = 'private_message'
-            notification.title = notification_title
-            notification.message = notification_message
-            notification.book_id = book_id if book_id else None
-            notification.related_user_id = current_user.id
-
-            db.session.add(notification)
-            logging.info(f"Tạo thông báo mới: tin nhắn từ {current_user.id} đến {recipient_id}")
+        # ✅ Gộp vào thông báo chưa đọc từ người này (nếu có) thay vì tạo dòng mới
+        Notification.notify(
+            recipient_id, 'private_message',
+            title='Tin nhắn riêng mới',
+            message=f'{current_user.get_full_name() or current_user.username} đã gửi tin nhắn cho bạn',
+            book_id=book_id if book_id else None,
+            related_user_id=current_user.id
+        )
 
         db.session.commit()
 
@@ -252,19 +300,52 @@ def get_chat_messages(recipient_id):
         return jsonify({'success': False, 'error': 'Not authenticated'}), 401
     
     try:
+        # ✅ Chỉ lấy tin nhắn mới hơn after_id / after_ts (poll thường trả về 0 dòng),
+        # hoặc một trang tin cũ hơn before_id khi cuộn lên
+        after_id = request.args.get('after_id', type=int)
+        after_ts = request.args.get('after_ts', '').strip()
+        before_id = request.args.get('before_id', type=int)
+        fmt = request_formatter()
+        
         # Get messages between current user and recipient
-        messages = PrivateMessage.query.filter(
-            ((PrivateMessage.sender_id == current_user.id) & (PrivateMessage.recipient_id == recipient_id)) |
-            ((PrivateMessage.sender_id == recipient_id) & (PrivateMessage.recipient_id == current_user.id))
-        ).order_by(PrivateMessage.timestamp.asc()).all()
+        query = _chat_between(PrivateMessage, current_user.id, recipient_id)
         
-        messages_data = []
-        for msg in messages:
-            messages_data.append(msg.to_dict())
+        if after_id is not None:
+            query = chat_poll_query(current_user.id, recipient_id, after_id)
+        elif after_ts:
+            try:
+                after = datetime.fromisoformat(after_ts.replace('Z', '+00:00'))
+            except ValueError:
+                return jsonify({'success': False, 'error': 'Invalid after_ts'}), 400
+            if after.tzinfo is not None:
+                after = after.astimezone(timezone.utc).replace(tzinfo=None)
+            query = query.filter(PrivateMessage.timestamp > after).order_by(PrivateMessage.id.asc())
+        else:
+            # Scrollback (or first load): newest page before before_id,
+            # continuing into archived history
+            archived = _chat_between(ArchivedPrivateMessage, current_user.id, recipient_id)
+            if before_id is not None:
+                query = query.filter(PrivateMessage.id < before_id)
+                archived = archived.filter(ArchivedPrivateMessage.id < before_id)
+            messages, has_more = _latest_page(
+                query, PrivateMessage.id.desc(),
+                archive=(archived, (ArchivedPrivateMessage.id.desc(),))
+            )
+            return jsonify({
+                'success': True,
+                'messages': [msg.to_dict(fmt) for msg in messages],
+                'has_more': has_more,
+                'last_id': messages[-1].id if messages else None
+            })
+        
+        messages = query.all()
+        
+        messages_data = [msg.to_dict(fmt) for msg in messages]
         
         return jsonify({
             'success': True,
-            'messages': messages_data
+            'messages': messages_data,
+            'last_id': messages[-1].id if messages else after_id
         })
         
     except Exception as e:
@@ -316,11 +397,12 @@ def mark_all_notifications_read():
         return jsonify({'success': False, 'error': 'Not authenticated'}), 401
     
     try:
-        notifications = Notification.query.filter_by(user_id=current_user.id, is_read=False).all()
-        for n in notifications:
-            n.is_read = True
+        # ✅ Một câu UPDATE cho tất cả, trừ bộ đếm chưa đọc trong cùng giao dịch
         try:
+            Notification.mark_read(current_user.id)
             db.session.commit()
+            invalidate_header_counts(current_user.id)
+            notify_count_changed(current_user.id)
         except Exception as e:
             db.session.rollback()
             logging.error(f"Lỗi cập nhật thông báo: {e}")
@@ -339,10 +421,7 @@ def get_unread_notifications_count():
         return jsonify({'count': 0})
     
     try:
-        count = Notification.query.filter_by(
-            user_id=current_user.id,
-            is_read=False
-        ).count()
+        count = get_header_counts(current_user.id)['notification_count']
         
         return jsonify({
             'success': True,
@@ -355,6 +434,77 @@ def get_unread_notifications_count():
         return jsonify({'count': 0})
 
 
+def chat_gateway_token():
+    """Short-lived token for opening the chat WebSocket (see chat_gateway.py)"""
+    if not current_user.is_authenticated:
+        return jsonify({'success': False, 'error': 'Not authenticated'}), 401
+
+    url = gateway_url()
+    if not url:
+        # Không có gateway: trang chat tiếp tục hỏi định kỳ
+        return jsonify({'success': False, 'error': 'Chat gateway is not configured'}), 503
+
+    return jsonify({
+        'success': True,
+        'url': url,
+        'token': make_gateway_token(current_app.secret_key, current_user.id, request.host_url.rstrip('/'))
+    })
+
+
+def notification_stream():
+    """Server-Sent Events stream of unread-count changes and new notifications"""
+    if not current_user.is_authenticated:
+        return jsonify({'success': False, 'error': 'Not authenticated'}), 401
+
+    user_id = current_user.id
+    subscription = notification_hub.subscribe(user_id)
+
+    def unread_count():
+        try:
+            return db.session.query(User.unread_notifications).filter_by(id=user_id).scalar() or 0
+        finally:
+            # Không giữ kết nối DB trong lúc stream đang rảnh
+            db.session.close()
+
+    def sse(event_name, data):
+        return f"event: {event_name}\ndata: {json.dumps(data)}\n\n"
+
+    def generate():
+        try:
+            last_count = unread_count()
+            yield 'retry: 5000\n\n'
+            yield sse('count', {'unread_count': last_count})
+
+            while True:
+                try:
+                    event_name, data = subscription.get(timeout=STREAM_KEEPALIVE_SECONDS)
+                except queue.Empty:
+                    # Hub theo từng worker: đồng bộ lại số đếm ở mỗi nhịp keep-alive
+                    if not notification_hub.shared:
+                        count = unread_count()
+                        if count != last_count:
+                            last_count = count
+                            yield sse('count', {'unread_count': count})
+                    yield ': keep-alive\n\n'
+                    continue
+
+                if event_name == 'notification':
+                    yield sse('notification', data)
+
+                count = unread_count()
+                if count != last_count:
+                    last_count = count
+                    yield sse('count', {'unread_count': count})
+        finally:
+            notification_hub.unsubscribe(user_id, subscription)
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+
 def handle_book_request_notification(notification_id, action):
     """Handle accept/decline actions for book request notifications"""
     if not current_user.is_authenticated:
@@ -394,14 +544,13 @@ def handle_book_request_notification(notification_id, action):
             book.available = False
             
             # Create notification for borrower
-            borrower_notification = Notification()
-            borrower_notification.user_id = notification.related_user_id
-            borrower_notification.type = 'borrow_approved'
-            borrower_notification.title = 'Book Request Approved'
-            borrower_notification.message = f'Your request to borrow "{book.title}" has been approved!'
-            borrower_notification.book_id = book.id
-            borrower_notification.related_user_id = current_user.id
-            db.session.add(borrower_notification)
+            Notification.notify(
+                notification.related_user_id, 'borrow_approved',
+                title='Book Request Approved',
+                message=f'Your request to borrow "{book.title}" has been approved!',
+                book_id=book.id,
+                related_user_id=current_user.id
+            )
             
             logging.info(f"Book request approved for book {book.id} by user {current_user.id}")
             
@@ -410,14 +559,13 @@ def handle_book_request_notification(notification_id, action):
             db.session.delete(borrow_request)
             
             # Create notification for borrower
-            borrower_notification = Notification()
-            borrower_notification.user_id = notification.related_user_id
-            borrower_notification.type = 'borrow_declined'
-            borrower_notification.title = 'Book Request Declined'
-            borrower_notification.message = f'Your request to borrow "{book.title}" has been declined.'
-            borrower_notification.book_id = book.id
-            borrower_notification.related_user_id = current_user.id
-            db.session.add(borrower_notification)
+            Notification.notify(
+                notification.related_user_id, 'borrow_declined',
+                title='Book Request Declined',
+                message=f'Your request to borrow "{book.title}" has been declined.',
+                book_id=book.id,
+                related_user_id=current_user.id
+            )
             
             logging.info(f"Book request declined for book {book.id} by user {current_user.id}")
         
@@ -425,6 +573,7 @@ def handle_book_request_notification(notification_id, action):
         notification.is_read = True
         
         db.session.commit()
+        catalog_facets.invalidate()
         
         return jsonify({
             'success': True, 
@@ -483,6 +632,7 @@ def approve_borrow_request(book_id):
         book.available = False
         
         db.session.commit()
+        catalog_facets.invalidate()
         
         logging.info(f"Borrow request approved for book {book_id} by user {current_user.id}")
         
@@ -554,9 +704,16 @@ def cancel_borrow_request(book_id):
         if not borrow_request:
             return jsonify({'success': False, 'error': 'Borrow request not found'}), 404
         
-        # Delete the request
+        # Delete the request; the owner's notification about it is settled too,
+        # so a new request later shows up as a fresh one
+        owner_id = borrow_request.book.posted_by if borrow_request.book else None
         db.session.delete(borrow_request)
+        if owner_id:
+            Notification.mark_read(owner_id, 'borrow_request', book_id=book_id, related_user_id=current_user.id)
         db.session.commit()
+        if owner_id:
+            invalidate_header_counts(owner_id)
+            notify_count_changed(owner_id)
         
         logging.info(f"Borrow request cancelled for book {book_id} by user {current_user.id}")
         
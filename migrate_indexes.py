@@ -0,0 +1,117 @@
+import argparse
+import sys
+
+from sqlalchemy import text
+
+from app import app
+from config import db
+from controllers.api_controller import notifications_query
+from controllers.book_controller import build_book_query
+from controllers.social_controller import _chat_between, chat_poll_query
+from models import Book, BorrowedBook, Conversation, Discussion, Notification, PrivateMessage
+from utils.schema import add_missing_indexes
+from utils.search import install_search_schema
+
+# Tạo các index khai báo trên model còn thiếu trong DB (PostgreSQL: CREATE
+# INDEX CONCURRENTLY, không khóa ghi) và schema tìm kiếm toàn văn (cột
+# search_vector + GIN trên PostgreSQL, bảng FTS5 trên SQLite). Chạy một lần ở
+# bước deploy; app không tự tạo index/schema lúc khởi động, chỉ dò xem đã có chưa. Với --check: EXPLAIN từng truy vấn
+# nóng của controller và báo lỗi nếu planner không dùng index mong đợi.
+#
+#   python migrate_indexes.py            # tạo index còn thiếu
+#   python migrate_indexes.py --check    # tạo rồi kiểm tra kế hoạch truy vấn
+
+
+def hot_queries():
+    """(mô tả, index mong đợi, truy vấn) — truy vấn dựng bằng chính hàm của controller/model"""
+    user_id, peer_id, book_id = 1, 2, 1
+    return [
+        ('Số sách đang mượn (header, dashboard)', 'ix_borrowed_books_user_active',
+         BorrowedBook.query.filter_by(user_id=user_id, is_returned=False, is_agreed=True)),
+        ('Yêu cầu mượn đang chờ trên thẻ sách', 'ix_borrowed_books_user_active',
+         BorrowedBook.query.filter(
+             BorrowedBook.user_id == user_id,
+             BorrowedBook.is_returned == False,
+             BorrowedBook.is_agreed == False,
+             BorrowedBook.book_id.in_([1, 2, 3])
+         )),
+        ('Lượt mượn của user với một sách', 'ix_borrowed_books_book_user_active',
+         BorrowedBook.query.filter_by(book_id=book_id, user_id=user_id, is_returned=False)),
+        ('Lượt mượn chưa trả của một sách (xóa sách)', 'ix_borrowed_books_book_user_active',
+         BorrowedBook.query.filter_by(book_id=book_id, is_returned=False)),
+        ('Danh mục sách (mới nhất)', 'ix_books_created',
+         build_book_query()),
+        ('Danh mục sách còn trống', 'ix_books_created',
+         build_book_query(available_only=True)),
+        ('Gộp thông báo tin nhắn chưa đọc', 'ix_notifications_user_read_created',
+         Notification.coalesce_query(user_id, 'private_message', related_user_id=peer_id)),
+        ('Danh sách thông báo', 'ix_notifications_user_created',
+         notifications_query(Notification, user_id).limit(20)),
+        ('Thông báo chưa đọc', 'ix_notifications_user_read_created',
+         notifications_query(Notification, user_id, unread_only=True).limit(20)),
+        ('Lịch sử trò chuyện', 'ix_private_messages_pair_id',
+         _chat_between(PrivateMessage, user_id, peer_id).order_by(PrivateMessage.id.desc()).limit(50)),
+        ('Hỏi tin nhắn mới (after_id)', 'ix_private_messages_pair_id',
+         chat_poll_query(user_id, peer_id, 100)),
+        ('Thảo luận của sách', 'ix_discussions_book_created',
+         Discussion.query.filter_by(book_id=book_id).order_by(Discussion.created_at.desc(), Discussion.id.desc())),
+        ('Thảo luận chung', 'ix_discussions_book_created',
+         Discussion.query.filter_by(book_id=None).order_by(Discussion.created_at.desc()).limit(50)),
+        ('Sách đã đăng', 'ix_books_posted_by',
+         Book.query.filter_by(posted_by=user_id)),
+        ('Hộp thư', 'ix_conversations_user_last',
+         Conversation.query.filter_by(user_id=user_id)
+         .order_by(Conversation.last_message_at.desc(), Conversation.id.desc()).limit(20)),
+    ]
+
+
+def explain(query):
+    """Kế hoạch truy vấn dạng văn bản"""
+    sql = str(query.statement.compile(dialect=db.engine.dialect, compile_kwargs={'literal_binds': True}))
+    if db.engine.dialect.name == 'postgresql':
+        # Bảng nhỏ thì planner thích quét tuần tự; ở đây chỉ kiểm tra index có dùng được không
+        db.session.execute(text('SET LOCAL enable_seqscan = off'))
+        rows = db.session.execute(text(f'EXPLAIN {sql}')).scalars().all()
+    else:
+        rows = [row[-1] for row in db.session.execute(text(f'EXPLAIN QUERY PLAN {sql}'))]
+    db.session.rollback()
+    return '\n'.join(rows)
+
+
+def check_plans():
+    failures = 0
+    for description, index_name, query in hot_queries():
+        plan = explain(query)
+        if index_name in plan:
+            print(f"✅ {description}: {index_name}")
+        else:
+            failures += 1
+            print(f"❌ {description}: không dùng {index_name}\n{plan}")
+    return failures
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Tạo index còn thiếu và kiểm tra kế hoạch truy vấn')
+    parser.add_argument('--check', action='store_true', help='EXPLAIN các truy vấn nóng sau khi tạo index')
+    args = parser.parse_args()
+
+    with app.app_context():
+        print("🔄 Đang tạo các index còn thiếu...")
+        created = add_missing_indexes()
+        print(f"✅ Đã tạo {len(created)} index" + (f": {', '.join(created)}" if created else ''))
+
+        print("🔄 Đang cài schema tìm kiếm toàn văn...")
+        try:
+            backend = install_search_schema()
+            print(f"✅ Tìm kiếm toàn văn: {backend}" if backend else "⚠️ CSDL này không hỗ trợ tìm kiếm toàn văn, dùng ILIKE")
+        except Exception as e:
+            db.session.rollback()
+            print("❌ Lỗi khi cài schema tìm kiếm:", e)
+
+        if args.check:
+            print("🔄 Đang kiểm tra kế hoạch truy vấn...")
+            failures = check_plans()
+            if failures:
+                print(f"❌ {failures} truy vấn không dùng index mong đợi")
+                sys.exit(1)
+            print("✅ Mọi truy vấn nóng đều dùng index")
@@ -2,13 +2,15 @@
 # Import all models to make them available when importing from models
 from .user import User
 from .book import Book, BorrowedBook
-from .social import Discussion, PrivateMessage, Notification
+from .social import Discussion, PrivateMessage, Notification, Conversation
 from .review import BookReview
+from .archive import ArchivedNotification, ArchivedPrivateMessage, ArchivedDiscussion
 
 # Make all models available at package level
 __all__ = [
     'User',
     'Book', 'BorrowedBook',
-    'Discussion', 'PrivateMessage', 'Notification',
-    'BookReview'
+    'Discussion', 'PrivateMessage', 'Notification', 'Conversation',
+    'BookReview',
+    'ArchivedNotification', 'ArchivedPrivateMessage', 'ArchivedDiscussion'
 ]
\ No newline at end of file
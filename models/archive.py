@@ -0,0 +1,67 @@
+from datetime import datetime
+from config import db
+from models.social import Discussion, Notification, PrivateMessage
+
+
+# Cold copies of rows moved out of the live social tables by
+# utils.retention. Rows keep their original ids (so scrollback cursors carry
+# over) and have no foreign keys (archived rows outlive deleted users/books).
+
+
+class ArchivedNotification(db.Model):
+    __tablename__ = 'notifications_archive'
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    user_id = db.Column(db.Integer, nullable=False)
+    type = db.Column(db.String(50), nullable=False)
+    title = db.Column(db.String(200), nullable=False)
+    message = db.Column(db.Text, nullable=False)
+    is_read = db.Column(db.Boolean, default=True)
+    created_at = db.Column(db.DateTime)
+    book_id = db.Column(db.Integer)
+    related_user_id = db.Column(db.Integer)
+    count = db.Column(db.Integer, nullable=False, default=1, server_default='1')
+    archived_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index('ix_notifications_archive_user_created', 'user_id', 'created_at', 'id'),
+    )
+
+    to_dict = Notification.to_dict
+
+
+class ArchivedPrivateMessage(db.Model):
+    __tablename__ = 'private_messages_archive'
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    sender_id = db.Column(db.Integer, nullable=False)
+    recipient_id = db.Column(db.Integer, nullable=False)
+    message = db.Column(db.Text, nullable=False)
+    timestamp = db.Column(db.DateTime)
+    is_read = db.Column(db.Boolean, default=True)
+    book_id = db.Column(db.Integer)
+    archived_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index('ix_private_messages_archive_pair_id', 'sender_id', 'recipient_id', 'id'),
+    )
+
+    to_dict = PrivateMessage.to_dict
+
+
+class ArchivedDiscussion(db.Model):
+    __tablename__ = 'discussions_archive'
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    user_id = db.Column(db.Integer)
+    username = db.Column(db.String(80), nullable=False)
+    message = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime)
+    book_id = db.Column(db.Integer)
+    archived_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index('ix_discussions_archive_book_created', 'book_id', 'created_at', 'id'),
+    )
+
+    to_dict = Discussion.to_dict
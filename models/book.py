@@ -1,5 +1,7 @@
 from datetime import datetime
+from sqlalchemy import event, func
 from config import db
+from utils.text import normalize_text
 
 class Book(db.Model):
     __tablename__ = 'books'
@@ -17,16 +19,60 @@ class Book(db.Model):
     borrow_duration_weeks = db.Column(db.Integer, default=2)
     rental_price = db.Column(db.String(100))
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # Bumped on every change, ratings included; drives HTTP validators (utils.http_cache)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    # Accent-stripped, casefolded copies for fuzzy search (kept in sync on flush)
+    title_norm = db.Column(db.String(200))
+    author_norm = db.Column(db.String(200))
+    location_norm = db.Column(db.String(100))
+
+    # Materialized review aggregates, kept in sync by Book.adjust_rating()
+    rating_sum = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    rating_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    rating_1 = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    rating_2 = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    rating_3 = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    rating_4 = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    rating_5 = db.Column(db.Integer, nullable=False, default=0, server_default='0')
 
     # ✅ CHỈ GIỮ LẠI DÒNG NÀY THÔI
-    posted_by = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=True)
+    posted_by = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=True, index=True)
     poster = db.relationship('User', backref=db.backref('posted_books', lazy=True))
 
+    # Catalog order (newest first) and the API's (created_at, id) keyset pages
+    __table_args__ = (
+        db.Index('ix_books_created', 'created_at', 'id'),
+    )
+
     def __repr__(self):
         return f'<Book {self.title}>'
 
+    def refresh_search_fields(self):
+        """Recompute the normalized columns used by fuzzy search"""
+        self.title_norm = normalize_text(self.title)
+        self.author_norm = normalize_text(self.author)
+        self.location_norm = normalize_text(self.location)
 
-    def to_dict(self):
+
+    @staticmethod
+    def last_modified_expr():
+        """Last change time as a SQL expression (rows predating updated_at fall back to created_at)"""
+        return func.coalesce(Book.updated_at, Book.created_at)
+
+    def to_dict(self, card=None):
+        """Serialize the book; ``card`` is this book's entry from
+        ``utils.book_cards.load_book_cards()`` when the caller batch-loaded it"""
+        if card is not None:
+            return {**self._columns_dict(), **card}
+        return {
+            **self._columns_dict(),
+            'poster_name': self.poster.get_full_name() if self.poster else None,
+            'average_rating': self.get_average_rating(),
+            'review_count': self.get_review_count()
+        }
+
+    def _columns_dict(self):
         return {
             'id': self.id,
             'title': self.title,
@@ -41,23 +87,85 @@ class Book(db.Model):
             'borrow_duration_weeks': self.borrow_duration_weeks,
             'rental_price': self.rental_price,
             'created_at': self.created_at.isoformat() if self.created_at else None,
-            'posted_by': self.posted_by,
-            'poster_name': self.poster.get_full_name() if self.poster else None
+            'posted_by': self.posted_by
         }
 
 
     def get_average_rating(self):
         """Tính trung bình số sao của sách"""
-        from models.review import BookReview
-        reviews = BookReview.query.filter_by(book_id=self.id).all()
-        if not reviews:
+        if not self.rating_count:
             return 0
-        return round(sum(review.rating for review in reviews) / len(reviews), 1)
+        return round(self.rating_sum / self.rating_count, 1)
 
     def get_review_count(self):
         """Đếm tổng số lượt đánh giá"""
+        return self.rating_count or 0
+
+    def get_rating_histogram(self):
+        """Số lượt đánh giá theo từng mức sao, {1: n, ..., 5: n}"""
+        return {star: getattr(self, f'rating_{star}') or 0 for star in range(1, 6)}
+
+    @staticmethod
+    def adjust_rating(book_id, old_rating=None, new_rating=None):
+        """Apply a review create/update/delete to the book's rating aggregates.
+
+        Pass ``old_rating=None`` for a new review and ``new_rating=None`` for
+        a deleted one. Runs as one atomic UPDATE in the caller's transaction,
+        so it commits or rolls back together with the review itself.
+        """
+        if old_rating == new_rating:
+            return
+
+        values = {
+            Book.rating_sum: Book.rating_sum + (new_rating or 0) - (old_rating or 0),
+            Book.rating_count: Book.rating_count + (1 if new_rating else 0) - (1 if old_rating else 0),
+            Book.updated_at: datetime.utcnow(),
+        }
+        if old_rating:
+            column = getattr(Book, f'rating_{old_rating}')
+            values[column] = column - 1
+        if new_rating:
+            column = getattr(Book, f'rating_{new_rating}')
+            values[column] = column + 1
+
+        Book.query.filter(Book.id == book_id).update(values, synchronize_session='evaluate')
+
+    @staticmethod
+    def recompute_ratings(book_ids=None):
+        """Rebuild rating aggregates from book_reviews in one bulk UPDATE.
+
+        Repairs drift (e.g. rows written before the aggregates existed);
+        limited to ``book_ids`` when given. Caller commits.
+        """
         from models.review import BookReview
-        return BookReview.query.filter_by(book_id=self.id).count()
+
+        def review_count(*conditions):
+            return db.select(func.count(BookReview.id)).where(
+                BookReview.book_id == Book.id, *conditions
+            ).scalar_subquery()
+
+        values = {
+            Book.rating_sum: func.coalesce(
+                db.select(func.sum(BookReview.rating)).where(
+                    BookReview.book_id == Book.id
+                ).scalar_subquery(), 0
+            ),
+            Book.rating_count: review_count(),
+            Book.updated_at: datetime.utcnow(),
+        }
+        for star in range(1, 6):
+            values[getattr(Book, f'rating_{star}')] = review_count(BookReview.rating == star)
+
+        query = Book.query
+        if book_ids is not None:
+            query = query.filter(Book.id.in_(book_ids))
+        return query.update(values, synchronize_session=False)
+
+
+@event.listens_for(Book, 'before_insert')
+@event.listens_for(Book, 'before_update')
+def _refresh_book_search_fields(mapper, connection, target):
+    target.refresh_search_fields()
 
 
 class BorrowedBook(db.Model):
@@ -74,6 +182,18 @@ class BorrowedBook(db.Model):
     is_returned = db.Column(db.Boolean, default=False)
     is_agreed = db.Column(db.Boolean, default=False)  # Người đăng đồng ý cho mượn hay chưa
 
+    book = db.relationship('Book', backref=db.backref('borrow_records', lazy=True))
+
+    # Partial: only open records are looked up by these predicates
+    __table_args__ = (
+        # Header count, "my borrowed books", pending-request badges
+        db.Index('ix_borrowed_books_user_active', 'user_id', 'is_agreed', 'book_id',
+                 postgresql_where=(is_returned == False), sqlite_where=(is_returned == False)),
+        # Book detail / borrow / return / approve, and the delete-book check
+        db.Index('ix_borrowed_books_book_user_active', 'book_id', 'user_id',
+                 postgresql_where=(is_returned == False), sqlite_where=(is_returned == False)),
+    )
+
     def __repr__(self):
         return f'<BorrowedBook {self.book_id} by {self.user_id}>'
 
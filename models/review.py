@@ -1,7 +1,7 @@
 
 from config import db
 from datetime import datetime, timezone
-from pytz import timezone as pytz_timezone
+from utils.timefmt import TimeFormatter, as_utc
 
 
 class BookReview(db.Model):
@@ -26,31 +26,9 @@ class BookReview(db.Model):
         return f'<BookReview {self.id} for book {self.book_id} by user {self.user_id}>'
     
 
-    def to_dict(self):
-        # Ensure created_at is timezone-aware
-        if self.created_at.tzinfo is None:
-            created_at_utc = self.created_at.replace(tzinfo=timezone.utc)
-        else:
-            created_at_utc = self.created_at.astimezone(timezone.utc)
-
-        now_utc = datetime.utcnow().replace(tzinfo=timezone.utc)
-        time_diff = now_utc - created_at_utc
-
-        # Format time ago
-        if time_diff.days > 0:
-            time_ago = f"{time_diff.days} day{'s' if time_diff.days > 1 else ''} ago"
-        elif time_diff.seconds > 3600:
-            hours = time_diff.seconds // 3600
-            time_ago = f"{hours} hour{'s' if hours > 1 else ''} ago"
-        elif time_diff.seconds > 60:
-            minutes = time_diff.seconds // 60
-            time_ago = f"{minutes} minute{'s' if minutes > 1 else ''} ago"
-        else:
-            time_ago = "Just now"
-
-        # Convert to Vietnam timezone
-        vn_tz = pytz_timezone('Asia/Ho_Chi_Minh')
-        local_time = created_at_utc.astimezone(vn_tz)
+    def to_dict(self, fmt=None):
+        fmt = fmt or TimeFormatter()
+        created_at_utc = as_utc(self.created_at).replace(tzinfo=timezone.utc)
 
         return {
             'id': self.id,
@@ -59,8 +37,7 @@ class BookReview(db.Model):
             'rating': self.rating,
             'review_text': self.review_text,
             'created_at': created_at_utc.isoformat(),
-            'formatted_time': local_time.strftime('%d/%m/%Y %H:%M'),
-            'time_ago': time_ago,
+            **fmt.fields(self.created_at, style='long'),
             'updated_at': self.updated_at.isoformat() if self.updated_at else None,
             'username': self.user.username if self.user else 'Unknown',
             'user_full_name': self.user.get_full_name() if self.user else 'Unknown User'
@@ -1,5 +1,7 @@
 from datetime import datetime
+from sqlalchemy import event, inspect
 from config import db
+from utils.timefmt import TimeFormatter, epoch_seconds
 
 
 class Discussion(db.Model):
@@ -16,23 +18,31 @@ class Discussion(db.Model):
     user = db.relationship('User', backref='discussions')
     book = db.relationship('Book', backref='discussions')
     
+    # Per-book threads and the global feed (book_id IS NULL), newest first
+    # Ids never reused (SQLite reuses the highest id once it is deleted),
+    # so they stay unique across this table and discussions_archive
+    __table_args__ = (
+        db.Index('ix_discussions_book_created', 'book_id', 'created_at'),
+        {'sqlite_autoincrement': True},
+    )
+    
     def __repr__(self):
         return f'<Discussion {self.id} by {self.username}>'
     
-    def to_dict(self):
-        from pytz import timezone
-        vn_tz = timezone('Asia/Ho_Chi_Minh')
-        local_time = self.created_at.replace(tzinfo=timezone('UTC')).astimezone(vn_tz)
-        
-        return {
+    def to_dict(self, fmt=None):
+        fmt = fmt or TimeFormatter()
+        data = {
             'id': self.id,
             'user_id': self.user_id,
             'username': self.username,
             'message': self.message,
             'timestamp': self.created_at.isoformat(),
-            'formatted_time': local_time.strftime('%d/%m/%Y %H:%M'),
+            'formatted_time': fmt.format(self.created_at),
             'book_id': self.book_id
         }
+        if fmt.epoch:
+            data['epoch'] = epoch_seconds(self.created_at)
+        return data
 
 
 class PrivateMessage(db.Model):
@@ -51,39 +61,30 @@ class PrivateMessage(db.Model):
     recipient = db.relationship('User', foreign_keys=[recipient_id], backref='received_messages')
     book = db.relationship('Book', backref='private_messages')
     
+    # Serves conversation reads, incl. incremental polls (id > :after_id)
+    # Ids never reused, as for discussions: archived messages keep theirs
+    __table_args__ = (
+        db.Index('ix_private_messages_pair_id', 'sender_id', 'recipient_id', 'id'),
+        {'sqlite_autoincrement': True},
+    )
+    
     def __repr__(self):
         return f'<PrivateMessage {self.id} from {self.sender_id} to {self.recipient_id}>'
     
-    def to_dict(self):
-        from pytz import timezone
-        import datetime
-        vn_tz = timezone('Asia/Ho_Chi_Minh')
-        local_time = self.timestamp.replace(tzinfo=timezone('UTC')).astimezone(vn_tz)
-        
-        # Calculate time ago
-        now = datetime.datetime.utcnow().replace(tzinfo=timezone('UTC'))
-        time_diff = now - self.timestamp.replace(tzinfo=timezone('UTC'))
-        
-        if time_diff.days > 0:
-            time_ago = f"{time_diff.days}d ago"
-        elif time_diff.seconds > 3600:
-            time_ago = f"{time_diff.seconds // 3600}h ago"
-        elif time_diff.seconds > 60:
-            time_ago = f"{time_diff.seconds // 60}m ago"
-        else:
-            time_ago = "just now"
-        
-        return {
+    def to_dict(self, fmt=None):
+        fmt = fmt or TimeFormatter()
+        data = {
             'id': self.id,
             'sender_id': self.sender_id,
             'recipient_id': self.recipient_id,
             'message': self.message,
             'timestamp': self.timestamp.isoformat(),
-            'formatted_time': local_time.strftime('%d/%m/%Y %H:%M'),
-            'time_ago': time_ago,
             'is_read': self.is_read,
             'book_id': self.book_id
         }
+        # formatted_time + time_ago, or epoch for client-side relative times
+        data.update(fmt.fields(self.timestamp))
+        return data
 
 
 class Notification(db.Model):
@@ -98,21 +99,29 @@ class Notification(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     book_id = db.Column(db.Integer, db.ForeignKey('books.id'), nullable=True)
     related_user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=True)
+    # Events merged into this row (see Notification.notify / Notification.compact)
+    count = db.Column(db.Integer, nullable=False, default=1, server_default='1')
     
     # Relationships
     user = db.relationship('User', foreign_keys=[user_id], backref='notifications')
     book = db.relationship('Book', backref='notifications')
     related_user = db.relationship('User', foreign_keys=[related_user_id])
     
+    __table_args__ = (
+        # Unread lookups and the unread-only list
+        db.Index('ix_notifications_user_read_created', 'user_id', 'is_read', 'created_at'),
+        # Full list, keyset-paginated on (created_at, id)
+        db.Index('ix_notifications_user_created', 'user_id', 'created_at', 'id'),
+        # Ids never reused, as for discussions: archived notifications keep theirs
+        {'sqlite_autoincrement': True},
+    )
+    
     def __repr__(self):
         return f'<Notification {self.id} for {self.user_id}>'
     
-    def to_dict(self):
-        from pytz import timezone
-        vn_tz = timezone('Asia/Ho_Chi_Minh')
-        local_time = self.created_at.replace(tzinfo=timezone('UTC')).astimezone(vn_tz)
-        
-        return {
+    def to_dict(self, fmt=None):
+        fmt = fmt or TimeFormatter()
+        data = {
             'id': self.id,
             'user_id': self.user_id,
             'type': self.type,
@@ -120,10 +129,387 @@ class Notification(db.Model):
             'message': self.message,
             'is_read': self.is_read,
             'created_at': self.created_at.isoformat(),
-            'formatted_time': local_time.strftime('%d/%m/%Y %H:%M'),
+            'formatted_time': fmt.format(self.created_at),
             'book_id': self.book_id,
-            'related_user_id': self.related_user_id
+            'related_user_id': self.related_user_id,
+            'count': self.count or 1
         }
+        if fmt.epoch:
+            data['epoch'] = epoch_seconds(self.created_at)
+        return data
+
+    # Columns that identify "the same thing happening again" per type; an
+    # unread notification with the same key absorbs the new event.
+    # borrow_request is left out: each one stands for a single live request
+    # with its own accept/decline, and a cancelled-then-resent request must
+    # not show up as "×2"
+    COALESCE_KEYS = {
+        'private_message': ('related_user_id',),
+        'borrow_approved': ('book_id',),
+        'borrow_declined': ('book_id',),
+    }
+
+    @classmethod
+    def coalesce_query(cls, user_id, type, book_id=None, related_user_id=None):
+        """Unread notifications a new ``type`` event would merge into, newest
+        first; None for types that are never coalesced"""
+        keys = cls.COALESCE_KEYS.get(type)
+        if keys is None:
+            return None
+        values = {'book_id': book_id, 'related_user_id': related_user_id}
+        return cls.query.filter_by(
+            user_id=user_id, type=type, is_read=False,
+            **{key: values[key] for key in keys}
+        ).order_by(cls.created_at.desc())
+
+    @classmethod
+    def notify(cls, user_id, type, title, message, book_id=None, related_user_id=None):
+        """Record an event for ``user_id``, merging bursts into one row.
+
+        For types in ``COALESCE_KEYS`` an unread notification with the same
+        (user, type, key columns) is bumped instead of inserting a row: its
+        count goes up, it moves to the top, and it shows the latest text.
+        Other types always insert. Returns the row; caller commits.
+        """
+        values = {'book_id': book_id, 'related_user_id': related_user_id}
+        query = cls.coalesce_query(user_id, type, **values)
+        if query is not None:
+            existing = query.first()
+            if existing is not None:
+                existing.count = (existing.count or 1) + 1
+                existing.created_at = datetime.utcnow()
+                existing.title = title
+                existing.message = message
+                return existing
+
+        notification = cls(user_id=user_id, type=type, title=title, message=message, count=1, **values)
+        db.session.add(notification)
+        return notification
+
+    @staticmethod
+    def compact(before, batch_size=1000):
+        """Digest pass: fold older notifications into one row per key.
+
+        Notifications created before ``before`` that share (user, type, key
+        columns, read state) are merged into the newest of them, which keeps
+        the summed count; the others are deleted. Unread rows are merged only
+        with unread rows and the unread counter drops by the rows removed.
+        Works through at most ``batch_size`` groups per type and call.
+        Returns ``(rows deleted, ids of users whose unread count changed)``;
+        caller commits and invalidates those users' header counts.
+        """
+        deleted = 0
+        unread_users = set()
+        for type, keys in Notification.COALESCE_KEYS.items():
+            key_columns = [getattr(Notification, key) for key in keys]
+            group_columns = [Notification.user_id, Notification.is_read, *key_columns]
+            groups = db.session.query(
+                *group_columns,
+                db.func.max(Notification.id),
+                db.func.sum(db.func.coalesce(Notification.count, 1))
+            ).filter(
+                Notification.type == type,
+                Notification.created_at < before
+            ).group_by(*group_columns).having(db.func.count(Notification.id) > 1).limit(batch_size).all()
+
+            for *group, keep_id, total in groups:
+                user_id, is_read, *key_values = group
+                conditions = [
+                    Notification.type == type,
+                    Notification.user_id == user_id,
+                    Notification.is_read == is_read,
+                    Notification.created_at < before,
+                    *[column.is_(None) if value is None else column == value
+                      for column, value in zip(key_columns, key_values)]
+                ]
+                db.session.query(Notification).filter(Notification.id == keep_id).update(
+                    {Notification.count: total}, synchronize_session=False
+                )
+                removed = db.session.query(Notification).filter(
+                    *conditions, Notification.id != keep_id
+                ).delete(synchronize_session=False)
+                deleted += removed
+                if not is_read and removed:
+                    from models.user import User
+                    User.adjust_unread_notifications(db.session.connection(), user_id, -removed)
+                    unread_users.add(user_id)
+        return deleted, unread_users
+
+    @staticmethod
+    def mark_read(user_id, type=None, book_id=None, related_user_id=None, before=None):
+        """Mark a user's unread notifications read in one UPDATE.
+
+        Optional filters narrow the set (``before`` compares ``created_at``).
+        The unread counter is decremented by the rows actually flipped, in
+        the caller's transaction; bulk updates skip the mapper events, so
+        the caller also invalidates header counts and notifies streams after
+        committing. Returns the number of notifications marked.
+        """
+        conditions = [Notification.user_id == user_id, Notification.is_read == False]
+        if type is not None:
+            conditions.append(Notification.type == type)
+        if book_id is not None:
+            conditions.append(Notification.book_id == book_id)
+        if related_user_id is not None:
+            conditions.append(Notification.related_user_id == related_user_id)
+        if before is not None:
+            conditions.append(Notification.created_at < before)
+
+        stmt = db.update(Notification).where(*conditions).values(is_read=True)
+        connection = db.session.connection()
+        if connection.dialect.update_returning:
+            # Count from RETURNING: exact even when a concurrent request
+            # flips some of the same rows first
+            marked = len(db.session.execute(
+                stmt.returning(Notification.id),
+                execution_options={'synchronize_session': False}
+            ).all())
+        else:
+            marked = db.session.execute(stmt, execution_options={'synchronize_session': False}).rowcount
+
+        from models.user import User
+        User.adjust_unread_notifications(connection, user_id, -marked)
+        return marked
+
+
+# Keep users.unread_notifications in step with notification writes, on the
+# flush's own connection so both commit (or roll back) together
+@event.listens_for(Notification, 'after_insert')
+def _count_new_notification(mapper, connection, target):
+    if not target.is_read:
+        from models.user import User
+        User.adjust_unread_notifications(connection, target.user_id, 1)
+
+
+@event.listens_for(Notification, 'after_update')
+def _count_read_transition(mapper, connection, target):
+    history = inspect(target).attrs.is_read.history
+    if not history.has_changes():
+        return
+    was_read = bool(history.deleted[0]) if history.deleted else False
+    if was_read != bool(target.is_read):
+        from models.user import User
+        User.adjust_unread_notifications(connection, target.user_id, -1 if target.is_read else 1)
+
+
+@event.listens_for(Notification, 'after_delete')
+def _count_deleted_notification(mapper, connection, target):
+    if not target.is_read:
+        from models.user import User
+        User.adjust_unread_notifications(connection, target.user_id, -1)
+
+
+class Conversation(db.Model):
+    """Inbox read model: one row per (user, peer) pair.
+
+    Maintained alongside ``private_messages`` (see ``record_message`` and
+    ``mark_read``) so an inbox page is one range scan on
+    ``(user_id, last_message_at, id)`` instead of a grouped scan of messages.
+    """
+    __tablename__ = 'conversations'
+
+    SNIPPET_LENGTH = 120
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    peer_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    last_message_id = db.Column(db.Integer, nullable=False)
+    last_sender_id = db.Column(db.Integer, nullable=False)
+    last_message_snippet = db.Column(db.String(SNIPPET_LENGTH), nullable=False, default='')
+    last_message_at = db.Column(db.DateTime, nullable=False)
+    unread_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
+    # Relationships
+    peer = db.relationship('User', foreign_keys=[peer_id])
+
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'peer_id', name='uq_conversations_user_peer'),
+        db.Index('ix_conversations_user_last', 'user_id', 'last_message_at', 'id'),
+    )
+
+    def __repr__(self):
+        return f'<Conversation {self.user_id} ↔ {self.peer_id}>'
+
+    def to_dict(self, fmt=None):
+        fmt = fmt or TimeFormatter()
+        data = {
+            'id': self.id,
+            'peer': {
+                'id': self.peer_id,
+                'username': self.peer.username if self.peer else None,
+                'full_name': self.peer.get_full_name() if self.peer else None
+            },
+            'last_message': {
+                'id': self.last_message_id,
+                'sender_id': self.last_sender_id,
+                'snippet': self.last_message_snippet,
+                'timestamp': self.last_message_at.isoformat(),
+                'formatted_time': fmt.format(self.last_message_at)
+            },
+            'unread_count': self.unread_count
+        }
+        if fmt.epoch:
+            data['last_message']['epoch'] = epoch_seconds(self.last_message_at)
+        return data
+
+    @staticmethod
+    def _upsert(connection, values, set_):
+        """INSERT, or UPDATE the existing (user_id, peer_id) row"""
+        table = Conversation.__table__
+        if connection.dialect.name in ('postgresql', 'sqlite'):
+            if connection.dialect.name == 'postgresql':
+                from sqlalchemy.dialects.postgresql import insert
+            else:
+                from sqlalchemy.dialects.sqlite import insert
+            stmt = insert(table).values(**values)
+            connection.execute(stmt.on_conflict_do_update(
+                index_elements=['user_id', 'peer_id'],
+                set_=set_(table, stmt.excluded)
+            ))
+            return
+
+        existing = connection.execute(
+            db.select(table.c.id).where(
+                table.c.user_id == values['user_id'],
+                table.c.peer_id == values['peer_id']
+            )
+        ).scalar()
+        if existing is None:
+            connection.execute(table.insert().values(**values))
+        else:
+            connection.execute(table.update().where(table.c.id == existing).values(**set_(table, table.c)))
+
+    @staticmethod
+    def record_message(connection, message):
+        """Fold a new private message into both participants' rows.
+
+        Runs on the flush's connection, so the conversation commits (or rolls
+        back) with the message. The last-message fields never move backwards
+        if two sends commit out of order.
+        """
+        snippet = (message.message or '')[:Conversation.SNIPPET_LENGTH]
+        sent_at = message.timestamp or datetime.utcnow()
+
+        for user_id, peer_id, unread in (
+            (message.sender_id, message.recipient_id, 0),
+            (message.recipient_id, message.sender_id, 0 if message.is_read else 1),
+        ):
+            values = {
+                'user_id': user_id,
+                'peer_id': peer_id,
+                'last_message_id': message.id,
+                'last_sender_id': message.sender_id,
+                'last_message_snippet': snippet,
+                'last_message_at': sent_at,
+                'unread_count': unread,
+            }
+
+            def set_(table, new, unread=unread):
+                newer = new.last_message_id > table.c.last_message_id
+                updates = {
+                    column: db.case((newer, getattr(new, column)), else_=table.c[column])
+                    for column in ('last_message_id', 'last_sender_id', 'last_message_snippet', 'last_message_at')
+                }
+                if unread:
+                    updates['unread_count'] = table.c.unread_count + unread
+                return updates
+
+            Conversation._upsert(connection, values, set_)
+            if user_id == peer_id:
+                break
+
+    @staticmethod
+    def mark_read(user_id, peer_id):
+        """Mark everything ``peer_id`` sent to ``user_id`` as read.
+
+        Two bulk UPDATEs (messages, then the conversation's unread count) in
+        the caller's transaction. Returns the number of messages marked.
+        """
+        marked = PrivateMessage.query.filter_by(
+            sender_id=peer_id,
+            recipient_id=user_id,
+            is_read=False
+        ).update({PrivateMessage.is_read: True}, synchronize_session=False)
+        if marked:
+            Conversation.query.filter_by(user_id=user_id, peer_id=peer_id).update(
+                {Conversation.unread_count: 0}, synchronize_session=False
+            )
+        return marked
+
+    @staticmethod
+    def rebuild(user_ids=None):
+        """Recreate conversation rows from ``private_messages`` and its archive.
+
+        Archived messages count too, so a conversation whose history was all
+        archived (``utils.retention``) keeps its inbox row; archived messages
+        are read. Limited to conversations owned by ``user_ids`` when given.
+        Returns the number of rows written. Caller commits.
+        """
+        from models.archive import ArchivedPrivateMessage
+        from models.user import User
+
+        selects = []
+        for model in (PrivateMessage, ArchivedPrivateMessage):
+            selects += [
+                db.select(
+                    model.sender_id.label('user_id'),
+                    model.recipient_id.label('peer_id'),
+                    model.id.label('message_id'),
+                    db.literal(0).label('unread')
+                ),
+                db.select(
+                    model.recipient_id,
+                    model.sender_id,
+                    model.id,
+                    db.case((model.is_read == False, 1), else_=0)
+                ).where(model.sender_id != model.recipient_id),
+            ]
+        pairs = db.union_all(*selects).subquery()
+        # Archived messages can outlive their users
+        existing_users = db.select(User.id)
+        query = db.select(
+            pairs.c.user_id, pairs.c.peer_id,
+            db.func.max(pairs.c.message_id), db.func.sum(pairs.c.unread)
+        ).where(
+            pairs.c.user_id.in_(existing_users), pairs.c.peer_id.in_(existing_users)
+        ).group_by(pairs.c.user_id, pairs.c.peer_id)
+        if user_ids is not None:
+            query = query.where(pairs.c.user_id.in_(user_ids))
+        rows = db.session.execute(query).all()
+
+        message_ids = {row[2] for row in rows}
+        last_messages = {
+            message.id: message
+            for model in (ArchivedPrivateMessage, PrivateMessage)
+            for message in model.query.filter(model.id.in_(message_ids))
+        }
+
+        stale = Conversation.query
+        if user_ids is not None:
+            stale = stale.filter(Conversation.user_id.in_(user_ids))
+        stale.delete(synchronize_session=False)
+
+        if rows:
+            db.session.execute(Conversation.__table__.insert(), [
+                {
+                    'user_id': user_id,
+                    'peer_id': peer_id,
+                    'last_message_id': message_id,
+                    'last_sender_id': last_messages[message_id].sender_id,
+                    'last_message_snippet': (last_messages[message_id].message or '')[:Conversation.SNIPPET_LENGTH],
+                    'last_message_at': last_messages[message_id].timestamp,
+                    'unread_count': unread or 0,
+                }
+                for user_id, peer_id, message_id, unread in rows
+            ])
+        return len(rows)
+
+
+@event.listens_for(PrivateMessage, 'after_insert')
+def _record_conversation_message(mapper, connection, target):
+    Conversation.record_message(connection, target)
+
+
 class Follow(db.Model):
     __tablename__ = 'follows'
 
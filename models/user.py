@@ -1,7 +1,9 @@
 from datetime import datetime
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask_login import UserMixin
+from sqlalchemy import event, func
 from config import db
+from utils.text import normalize_text
 
 
 class User(UserMixin, db.Model):
@@ -23,6 +25,13 @@ class User(UserMixin, db.Model):
     is_admin = db.Column(db.Boolean, default=False)
     last_activity = db.Column(db.DateTime, default=datetime.utcnow)
 
+    # Accent-stripped, casefolded username/name/email for fuzzy user search
+    search_norm = db.Column(db.String(400))
+
+    # Materialized count of unread notifications, kept in sync by the
+    # Notification mapper events (models/social.py)
+    unread_notifications = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
     # Relationships
     borrowed_books = db.relationship('BorrowedBook', backref='user', lazy=True)
 
@@ -36,19 +45,91 @@ class User(UserMixin, db.Model):
     # --- Convenience methods ---
     def get_full_name(self):
         """Return first + last name, or fallback to username."""
-        if self.first_name and self.last_name:
-            return f"{self.first_name} {self.last_name}"
-        return self.username
+        return self.format_full_name(self.first_name, self.last_name, self.username)
+
+    @staticmethod
+    def format_full_name(first_name, last_name, username):
+        """Display name from raw column values (for column-only queries)"""
+        if first_name and last_name:
+            return f"{first_name} {last_name}"
+        return username
 
     def is_online(self):
         """Check if user has been active within the last 5 minutes."""
-        if not self.last_activity:
+        from utils.presence import presence
+        if presence.is_online(self.id):
+            return True
+        if presence.authoritative:
+            return False
+        # Per-worker presence only knows this worker's users; fall back to
+        # the stored timestamp for the rest
+        last_activity = self.get_last_activity()
+        if not last_activity:
             return False
-        return (datetime.utcnow() - self.last_activity).total_seconds() < 300  # 5 minutes
+        return (datetime.utcnow() - last_activity).total_seconds() < 300  # 5 minutes
+
+    def get_last_activity(self):
+        """Stored last_activity, or newer activity this worker has not flushed yet."""
+        from utils.activity import activity_tracker
+        seen = activity_tracker.last_seen(self.id)
+        if seen and (not self.last_activity or seen > self.last_activity):
+            return seen
+        return self.last_activity
 
     def update_activity(self):
-        """Update user's last activity timestamp."""
-        self.last_activity = datetime.utcnow()
+        """Record activity now: a presence heartbeat plus a last_activity
+        write that is flushed to the database in coalesced batches."""
+        from utils.activity import activity_tracker
+        from utils.presence import presence
+        presence.heartbeat(self.id)
+        activity_tracker.touch(self.id, self.last_activity)
+
+    def refresh_search_fields(self):
+        """Recompute the normalized column used by fuzzy user search"""
+        self.search_norm = normalize_text(' '.join(
+            part for part in (self.username, self.first_name, self.last_name, self.email) if part
+        ))
+
+    @staticmethod
+    def adjust_unread_notifications(connection, user_id, delta):
+        """Add ``delta`` to a user's unread counter on ``connection``.
+
+        Runs inside the caller's transaction, so the counter commits or rolls
+        back together with the notification change that caused it.
+        """
+        if not user_id or not delta:
+            return
+        users = User.__table__
+        connection.execute(
+            users.update()
+            .where(users.c.id == user_id)
+            .values(unread_notifications=users.c.unread_notifications + delta)
+        )
+
+    @staticmethod
+    def recompute_unread_notifications(user_ids=None):
+        """Rebuild unread counters from notifications in one bulk UPDATE.
+
+        Only rows whose counter drifted are written; limited to ``user_ids``
+        when given. Returns the number of users repaired. Caller commits.
+        """
+        from models.social import Notification
+
+        actual = db.select(func.count(Notification.id)).where(
+            Notification.user_id == User.id,
+            Notification.is_read == False
+        ).scalar_subquery()
+
+        query = User.query.filter(User.unread_notifications != actual)
+        if user_ids is not None:
+            query = query.filter(User.id.in_(user_ids))
+        return query.update({User.unread_notifications: actual}, synchronize_session=False)
 
     def __repr__(self):
         return f'<User {self.username}>'
+
+
+@event.listens_for(User, 'before_insert')
+@event.listens_for(User, 'before_update')
+def _refresh_user_search_fields(mapper, connection, target):
+    target.refresh_search_fields()
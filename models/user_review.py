@@ -1,5 +1,6 @@
 from datetime import datetime
 from config import db
+from utils.timefmt import TimeFormatter, epoch_seconds
 
 
 class UserReview(db.Model):
@@ -23,10 +24,10 @@ class UserReview(db.Model):
     def __repr__(self):
         return f"<UserReview {self.id} - {self.reviewer_id} → {self.reviewed_user_id}>"
 
-    def to_dict(self):
+    def to_dict(self, fmt=None):
         """Trả về dữ liệu ở dạng dictionary, có thêm thông tin thời gian."""
-        time_ago = self._time_ago()
-        return {
+        fmt = fmt or TimeFormatter()
+        data = {
             "id": self.id,
             "reviewer_id": self.reviewer_id,
             "reviewed_user_id": self.reviewed_user_id,
@@ -34,20 +35,11 @@ class UserReview(db.Model):
             "comment": self.comment,
             "created_at": self.created_at.isoformat() if self.created_at else None,
             "updated_at": self.updated_at.isoformat() if self.updated_at else None,
-            "time_ago": time_ago,
         }
+        changed_at = self.updated_at or self.created_at
+        if fmt.epoch:
+            data["epoch"] = epoch_seconds(changed_at)
+        else:
+            data["time_ago"] = fmt.time_ago(changed_at, style="vi")
+        return data
 
-    def _time_ago(self):
-        """Tính khoảng thời gian 'x phút/giờ/ngày trước'."""
-        now = datetime.utcnow()
-        delta = now - (self.updated_at or self.created_at)
-
-        if delta.days > 0:
-            return f"{delta.days} ngày trước"
-        elif delta.seconds >= 3600:
-            hours = delta.seconds // 3600
-            return f"{hours} giờ trước"
-        elif delta.seconds >= 60:
-            minutes = delta.seconds // 60
-            return f"{minutes} phút trước"
-        return "Vừa xong"
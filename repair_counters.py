@@ -0,0 +1,39 @@
+from app import app
+from config import db
+from models import Book, Conversation, User
+from utils.search import backfill_search_fields
+
+# Sửa các bộ đếm materialized bị lệch: số thông báo chưa đọc của user,
+# tổng/số lượt đánh giá của sách, hộp thư (conversations) và các cột *_norm
+# dùng cho tìm kiếm. Chạy lại nhiều lần vẫn an toàn.
+with app.app_context():
+    print("🔄 Đang tính lại số thông báo chưa đọc...")
+    try:
+        repaired = User.recompute_unread_notifications()
+        db.session.commit()
+        print(f"✅ Đã sửa bộ đếm thông báo cho {repaired} người dùng")
+    except Exception as e:
+        db.session.rollback()
+        print("❌ Lỗi khi tính lại thông báo chưa đọc:", e)
+
+    print("🔄 Đang tính lại đánh giá sách...")
+    try:
+        updated = Book.recompute_ratings()
+        db.session.commit()
+        print(f"✅ Đã tính lại đánh giá cho {updated} cuốn sách")
+    except Exception as e:
+        db.session.rollback()
+        print("❌ Lỗi khi tính lại đánh giá sách:", e)
+
+    print("🔄 Đang dựng lại hộp thư (conversations)...")
+    try:
+        rebuilt = Conversation.rebuild()
+        db.session.commit()
+        print(f"✅ Đã dựng lại {rebuilt} cuộc trò chuyện")
+    except Exception as e:
+        db.session.rollback()
+        print("❌ Lỗi khi dựng lại hộp thư:", e)
+
+    print("🔄 Đang điền các cột tìm kiếm chuẩn hóa còn trống...")
+    filled = backfill_search_fields()
+    print(f"✅ Đã điền cột tìm kiếm cho {filled} dòng")
@@ -8,7 +8,7 @@ document.addEventListener('DOMContentLoaded', function() {
 function initializeApp() {
     console.log('ReadingTrail initialized');
     updateBorrowedCount();
-    updateNotificationCount();
+    // Notification badges are rendered server-side from the cached header counts
     loadCatalogRatings();
     if (typeof bootstrap !== 'undefined') {
         const tooltipTriggerList = [].slice.call(document.querySelectorAll('[data-bs-toggle="tooltip"]'));
@@ -222,40 +222,6 @@ function updateBorrowedCount(change = 0) {
     }
 }
 
-// Update notification count in both sidebar and navbar
-function updateNotificationCount() {
-    fetch('/api/notifications/count')
-        .then(response => response.json())
-        .then(data => {
-            const unreadCount = data.data?.unread_count ?? 0;
-            
-            // Update sidebar badge
-            const sidebarBadge = document.getElementById('sidebar-notification-badge');
-            if (sidebarBadge) {
-                if (count > 0) {
-                    sidebarBadge.textContent = count;
-                    sidebarBadge.style.display = 'inline';
-                } else {
-                    sidebarBadge.style.display = 'none';
-                }
-            }
-            
-            // Update navbar badge
-            const navbarBadge = document.getElementById('navbar-notification-badge');
-            if (navbarBadge) {
-                if (count > 0) {
-                    navbarBadge.textContent = count;
-                    navbarBadge.style.display = 'inline';
-                } else {
-                    navbarBadge.style.display = 'none';
-                }
-            }
-        })
-        .catch(error => {
-            console.error('Error updating notification count:', error);
-        });
-}
-
 // Add borrowed badge to book card
 function addBorrowedBadge(buttonElement) {
     const card = buttonElement.closest('.card');
@@ -438,7 +404,9 @@ function loadCatalogRatings() {
     
     ratingDisplays.forEach(display => {
         const bookId = display.getAttribute('data-book-id');
-        if (bookId) {
+        // Cards appended by infinite scroll call this again; skip ones already requested
+        if (bookId && !display.dataset.ratingRequested) {
+            display.dataset.ratingRequested = '1';
             loadBookRating(bookId);
         }
     });
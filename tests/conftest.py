@@ -0,0 +1,52 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# config.py reads DATABASE_URL at import time: point the app at a throwaway
+# SQLite database before anything imports it
+_DB_DIR = tempfile.mkdtemp(prefix='readingtrail-tests-')
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(_DB_DIR, 'test.db')
+# X-Query-Count on responses (tests/test_query_count.py)
+os.environ['QUERY_COUNTER'] = '1'
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(scope='session')
+def app():
+    from app import app
+    app.config['TESTING'] = True
+    return app
+
+
+@pytest.fixture
+def db(app):
+    """Database inside an app context; every table is emptied afterwards"""
+    from config import db
+    with app.app_context():
+        yield db
+        db.session.rollback()
+        for table in reversed(db.metadata.sorted_tables):
+            db.session.execute(table.delete())
+        db.session.commit()
+
+
+@pytest.fixture
+def client(app, db):
+    return app.test_client()
+
+
+@pytest.fixture
+def user(db):
+    from models import User
+    user = User(username='alice', email='alice@example.com')
+    user.set_password('secret')
+    db.session.add(user)
+    db.session.commit()
+    return user
+
+
+def login(client, username='alice', password='secret'):
+    response = client.post('/login', data={'username': username, 'password': password})
+    assert response.status_code in (200, 302)
@@ -0,0 +1,47 @@
+import time
+from datetime import datetime, timedelta
+
+from models import User
+from utils.activity import ActivityTracker
+
+
+def stored_activity(db, user_id):
+    db.session.expire_all()
+    return db.session.get(User, user_id).last_activity
+
+
+def test_repeated_touches_coalesce_into_one_write(db, user):
+    tracker = ActivityTracker(flush_interval=3600)
+    for _ in range(5):
+        tracker.touch(user.id)
+
+    assert tracker.flush() == 1
+    assert stored_activity(db, user.id) == tracker.last_seen(user.id)
+    assert tracker.flush() == 0
+
+
+def test_recently_stored_activity_is_not_rewritten(db, user):
+    recent = datetime.utcnow() - timedelta(seconds=10)
+    user.last_activity = recent
+    db.session.commit()
+
+    tracker = ActivityTracker(flush_interval=3600, min_write_gap=60)
+    tracker.touch(user.id, recent)
+
+    assert tracker.flush() == 0
+    assert stored_activity(db, user.id) == recent
+    # Still exact for this worker
+    assert tracker.last_seen(user.id) > recent
+
+
+def test_idle_worker_flushes_in_the_background(db, user):
+    user.last_activity = None
+    db.session.commit()
+
+    tracker = ActivityTracker(flush_interval=0.05)
+    tracker.touch(user.id)
+
+    deadline = time.monotonic() + 2
+    while stored_activity(db, user.id) is None and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert stored_activity(db, user.id) == tracker.last_seen(user.id)
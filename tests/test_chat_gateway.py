@@ -0,0 +1,176 @@
+import asyncio
+import json
+import struct
+
+from chat_gateway import (
+    CLOSE_PROTOCOL_ERROR, CLOSE_TOO_BIG, MAX_CLIENT_MESSAGE, OP_CLOSE, OP_CONTINUATION,
+    OP_PING, OP_PONG, OP_TEXT, ChatGateway,
+)
+from utils.chat_bus import make_gateway_token
+
+SECRET = 'test secret'
+APP_ORIGIN = 'https://readingtrail.example'
+# Sample handshake from RFC 6455 section 1.3
+SAMPLE_KEY = 'dGhlIHNhbXBsZSBub25jZQ=='
+SAMPLE_ACCEPT = 's3pPLMBiTxaQ9kYGzzhZRbK+xOo='
+
+
+def client_frame(opcode, payload=b'', fin=True, mask=b'\x01\x02\x03\x04', masked=True):
+    header = bytes([(0x80 if fin else 0) | opcode])
+    length = len(payload)
+    bit = 0x80 if masked else 0
+    if length < 126:
+        header += bytes([bit | length])
+    elif length < 1 << 16:
+        header += bytes([bit | 126]) + struct.pack('!H', length)
+    else:
+        header += bytes([bit | 127]) + struct.pack('!Q', length)
+    if not masked:
+        return header + payload
+    return header + mask + bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+
+
+async def read_server_frame(reader):
+    head = await reader.readexactly(2)
+    length = head[1] & 0x7F
+    if length == 126:
+        length = struct.unpack('!H', await reader.readexactly(2))[0]
+    elif length == 127:
+        length = struct.unpack('!Q', await reader.readexactly(8))[0]
+    return head[0] & 0x0F, await reader.readexactly(length)
+
+
+async def open_socket(port, origin=APP_ORIGIN, token_origin=APP_ORIGIN, user_id=1):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    token = make_gateway_token(SECRET, user_id, token_origin)
+    headers = [
+        f'GET /?token={token} HTTP/1.1',
+        'Host: 127.0.0.1',
+        'Upgrade: websocket',
+        'Connection: Upgrade',
+        f'Sec-WebSocket-Key: {SAMPLE_KEY}',
+        'Sec-WebSocket-Version: 13',
+    ]
+    if origin:
+        headers.append(f'Origin: {origin}')
+    writer.write(('\r\n'.join(headers) + '\r\n\r\n').encode())
+    response = (await reader.readuntil(b'\r\n\r\n')).decode('latin-1')
+    return reader, writer, response
+
+
+def run_gateway(scenario, allowed_origins=()):
+    async def main():
+        gateway = ChatGateway(SECRET, allowed_origins)
+        server = await asyncio.start_server(gateway.handle, '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        async with server:
+            return await asyncio.wait_for(scenario(gateway, port), 5)
+    return asyncio.run(main())
+
+
+def test_handshake_accepts_the_apps_own_origin():
+    async def scenario(gateway, port):
+        reader, writer, response = await open_socket(port)
+        assert response.startswith('HTTP/1.1 101')
+        assert f'Sec-WebSocket-Accept: {SAMPLE_ACCEPT}' in response
+
+        await asyncio.sleep(0.05)
+        gateway.deliver(1, {'type': 'private_message', 'message': {'id': 7}})
+        opcode, payload = await read_server_frame(reader)
+        assert opcode == OP_TEXT
+        assert json.loads(payload)['message']['id'] == 7
+        writer.close()
+    run_gateway(scenario)
+
+
+def test_handshake_rejects_other_or_missing_origins():
+    async def scenario(gateway, port):
+        for origin in ('https://evil.example', None):
+            _, writer, response = await open_socket(port, origin=origin)
+            assert response.startswith('HTTP/1.1 403')
+            writer.close()
+    run_gateway(scenario)
+
+
+def test_configured_origins_replace_the_token_origin():
+    async def scenario(gateway, port):
+        _, writer, response = await open_socket(port, origin='https://chat.example')
+        assert response.startswith('HTTP/1.1 101')
+        writer.close()
+        _, writer, response = await open_socket(port)
+        assert response.startswith('HTTP/1.1 403')
+        writer.close()
+    run_gateway(scenario, allowed_origins=['https://chat.example'])
+
+
+def test_ping_frames_and_text_pings_are_answered():
+    async def scenario(gateway, port):
+        reader, writer, _ = await open_socket(port)
+        writer.write(client_frame(OP_PING, b'hi'))
+        assert await read_server_frame(reader) == (OP_PONG, b'hi')
+        writer.write(client_frame(OP_TEXT, b'ping'))
+        opcode, payload = await read_server_frame(reader)
+        assert (opcode, json.loads(payload)) == (OP_TEXT, {'type': 'pong'})
+        writer.close()
+    run_gateway(scenario)
+
+
+def test_fragmented_message_is_joined_around_control_frames():
+    async def scenario(gateway, port):
+        reader, writer, _ = await open_socket(port)
+        writer.write(client_frame(OP_TEXT, b'pi', fin=False))
+        writer.write(client_frame(OP_PING, b'x'))
+        writer.write(client_frame(OP_CONTINUATION, b'ng'))
+        assert await read_server_frame(reader) == (OP_PONG, b'x')
+        opcode, payload = await read_server_frame(reader)
+        assert json.loads(payload) == {'type': 'pong'}
+        writer.close()
+    run_gateway(scenario)
+
+
+def test_close_frame_is_answered_and_the_socket_closed():
+    async def scenario(gateway, port):
+        reader, writer, _ = await open_socket(port)
+        writer.write(client_frame(OP_CLOSE, struct.pack('!H', 1000)))
+        opcode, payload = await read_server_frame(reader)
+        assert opcode == OP_CLOSE
+        assert await reader.read() == b''
+        assert gateway.connection_count == 0
+        writer.close()
+    run_gateway(scenario)
+
+
+def assert_closed_with(code, *frames):
+    async def scenario(gateway, port):
+        reader, writer, _ = await open_socket(port)
+        for frame in frames:
+            writer.write(frame)
+        opcode, payload = await read_server_frame(reader)
+        assert (opcode, struct.unpack('!H', payload)[0]) == (OP_CLOSE, code)
+        writer.close()
+    run_gateway(scenario)
+
+
+def test_unmasked_frame_is_a_protocol_error():
+    assert_closed_with(CLOSE_PROTOCOL_ERROR, client_frame(OP_TEXT, b'ping', masked=False))
+
+
+def test_stray_continuation_is_a_protocol_error():
+    assert_closed_with(CLOSE_PROTOCOL_ERROR, client_frame(OP_CONTINUATION, b'ng'))
+
+
+def test_fragmented_control_frame_is_a_protocol_error():
+    assert_closed_with(CLOSE_PROTOCOL_ERROR, client_frame(OP_PING, b'x', fin=False))
+
+
+def test_oversized_frame_is_refused():
+    assert_closed_with(CLOSE_TOO_BIG, client_frame(OP_TEXT, b'x' * (MAX_CLIENT_MESSAGE + 1)))
+
+
+def test_oversized_fragmented_message_is_refused():
+    half = b'x' * (MAX_CLIENT_MESSAGE // 2 + 1)
+    assert_closed_with(
+        CLOSE_TOO_BIG,
+        client_frame(OP_TEXT, half, fin=False),
+        client_frame(OP_CONTINUATION, half),
+    )
@@ -0,0 +1,29 @@
+from datetime import datetime, timedelta
+
+from models import Conversation, PrivateMessage, User
+from utils.retention import archive_cold_rows
+
+
+def test_rebuild_keeps_conversations_whose_messages_were_archived(db, user, monkeypatch):
+    peer = User(username='bob', email='bob@example.com')
+    peer.set_password('secret')
+    db.session.add(peer)
+    db.session.flush()
+    old = datetime.utcnow() - timedelta(days=400)
+    db.session.add_all([
+        PrivateMessage(sender_id=user.id, recipient_id=peer.id, message='hello', timestamp=old),
+        PrivateMessage(sender_id=peer.id, recipient_id=user.id, message='hi back', timestamp=old, is_read=False),
+    ])
+    db.session.commit()
+
+    monkeypatch.setenv('MESSAGE_RETENTION_DAYS', '365')
+    archive_cold_rows()
+    assert PrivateMessage.query.count() == 0
+    before = {(c.user_id, c.peer_id, c.last_message_id, c.unread_count) for c in Conversation.query}
+
+    Conversation.rebuild()
+    db.session.commit()
+
+    after = {(c.user_id, c.peer_id, c.last_message_id, c.unread_count) for c in Conversation.query}
+    assert after == before
+    assert {(row[0], row[1]) for row in after} == {(user.id, peer.id), (peer.id, user.id)}
@@ -0,0 +1,42 @@
+from models import Discussion
+from utils.discussion_feed import DiscussionFeed
+from utils.timefmt import TimeFormatter
+
+
+def post(db, user, text, id=None):
+    message = Discussion(id=id, user_id=user.id, username=user.username, message=text)
+    db.session.add(message)
+    db.session.commit()
+    return message.to_dict(TimeFormatter(epoch=True))
+
+
+def test_own_append_does_not_hide_messages_from_other_workers(db, user):
+    # Two workers; neither would refresh on the timer during the test
+    worker_a = DiscussionFeed(refresh_interval=3600)
+    worker_b = DiscussionFeed(refresh_interval=3600)
+    assert worker_a.since() == worker_b.since() == []
+
+    from_a = post(db, user, 'posted through worker A')
+    worker_a.append([from_a])
+    from_b = post(db, user, 'posted through worker B')
+    worker_b.append([from_b])
+
+    assert [m['id'] for m in worker_b.since(0)] == [from_a['id'], from_b['id']]
+    assert [m['id'] for m in worker_a.since(0)] == [from_a['id'], from_b['id']]
+
+
+def test_sync_picks_up_lower_id_committed_late(db, user):
+    feed = DiscussionFeed(refresh_interval=0)
+    post(db, user, 'first', id=1)
+    post(db, user, 'third', id=3)
+    assert [m['id'] for m in feed.since()] == [1, 3]
+
+    post(db, user, 'second, committed last', id=2)
+    assert [m['id'] for m in feed.since()] == [1, 2, 3]
+
+
+def test_buffer_keeps_newest_messages(db, user):
+    feed = DiscussionFeed(size=2, refresh_interval=0)
+    for n in range(3):
+        post(db, user, f'message {n}')
+    assert [m['message'] for m in feed.since()] == ['message 1', 'message 2']
@@ -0,0 +1,36 @@
+from models import Notification
+from utils.header_counts import _key, get_header_counts
+from utils.shared_store import store, warn_if_not_shared
+
+
+def notify(db, user):
+    db.session.add(Notification(user_id=user.id, type='system', title='Hello', message='hi'))
+
+
+def test_commit_invalidates_cached_counts(db, user):
+    assert get_header_counts(user.id)['notification_count'] == 0
+    assert store.get(_key(user.id)) is not None
+
+    notify(db, user)
+    db.session.commit()
+
+    assert store.get(_key(user.id)) is None
+    assert get_header_counts(user.id)['notification_count'] == 1
+
+
+def test_rollback_keeps_cached_counts(db, user):
+    cached = get_header_counts(user.id)
+
+    notify(db, user)
+    db.session.flush()
+    db.session.rollback()
+
+    assert store.get(_key(user.id)) == cached
+
+
+def test_several_workers_without_shared_store_warn(monkeypatch):
+    monkeypatch.setattr(store, 'shared', False)
+    assert warn_if_not_shared(4)
+    assert not warn_if_not_shared(1)
+    monkeypatch.setattr(store, 'shared', True)
+    assert not warn_if_not_shared(4)
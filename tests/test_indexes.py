@@ -0,0 +1,12 @@
+from migrate_indexes import explain, hot_queries
+
+
+def test_hot_queries_use_their_indexes(db):
+    """Every hot controller query is planned with the index declared for it"""
+    failures = []
+    for description, index_name, query in hot_queries():
+        plan = explain(query)
+        if index_name not in plan:
+            failures.append(f'{description}: expected {index_name}\n{plan}')
+
+    assert not failures, '\n\n'.join(failures)
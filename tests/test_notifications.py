@@ -0,0 +1,52 @@
+from conftest import login
+from models import Book, Notification, User
+
+
+def _peer(db):
+    peer = User(username='bob', email='bob@example.com')
+    peer.set_password('secret')
+    db.session.add(peer)
+    db.session.flush()
+    return peer
+
+
+def test_repeated_messages_coalesce(db, user):
+    peer = _peer(db)
+    for _ in range(3):
+        Notification.notify(user.id, 'private_message', 'New message', 'hi', related_user_id=peer.id)
+        db.session.commit()
+
+    notification = Notification.query.filter_by(user_id=user.id).one()
+    assert notification.count == 3
+
+
+def test_resent_borrow_request_is_not_merged(db, user):
+    peer = _peer(db)
+    book = Book(title='Book', author='Author', category='Novel', location='Hà Nội', posted_by=user.id)
+    db.session.add(book)
+    db.session.flush()
+    # Request, cancel, request again: the first notification is still unread
+    for _ in range(2):
+        Notification.notify(user.id, 'borrow_request', 'Borrow request', 'please',
+                            book_id=book.id, related_user_id=peer.id)
+        db.session.commit()
+
+    counts = [n.count for n in Notification.query.filter_by(user_id=user.id, type='borrow_request')]
+    assert counts == [1, 1]
+
+
+def test_cancelled_borrow_request_settles_its_notification(client, db, user):
+    peer = _peer(db)
+    book = Book(title='Book', author='Author', category='Novel', location='Hà Nội', posted_by=user.id)
+    db.session.add(book)
+    db.session.commit()
+    book_id, user_id = book.id, user.id
+
+    login(client, 'bob')
+    client.post(f'/borrow/{book_id}')
+    assert client.post(f'/api/books/{book_id}/cancel_borrow').get_json()['success']
+    client.post(f'/borrow/{book_id}')
+
+    rows = Notification.query.filter_by(user_id=user_id, type='borrow_request').order_by(Notification.id).all()
+    assert [(n.is_read, n.count) for n in rows] == [(True, 1), (False, 1)]
+    assert db.session.get(User, user_id).unread_notifications == 1
@@ -0,0 +1,41 @@
+import base64
+import json
+from datetime import datetime
+
+import pytest
+
+from utils.pagination import decode_cursor, encode_cursor
+
+
+def _cursor(payload):
+    raw = json.dumps(payload).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def test_cursor_round_trip():
+    values = [datetime(2025, 1, 1, 12, 30), 45]
+    assert decode_cursor(encode_cursor(values)) == values
+
+
+@pytest.mark.parametrize('cursor', [
+    'not base64 at all!',
+    _cursor({'dt': '2025-01-01T00:00:00'}),
+    _cursor([{'x': 1}]),
+    _cursor([{'dt': 5}]),
+    _cursor([{'dt': 'yesterday'}]),
+    _cursor([[1, 2], 3]),
+])
+def test_decode_cursor_rejects_malformed_payloads(cursor):
+    with pytest.raises(ValueError, match='Invalid cursor'):
+        decode_cursor(cursor)
+
+
+@pytest.mark.parametrize('cursor', [
+    'W3sieCI6MX1d',
+    _cursor([{'dt': 'yesterday'}, 1]),
+    _cursor(['2025-01-01', 1]),
+    _cursor([1]),
+])
+def test_bad_cursor_is_a_client_error(client, cursor):
+    response = client.get('/api/v1/books', query_string={'cursor': cursor})
+    assert response.status_code == 400
@@ -0,0 +1,73 @@
+from datetime import datetime, timedelta
+
+import pytest
+from flask import Flask
+from sqlalchemy import create_engine
+
+from conftest import login
+from utils.query_counter import init_query_counter
+
+# List pages whose query count must not depend on the number of rows
+LIST_URLS = [
+    '/',
+    '/api/v1/books',
+    '/api/v1/books?limit=100',
+    '/api/v1/books/{book_id}/reviews?per_page=100',
+    '/api/books/{book_id}/reviews',
+    '/api/v1/borrowed-books',
+    '/api/v1/discussions',
+    '/api/v1/notifications',
+    '/api/v1/users',
+]
+
+
+def _add_rows(db, owner, count):
+    """``count`` more books (each with a borrow, a discussion and a
+    notification for ``owner``) and reviewers for the first book"""
+    from models import Book, BookReview, BorrowedBook, Discussion, Notification, User
+
+    start = Book.query.count()
+    for i in range(start, start + count):
+        reviewer = User(username=f'reader{i}', email=f'reader{i}@example.com')
+        reviewer.set_password('secret')
+        book = Book(title=f'Book {i}', author=f'Author {i}', category='Novel',
+                    location='Hà Nội', posted_by=owner.id)
+        db.session.add_all([reviewer, book])
+        db.session.flush()
+        first_book_id = Book.query.order_by(Book.id).first().id
+        db.session.add_all([
+            BookReview(book_id=first_book_id, user_id=reviewer.id, rating=i % 5 + 1, review_text='ok'),
+            BorrowedBook(book_id=book.id, user_id=owner.id, due_date=datetime.utcnow() + timedelta(days=14),
+                         is_agreed=True),
+            Discussion(user_id=reviewer.id, username=reviewer.username, message='hi', book_id=book.id),
+            Notification(user_id=owner.id, type='info', title='T', message='M', book_id=book.id),
+        ])
+    db.session.commit()
+    return Book.query.order_by(Book.id).first().id
+
+
+def _query_count(client, url):
+    # The second request runs with warm per-process caches (facets, header counts)
+    client.get(url)
+    response = client.get(url)
+    assert response.status_code == 200, url
+    return int(response.headers['X-Query-Count'])
+
+
+@pytest.mark.parametrize('url', LIST_URLS)
+def test_list_endpoints_run_a_constant_number_of_queries(client, db, user, url):
+    login(client)
+
+    book_id = _add_rows(db, user, 5)
+    small = _query_count(client, url.format(book_id=book_id))
+    _add_rows(db, user, 5)
+    large = _query_count(client, url.format(book_id=book_id))
+
+    assert small == large, f'{url}: {small} queries for 5 rows, {large} for 10'
+
+
+def test_query_counter_is_off_unless_enabled():
+    app = Flask(__name__)
+    app.add_url_rule('/', 'index', lambda: 'ok')
+    assert init_query_counter(app, create_engine('sqlite://')) is False
+    assert 'X-Query-Count' not in app.test_client().get('/').headers
@@ -0,0 +1,42 @@
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import Column, Integer, MetaData, Table
+
+from models import ArchivedPrivateMessage, Conversation, PrivateMessage, User
+from utils.retention import _check_ids_not_reused, archive_cold_rows
+
+
+def test_new_messages_never_reuse_archived_ids(db, user):
+    peer = User(username='bob', email='bob@example.com')
+    peer.set_password('secret')
+    db.session.add(peer)
+    db.session.flush()
+    old = datetime.utcnow() - timedelta(days=400)
+    db.session.add_all([
+        PrivateMessage(sender_id=user.id, recipient_id=peer.id, message=f'old {i}', timestamp=old)
+        for i in range(3)
+    ])
+    db.session.commit()
+
+    archive_cold_rows()
+    archived_max = db.session.query(db.func.max(ArchivedPrivateMessage.id)).scalar()
+
+    message = PrivateMessage(sender_id=peer.id, recipient_id=user.id, message='new')
+    db.session.add(message)
+    db.session.commit()
+
+    assert message.id > archived_max
+    inbox = Conversation.query.filter_by(user_id=user.id, peer_id=peer.id).one()
+    assert inbox.last_message_id == message.id
+    assert inbox.unread_count == 1
+
+
+def test_archiving_refuses_sqlite_tables_that_reuse_ids(db):
+    legacy = Table('legacy_rows', MetaData(), Column('id', Integer, primary_key=True))
+    legacy.create(db.engine)
+    try:
+        with pytest.raises(RuntimeError, match='AUTOINCREMENT'):
+            _check_ids_not_reused(legacy)
+    finally:
+        legacy.drop(db.engine)
@@ -0,0 +1,34 @@
+from models import Book
+from utils.search import apply_search, fuzzy_filter
+
+
+def add_books(db, user, *titles):
+    db.session.add_all([
+        Book(title=title, author='Tác giả', category='Văn học', location='Hà Nội', posted_by=user.id)
+        for title in titles
+    ])
+    db.session.commit()
+
+
+def test_fuzzy_filter_treats_like_wildcards_literally(db, user):
+    add_books(db, user, '100% Sách hay', '1000 câu đố', 'Sách_mới')
+
+    def titles(search):
+        return sorted(b.title for b in Book.query.filter(fuzzy_filter(Book.title_norm, search)))
+
+    assert titles('100%') == ['100% Sách hay']
+    assert titles('%') == ['100% Sách hay']
+    assert titles('_') == ['Sách_mới']
+    assert titles('sach') == ['100% Sách hay', 'Sách_mới']
+
+
+def test_fallback_search_escapes_description_pattern(db, user, monkeypatch):
+    monkeypatch.setattr('utils.search._search_backend', None)
+    add_books(db, user, 'Một', 'Hai')
+    Book.query.filter_by(title='Một').one().description = 'mã 5_%'
+    Book.query.filter_by(title='Hai').one().description = 'giảm 50 lần'
+    db.session.commit()
+
+    query, rank = apply_search(Book.query, '5_%')
+    assert rank is None
+    assert [b.title for b in query] == ['Một']
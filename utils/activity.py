@@ -0,0 +1,121 @@
+"""
+Write-coalescing tracker for ``users.last_activity``.
+
+Page renders record "seen at" in memory only. Every ``flush_interval``
+seconds a background thread writes the pending values in one bulk UPDATE
+(and once more at exit), so a worker that goes idle still writes what it
+saw. Users whose stored value is already recent are skipped entirely, so
+an active user costs at most one write per ``min_write_gap`` instead of one
+per page.
+"""
+import atexit
+import logging
+import threading
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import and_, case, or_
+
+from config import db
+
+ACTIVITY_FLUSH_INTERVAL = 30
+# Stored values younger than this are not rewritten
+ACTIVITY_MIN_WRITE_GAP = 60
+
+
+class ActivityTracker:
+    """Per-worker in-memory "seen at" map with periodic bulk flushes.
+
+    The stored ``last_activity`` lags real activity by at most
+    ``min_write_gap + flush_interval`` seconds; this worker's own users are
+    exact through ``last_seen()``.
+    """
+
+    def __init__(self, flush_interval=ACTIVITY_FLUSH_INTERVAL, min_write_gap=ACTIVITY_MIN_WRITE_GAP):
+        self.flush_interval = flush_interval
+        self.min_write_gap = timedelta(seconds=min_write_gap)
+        self._lock = threading.Lock()
+        self._seen = {}
+        self._pending = {}
+        # Remembered so flushes work outside an app context
+        self._engine = None
+        self._flusher = None
+
+    def touch(self, user_id, stored_last_activity=None):
+        """Record that ``user_id`` is active now; the flusher thread writes it"""
+        now = datetime.utcnow()
+        self._engine = db.engine
+        with self._lock:
+            self._seen[user_id] = now
+            if stored_last_activity is None or now - stored_last_activity >= self.min_write_gap:
+                self._pending[user_id] = now
+        self._ensure_flusher()
+
+    def last_seen(self, user_id):
+        """Latest activity this worker saw for ``user_id``, or None"""
+        return self._seen.get(user_id)
+
+    def flush(self):
+        """Write pending activity in one UPDATE; never moves a value backwards"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            # Forget users not seen for a while so the map stays small
+            cutoff = datetime.utcnow() - timedelta(hours=1)
+            self._seen = {uid: seen for uid, seen in self._seen.items() if seen >= cutoff}
+
+        if not pending or self._engine is None:
+            return 0
+
+        users = db.metadata.tables['users']
+        seen_at = case(pending, value=users.c.id)
+        try:
+            # Own connection, so the request session is not committed or expired
+            with self._engine.begin() as conn:
+                result = conn.execute(
+                    users.update()
+                    .where(and_(
+                        users.c.id.in_(list(pending)),
+                        or_(users.c.last_activity.is_(None), users.c.last_activity < seen_at)
+                    ))
+                    .values(last_activity=seen_at)
+                )
+            return result.rowcount
+        except Exception as e:
+            logging.error(f"Error flushing user activity: {e}")
+            # Keep the values for the next flush unless newer ones arrived
+            with self._lock:
+                for user_id, seen in pending.items():
+                    self._pending.setdefault(user_id, seen)
+            return 0
+
+
+    def _ensure_flusher(self):
+        # Started lazily, so it runs in the worker (threads do not survive fork)
+        if self._flusher is not None and self._flusher.is_alive():
+            return
+        with self._lock:
+            if self._flusher is not None and self._flusher.is_alive():
+                return
+            self._flusher = threading.Thread(target=self._flush_periodically, name='activity-flush', daemon=True)
+            self._flusher.start()
+
+    def _flush_periodically(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                logging.error(f"Activity flusher error: {e}")
+
+
+activity_tracker = ActivityTracker()
+
+
+def _flush_at_exit():
+    try:
+        activity_tracker.flush()
+    except Exception:
+        pass
+
+
+atexit.register(_flush_at_exit)
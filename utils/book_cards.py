@@ -0,0 +1,84 @@
+"""
+Batched read path for book cards.
+
+List views show, for every book on the page, the poster's name, the rating
+average and review count, and whether the viewer already has a pending
+borrow request. Loading those per book costs several queries per card;
+``load_book_cards()`` fetches each attribute for the whole page in one query.
+"""
+import logging
+
+from sqlalchemy import func
+
+from config import db
+from models import Book, BorrowedBook, User
+
+
+def _empty_card():
+    return {
+        'poster_name': None,
+        'average_rating': 0,
+        'review_count': 0,
+        'pending_request': False,
+    }
+
+
+def load_book_cards(book_ids, viewer_id=None):
+    """Card data for a page of books, keyed by book id.
+
+    Returns ``{book_id: {'poster_name', 'average_rating', 'review_count',
+    'pending_request'}}`` with one entry for every id in ``book_ids``.
+    Runs one query for poster names, one for ratings and, when
+    ``viewer_id`` is given, one for the viewer's pending borrow requests.
+    """
+    book_ids = list(dict.fromkeys(book_ids))
+    cards = {book_id: _empty_card() for book_id in book_ids}
+    if not book_ids:
+        return cards
+
+    try:
+        posters = db.session.query(
+            Book.id, User.first_name, User.last_name, User.username
+        ).join(User, User.id == Book.posted_by).filter(Book.id.in_(book_ids))
+        for book_id, first_name, last_name, username in posters:
+            cards[book_id]['poster_name'] = User.format_full_name(first_name, last_name, username)
+
+        # Aggregates are materialized on books (see Book.adjust_rating)
+        ratings = db.session.query(
+            Book.id, Book.rating_sum, Book.rating_count
+        ).filter(Book.id.in_(book_ids), Book.rating_count > 0)
+        for book_id, rating_sum, rating_count in ratings:
+            cards[book_id]['average_rating'] = round(rating_sum / rating_count, 1)
+            cards[book_id]['review_count'] = rating_count
+
+        if viewer_id:
+            pending = db.session.query(BorrowedBook.book_id).filter(
+                BorrowedBook.user_id == viewer_id,
+                BorrowedBook.is_returned == False,
+                BorrowedBook.is_agreed == False,
+                BorrowedBook.book_id.in_(book_ids)
+            ).distinct()
+            for (book_id,) in pending:
+                cards[book_id]['pending_request'] = True
+    except Exception as e:
+        db.session.rollback()
+        logging.error(f"Error loading book cards: {e}")
+
+    return cards
+
+
+def pending_requests_stamp(viewer_id):
+    """Version stamp of the viewer's pending requests, for cache validators.
+
+    Changes whenever a request is created, cancelled or approved, i.e.
+    whenever some card's ``pending_request`` could have flipped.
+    """
+    if not viewer_id:
+        return None
+    return db.session.query(
+        func.count(BorrowedBook.id), func.max(BorrowedBook.id)
+    ).filter(
+        BorrowedBook.user_id == viewer_id,
+        BorrowedBook.is_returned == False,
+        BorrowedBook.is_agreed == False
+    ).one()
@@ -0,0 +1,160 @@
+"""
+Publish side of the real-time chat channel, plus gateway tokens.
+
+Committed ``PrivateMessage`` inserts are published (session events below)
+as ``{'type': 'private_message', 'message': ...}`` for both the sender and
+the recipient; ``chat_gateway.py`` subscribes and pushes them to open
+WebSocket connections.
+
+With ``REDIS_URL`` set (and the ``redis`` package installed) events go over
+a Redis pub/sub channel, so any number of web workers and gateway processes
+can run on any hosts. Without it ``LocalChatBus`` stands in: fire-and-forget
+UDP datagrams to one gateway process on ``CHAT_BUS_ADDR`` (default
+``127.0.0.1:8766``). Publishing never blocks a request and a missing
+gateway is not an error; chat pages fall back to polling.
+"""
+import json
+import logging
+import os
+import socket
+
+from itsdangerous import BadSignature, SignatureExpired, URLSafeTimedSerializer
+from sqlalchemy import event
+
+from config import db
+from models import PrivateMessage
+
+CHANNEL = 'readingtrail:chat'
+DEFAULT_BUS_ADDR = '127.0.0.1:8766'
+# Payloads larger than one loopback datagram are sent without the body
+MAX_DATAGRAM = 60000
+# A token only has to survive until the socket is opened
+TOKEN_MAX_AGE = 60
+TOKEN_SALT = 'chat-gateway'
+
+_SESSION_KEY = 'chat_bus_messages'
+
+
+def bus_address():
+    host, _, port = (os.environ.get('CHAT_BUS_ADDR') or DEFAULT_BUS_ADDR).rpartition(':')
+    return host or '127.0.0.1', int(port)
+
+
+def encode_event(user_id, data):
+    """Wire format shared by both buses: ``[user_id, data]`` as JSON"""
+    return json.dumps([user_id, data], ensure_ascii=False).encode('utf-8')
+
+
+def decode_event(raw):
+    """``(user_id, data)`` or None for anything malformed"""
+    try:
+        user_id, data = json.loads(raw)
+        return int(user_id), data
+    except (TypeError, ValueError):
+        return None
+
+
+class LocalChatBus:
+    """Loopback UDP datagrams to a single gateway process"""
+
+    shared = False
+
+    def __init__(self, address):
+        self.address = address
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._socket.setblocking(False)
+
+    def publish(self, user_id, data):
+        raw = encode_event(user_id, data)
+        if len(raw) > MAX_DATAGRAM:
+            # Too big for one datagram: announce it, the client fetches it
+            message = data.get('message') or {}
+            raw = encode_event(user_id, {
+                'type': data.get('type'),
+                'message': {key: message.get(key) for key in ('id', 'sender_id', 'recipient_id')},
+                'truncated': True,
+            })
+        try:
+            self._socket.sendto(raw, self.address)
+        except OSError:
+            # No gateway listening (or its buffer is full); clients poll
+            pass
+
+
+class RedisChatBus:
+    """Redis pub/sub channel read by every gateway process"""
+
+    shared = True
+
+    def __init__(self, url):
+        import redis
+        self._redis = redis.Redis.from_url(url, socket_timeout=0.5)
+
+    def publish(self, user_id, data):
+        try:
+            self._redis.publish(CHANNEL, encode_event(user_id, data))
+        except Exception as e:
+            logging.warning(f"Chat bus publish failed: {e}")
+
+
+def _create_bus():
+    url = os.environ.get('REDIS_URL')
+    if url:
+        try:
+            return RedisChatBus(url)
+        except ImportError:
+            logging.warning("REDIS_URL is set but the redis package is not installed; using the local chat bus")
+    return LocalChatBus(bus_address())
+
+
+chat_bus = _create_bus()
+
+
+def gateway_url():
+    """Public ``ws(s)://`` URL of the gateway, or None when not deployed"""
+    return os.environ.get('CHAT_GATEWAY_URL') or None
+
+
+def _serializer(secret_key):
+    return URLSafeTimedSerializer(secret_key, salt=TOKEN_SALT)
+
+
+def make_gateway_token(secret_key, user_id, origin):
+    """Short-lived signed token identifying ``user_id`` to the gateway.
+
+    ``origin`` is the app's own origin (``scheme://host[:port]``) as the page
+    requesting the token sees it; unless ``CHAT_GATEWAY_ORIGINS`` is set the
+    gateway only accepts the socket from that origin.
+    """
+    return _serializer(secret_key).dumps({'uid': user_id, 'origin': origin})
+
+
+def load_gateway_token(secret_key, token, max_age=TOKEN_MAX_AGE):
+    """``(user_id, origin)`` from a valid, unexpired token, else None"""
+    try:
+        data = _serializer(secret_key).loads(token, max_age=max_age)
+        return int(data['uid']), data.get('origin')
+    except (BadSignature, SignatureExpired, KeyError, TypeError, ValueError):
+        return None
+
+
+@event.listens_for(db.session, 'after_flush')
+def _collect_messages(session, flush_context):
+    messages = session.info.setdefault(_SESSION_KEY, [])
+    for obj in session.new:
+        if isinstance(obj, PrivateMessage):
+            messages.append(obj.to_dict())
+
+
+@event.listens_for(db.session, 'after_commit')
+def _publish_after_commit(session):
+    for message in session.info.pop(_SESSION_KEY, ()):
+        data = {'type': 'private_message', 'message': message}
+        # The sender's other tabs get it too; clients skip ids they have
+        for user_id in {message['sender_id'], message['recipient_id']}:
+            chat_bus.publish(user_id, data)
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _drop_after_rollback(session):
+    session.info.pop(_SESSION_KEY, None)
@@ -0,0 +1,156 @@
+"""
+In-process ring buffer of the latest general discussion messages.
+
+Holds the newest ``FEED_SIZE`` messages already serialized with
+``to_dict()`` (including ``epoch``, so both time formats are served), and
+feed polls (``/api/discussion/messages?after_id=``) are answered from
+memory. Committed inserts of general (``book_id IS NULL``) discussions are
+appended by the session events below.
+
+Messages posted through other workers are merged in by a sync against the
+database: one id-only query over the newest ``FEED_SIZE`` ids, plus a row
+query for ids the buffer lacks. Ids are handed out in insert order, not
+commit order, so the sync re-reads that whole window instead of asking
+for ids above the newest one it holds; a message committed late with a
+lower id is still picked up. A sync runs after this worker appends its own
+messages (before they are served), and otherwise when the shared store
+announces a new commit (a fresh token per commit rather than the highest
+id, which a late commit with a lower id would not raise). Without a shared store (no ``REDIS_URL``) each worker
+syncs at most every ``LOCAL_REFRESH_SECONDS`` instead: steady-state polls
+then cost one small query per worker per interval rather than none.
+"""
+import logging
+import threading
+import time
+import uuid
+from collections import deque
+
+from sqlalchemy import event
+
+from config import db
+from models import Discussion
+from utils.shared_store import store
+from utils.timefmt import TimeFormatter
+
+FEED_SIZE = 50
+LOCAL_REFRESH_SECONDS = 5
+
+_VERSION_KEY = 'discussion_feed:version'
+_SESSION_KEY = 'discussion_feed_new'
+
+
+class DiscussionFeed:
+    """Newest-last deque of serialized messages with ``after_id`` deltas"""
+
+    def __init__(self, size=FEED_SIZE, refresh_interval=LOCAL_REFRESH_SECONDS):
+        self.size = size
+        self.refresh_interval = refresh_interval
+        self._lock = threading.Lock()
+        self._messages = deque(maxlen=size)
+        self._loaded = False
+        # Newest id seen in the database; only _load() advances it, so local
+        # appends never hide messages other workers committed
+        self._synced_through = 0
+        self._dirty = False
+        self._seen_version = None
+        self._synced_at = 0
+
+    @property
+    def newest_id(self):
+        return self._messages[-1]['id'] if self._messages else 0
+
+    def since(self, after_id=None):
+        """Messages newer than ``after_id`` (all buffered ones if None), oldest first.
+
+        A client that fell further behind than the buffer gets the whole
+        buffer; it skips ids it already shows.
+        """
+        self._sync()
+        with self._lock:
+            messages = list(self._messages)
+        if after_id is None:
+            return messages
+        return [message for message in messages if message['id'] > after_id]
+
+    def append(self, messages):
+        """Add serialized messages (e.g. just committed); keeps id order"""
+        with self._lock:
+            if not self._loaded:
+                # The first read loads the buffer from the database anyway
+                return
+            self._merge(messages)
+            # Another worker may have committed a lower id just before these;
+            # look at the database before serving them
+            self._dirty = True
+
+    def invalidate(self):
+        with self._lock:
+            self._messages.clear()
+            self._loaded = False
+            self._synced_through = 0
+
+    def _sync(self):
+        version = store.get(_VERSION_KEY) if store.shared else None
+        if not self._loaded or self._dirty:
+            stale = True
+        elif store.shared:
+            stale = version != self._seen_version
+        else:
+            stale = time.monotonic() - self._synced_at >= self.refresh_interval
+        if stale:
+            self._load(version)
+
+    def _load(self, version=None):
+        with self._lock:
+            known = {message['id'] for message in self._messages} if self._loaded else set()
+        try:
+            general = Discussion.query.filter(Discussion.book_id.is_(None))
+            ids = [row.id for row in general.with_entities(Discussion.id)
+                   .order_by(Discussion.id.desc()).limit(self.size)]
+            missing = [message_id for message_id in ids if message_id not in known]
+            fmt = TimeFormatter(epoch=True)
+            messages = [row.to_dict(fmt) for row in Discussion.query.filter(Discussion.id.in_(missing))] if missing else []
+        except Exception as e:
+            logging.error(f"Error loading discussion feed: {e}")
+            return
+
+        with self._lock:
+            if not self._loaded:
+                self._messages.clear()
+            self._merge(messages)
+            self._synced_through = max([self._synced_through, *ids])
+            self._loaded = True
+            self._dirty = False
+            self._seen_version = version
+            self._synced_at = time.monotonic()
+
+    def _merge(self, messages):
+        # Caller holds the lock
+        known = {message['id'] for message in self._messages}
+        merged = list(self._messages) + [message for message in messages if message['id'] not in known]
+        merged.sort(key=lambda message: message['id'])
+        self._messages = deque(merged[-self.size:], maxlen=self.size)
+
+
+discussion_feed = DiscussionFeed()
+
+
+@event.listens_for(db.session, 'after_flush')
+def _collect_new_messages(session, flush_context):
+    for obj in session.new:
+        if isinstance(obj, Discussion) and obj.book_id is None:
+            session.info.setdefault(_SESSION_KEY, []).append(obj.to_dict(TimeFormatter(epoch=True)))
+
+
+@event.listens_for(db.session, 'after_commit')
+def _append_after_commit(session):
+    messages = session.info.pop(_SESSION_KEY, None)
+    if messages:
+        discussion_feed.append(messages)
+        if store.shared:
+            store.set(_VERSION_KEY, uuid.uuid4().hex)
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _drop_after_rollback(session):
+    session.info.pop(_SESSION_KEY, None)
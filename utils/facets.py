@@ -0,0 +1,74 @@
+"""
+Cached catalog facets: distinct categories and locations with book counts.
+"""
+import logging
+import threading
+import time
+
+from sqlalchemy import case, func
+
+from config import db
+from models import Book
+
+# Upper bound on how stale another worker's cached facets can be, since
+# invalidate() only clears the cache of the process that did the write.
+FACET_CACHE_TTL = 60
+
+
+class FacetCache:
+    """Per-process cache of catalog facets, rebuilt with two GROUP BY queries.
+
+    Writes that add/remove books or flip availability call ``invalidate()``;
+    the TTL covers writes made by other workers.
+    """
+
+    def __init__(self, ttl=FACET_CACHE_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._facets = None
+        self._loaded_at = 0.0
+
+    def get(self):
+        """Return ``{'categories': [...], 'locations': [...]}``.
+
+        Each entry is ``{'value', 'count', 'available_count'}`` sorted by value.
+        """
+        facets = self._facets
+        if facets is not None and time.monotonic() - self._loaded_at < self.ttl:
+            return facets
+
+        with self._lock:
+            if self._facets is None or time.monotonic() - self._loaded_at >= self.ttl:
+                try:
+                    self._facets = {
+                        'categories': self._count_by(Book.category),
+                        'locations': self._count_by(Book.location),
+                    }
+                    self._loaded_at = time.monotonic()
+                except Exception as e:
+                    logging.error(f"Error loading catalog facets: {e}")
+                    return self._facets or {'categories': [], 'locations': []}
+            return self._facets
+
+    def invalidate(self):
+        """Drop the cached facets; the next get() reloads them"""
+        with self._lock:
+            self._facets = None
+
+    @staticmethod
+    def _count_by(column):
+        rows = db.session.query(
+            column,
+            func.count(Book.id),
+            func.sum(case((Book.available == True, 1), else_=0))
+        ).filter(
+            column.isnot(None), column != ''
+        ).group_by(column).order_by(column).all()
+
+        return [
+            {'value': value, 'count': count, 'available_count': int(available or 0)}
+            for value, count, available in rows
+        ]
+
+
+catalog_facets = FacetCache()
@@ -0,0 +1,87 @@
+"""
+Cached per-user header counters: borrowed books and unread notifications.
+
+The counts live in the shared store under ``header_counts:<user_id>``. A
+miss costs one query for both counts. Any commit that inserts, updates or
+deletes a ``BorrowedBook`` or ``Notification`` row invalidates the
+affected users' entries (session events below), so the borrow, approve,
+return and notification code paths need no explicit calls. Bulk
+``Query.update()``/``delete()`` bypass the session and must call
+``invalidate_header_counts()`` themselves.
+
+Invalidations reach every worker only through a shared store (Redis).
+Without one they clear the committing worker's copy, and other workers
+serve counts up to ``LOCAL_TTL`` old; multi-worker deployments need
+``REDIS_URL`` (see ``utils.shared_store.warn_if_not_shared``).
+"""
+import logging
+
+from sqlalchemy import event, func
+
+from config import db
+from models import BorrowedBook, Notification, User
+from utils.shared_store import store
+
+# Without a shared store other workers only see an invalidation via expiry
+LOCAL_TTL = 30
+SHARED_TTL = 600
+
+_SESSION_KEY = 'header_count_users'
+
+
+def _key(user_id):
+    return f'header_counts:{user_id}'
+
+
+def get_header_counts(user_id):
+    """``{'borrowed_count', 'notification_count'}`` for ``user_id``"""
+    counts = store.get(_key(user_id))
+    if counts is not None:
+        return counts
+
+    try:
+        borrowed = db.select(func.count(BorrowedBook.id)).where(
+            BorrowedBook.user_id == user_id,
+            BorrowedBook.is_returned == False,
+            BorrowedBook.is_agreed == True
+        ).scalar_subquery()
+        # Materialized on users (see User.adjust_unread_notifications)
+        unread = db.select(User.unread_notifications).where(
+            User.id == user_id
+        ).scalar_subquery()
+        borrowed_count, notification_count = db.session.execute(db.select(borrowed, unread)).one()
+    except Exception as e:
+        logging.error(f"Error loading header counts for user {user_id}: {e}")
+        return {'borrowed_count': 0, 'notification_count': 0}
+
+    counts = {
+        'borrowed_count': borrowed_count,
+        'notification_count': max(notification_count or 0, 0),
+    }
+    store.set(_key(user_id), counts, ttl=SHARED_TTL if store.shared else LOCAL_TTL)
+    return counts
+
+
+def invalidate_header_counts(*user_ids):
+    """Drop cached counts; the next render reloads them"""
+    store.delete(*(_key(user_id) for user_id in user_ids if user_id))
+
+
+@event.listens_for(db.session, 'after_flush')
+def _collect_affected_users(session, flush_context):
+    users = session.info.setdefault(_SESSION_KEY, set())
+    for obj in (*session.new, *session.dirty, *session.deleted):
+        if isinstance(obj, (BorrowedBook, Notification)):
+            users.add(obj.user_id)
+
+
+@event.listens_for(db.session, 'after_commit')
+def _invalidate_after_commit(session):
+    users = session.info.pop(_SESSION_KEY, None)
+    if users:
+        invalidate_header_counts(*users)
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _forget_after_rollback(session):
+    session.info.pop(_SESSION_KEY, None)
@@ -0,0 +1,85 @@
+"""
+Conditional GET support (ETag / Last-Modified).
+
+Views compute a cheap version stamp first (row counts and the newest
+``updated_at`` of the rows behind the response) and hand it to
+``conditional_response()`` together with a callable that builds the real
+response. When the client's ``If-None-Match`` / ``If-Modified-Since``
+still matches, a bodiless 304 is returned and the builder never runs, so
+unchanged resources skip both the full query and the serialization.
+"""
+import hashlib
+from datetime import timezone
+
+from flask import make_response, request
+from sqlalchemy import func
+
+
+def make_etag(*parts):
+    """Opaque validator for a version stamp; includes the request URL so
+    different pages, filters and sorts of the same table never collide"""
+    raw = repr((request.full_path,) + parts).encode()
+    return hashlib.sha256(raw).hexdigest()[:32]
+
+
+def table_stamp(query, updated_column):
+    """``(row count, newest update time)`` of the rows matched by ``query``.
+
+    Deleting a row lowers the count but never advances the newest update
+    time, so the time alone is not a valid ``Last-Modified`` for a
+    collection; use both in the ETag.
+    """
+    count, last_modified = query.with_entities(
+        func.count(), func.max(updated_column)
+    ).order_by(None).one()
+    return count, last_modified
+
+
+def newest(*stamps):
+    """Latest of several update times, ignoring missing ones"""
+    stamps = [stamp for stamp in stamps if stamp is not None]
+    return max(stamps) if stamps else None
+
+
+def is_not_modified(etag, last_modified=None):
+    """True when the request's validators show the client copy is current.
+
+    ``If-None-Match`` takes precedence over ``If-Modified-Since`` (RFC 9110).
+    """
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+
+    if last_modified and request.if_modified_since:
+        # HTTP dates have one-second resolution
+        last_modified = _as_utc(last_modified).replace(microsecond=0)
+        return last_modified <= request.if_modified_since
+
+    return False
+
+
+def conditional_response(etag, last_modified, build, weak=False, private=False):
+    """Answer 304 if the client copy is current, else ``build()``.
+
+    ``build`` returns anything a view may return. The validators are set on
+    both the 304 and the full response. ``private`` marks responses that
+    differ per logged-in user so shared caches do not store them.
+    """
+    if request.method in ('GET', 'HEAD') and is_not_modified(etag, last_modified):
+        response = make_response('', 304)
+    else:
+        response = make_response(build())
+        if response.status_code != 200:
+            return response
+
+    response.set_etag(etag, weak=weak)
+    if last_modified:
+        response.last_modified = _as_utc(last_modified)
+    response.cache_control.no_cache = True
+    if private:
+        response.cache_control.private = True
+    return response
+
+
+def _as_utc(value):
+    # Timestamps are stored as naive UTC (datetime.utcnow)
+    return value.replace(tzinfo=timezone.utc) if value.tzinfo is None else value
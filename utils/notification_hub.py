@@ -0,0 +1,149 @@
+"""
+Fan-out hub for live notification events (Server-Sent Events).
+
+Each open ``/api/notifications/stream`` connection subscribes a small
+bounded queue for its user; an idle connection is just a blocked
+``queue.get`` and one set entry, with no database connection held. Commits
+that create notifications or flip ``is_read`` publish to the hub (session
+events below), and bulk updates call ``notify_count_changed()`` explicitly.
+
+With ``REDIS_URL`` set (and the ``redis`` package installed) events travel
+over a Redis pub/sub channel so a write in one gunicorn worker reaches
+streams held by every worker; otherwise the hub is per-worker and streams
+reconcile the count on their keep-alive tick.
+
+Run gunicorn with a threaded or async worker class (``gthread``/``gevent``)
+so idle streams do not each occupy a whole sync worker.
+"""
+import json
+import logging
+import os
+import queue
+import threading
+from collections import defaultdict
+
+from sqlalchemy import event, inspect
+
+from config import db
+from models import Notification
+
+SUBSCRIBER_QUEUE_SIZE = 100
+_SESSION_KEY = 'notification_hub_events'
+
+
+class NotificationHub:
+    """Per-user fan-out of ``(event, data)`` pairs to subscriber queues"""
+
+    channel = 'readingtrail:notifications'
+
+    def __init__(self, redis_url=None):
+        self._lock = threading.Lock()
+        self._subscribers = defaultdict(set)
+        self._redis = None
+        self._listener = None
+        if redis_url:
+            try:
+                import redis
+                self._redis = redis.Redis.from_url(redis_url)
+            except ImportError:
+                logging.warning("REDIS_URL is set but the redis package is not installed; notification hub is per-worker")
+
+    @property
+    def shared(self):
+        """True when events from every worker reach this worker's streams"""
+        return self._redis is not None
+
+    def subscribe(self, user_id):
+        """Register a stream for ``user_id``; returns its event queue"""
+        subscription = queue.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        with self._lock:
+            self._subscribers[user_id].add(subscription)
+        if self._redis is not None:
+            self._ensure_listener()
+        return subscription
+
+    def unsubscribe(self, user_id, subscription):
+        with self._lock:
+            subscribers = self._subscribers.get(user_id)
+            if subscribers:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self._subscribers[user_id]
+
+    def publish(self, user_id, event_name, data=None):
+        """Send an event to every stream of ``user_id`` (in all workers if shared)"""
+        if self._redis is not None:
+            try:
+                self._redis.publish(self.channel, json.dumps([user_id, event_name, data]))
+                return
+            except Exception as e:
+                logging.warning(f"Redis publish failed, delivering locally only: {e}")
+        self._deliver(user_id, event_name, data)
+
+    def _deliver(self, user_id, event_name, data):
+        with self._lock:
+            subscribers = list(self._subscribers.get(user_id, ()))
+        for subscription in subscribers:
+            try:
+                subscription.put_nowait((event_name, data))
+            except queue.Full:
+                # A stalled client; it resyncs the count on its next event
+                pass
+
+    def _ensure_listener(self):
+        with self._lock:
+            if self._listener is not None and self._listener.is_alive():
+                return
+            self._listener = threading.Thread(target=self._listen, name='notification-hub', daemon=True)
+            self._listener.start()
+
+    def _listen(self):
+        try:
+            pubsub = self._redis.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(self.channel)
+            for message in pubsub.listen():
+                try:
+                    user_id, event_name, data = json.loads(message['data'])
+                except (TypeError, ValueError):
+                    continue
+                self._deliver(user_id, event_name, data)
+        except Exception as e:
+            logging.error(f"Notification hub listener stopped: {e}")
+
+
+notification_hub = NotificationHub(os.environ.get('REDIS_URL'))
+
+
+def notify_count_changed(*user_ids):
+    """Tell open streams to refresh the unread count (for bulk updates)"""
+    for user_id in user_ids:
+        if user_id:
+            notification_hub.publish(user_id, 'count')
+
+
+@event.listens_for(db.session, 'after_flush')
+def _collect_notification_events(session, flush_context):
+    events = session.info.setdefault(_SESSION_KEY, [])
+    for obj in session.new:
+        if isinstance(obj, Notification):
+            events.append((obj.user_id, 'notification', obj.to_dict()))
+    for obj in session.dirty:
+        if not isinstance(obj, Notification):
+            continue
+        attrs = inspect(obj).attrs
+        if attrs.is_read.history.has_changes():
+            events.append((obj.user_id, 'count', None))
+        elif attrs.count.history.has_changes():
+            # A burst merged into an existing row (Notification.notify)
+            events.append((obj.user_id, 'notification', obj.to_dict()))
+
+
+@event.listens_for(db.session, 'after_commit')
+def _publish_after_commit(session):
+    for user_id, event_name, data in session.info.pop(_SESSION_KEY, ()):
+        notification_hub.publish(user_id, event_name, data)
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _drop_after_rollback(session):
+    session.info.pop(_SESSION_KEY, None)
@@ -0,0 +1,99 @@
+"""
+Keyset (cursor) pagination helpers.
+
+A cursor is an opaque, URL-safe token holding the sort-key values of the
+last row of a page. The next page is fetched with a row-value comparison
+on those keys (``(created_at, id) < (:created_at, :id)``), which an index
+on the keys serves directly, so deep pages cost the same as the first one.
+"""
+import base64
+import json
+from datetime import datetime
+
+from sqlalchemy import tuple_
+
+MAX_PAGE_SIZE = 100
+
+
+def encode_cursor(values):
+    """Encode a row's sort-key values as an opaque cursor string"""
+    payload = [
+        {'dt': value.isoformat()} if isinstance(value, datetime) else value
+        for value in values
+    ]
+    raw = json.dumps(payload, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Decode a cursor produced by encode_cursor(); raises ValueError if invalid"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        payload = json.loads(raw)
+    except (ValueError, TypeError) as e:
+        raise ValueError('Invalid cursor') from e
+
+    if not isinstance(payload, list):
+        raise ValueError('Invalid cursor')
+
+    try:
+        return [_decode_value(value) for value in payload]
+    except (KeyError, TypeError, ValueError) as e:
+        raise ValueError('Invalid cursor') from e
+
+
+def _decode_value(value):
+    if isinstance(value, dict):
+        return datetime.fromisoformat(value['dt'])
+    if isinstance(value, (list, bool)):
+        raise TypeError(f'unexpected cursor value {value!r}')
+    return value
+
+
+def _matches_type(value, column):
+    try:
+        python_type = column.type.python_type
+    except NotImplementedError:
+        return True
+    return isinstance(value, python_type)
+
+
+def keyset_page(query, keys, limit, cursor=None, descending=True, include_total=False):
+    """Fetch one page of ``query`` ordered by ``keys`` after ``cursor``.
+
+    ``keys`` are model columns that together are unique, ending with the
+    primary key (e.g. ``(Book.created_at, Book.id)``). Any existing ORDER BY
+    on ``query`` is replaced. Returns ``(items, pagination)`` where
+    ``pagination`` has ``limit``, ``has_next``, ``next_cursor`` and, only
+    when ``include_total`` is set, ``total``.
+    """
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    total = query.order_by(None).count() if include_total else None
+
+    if cursor:
+        values = decode_cursor(cursor)
+        # A well-formed cursor for other keys (e.g. a string where a date
+        # belongs) would otherwise fail in the database, not here
+        if len(values) != len(keys) or not all(map(_matches_type, values, keys)):
+            raise ValueError('Invalid cursor')
+        row_keys, row_values = tuple_(*keys), tuple_(*values)
+        query = query.filter(row_keys < row_values if descending else row_keys > row_values)
+
+    ordering = [key.desc() if descending else key.asc() for key in keys]
+    rows = query.order_by(None).order_by(*ordering).limit(limit + 1).all()
+
+    has_next = len(rows) > limit
+    items = rows[:limit]
+    next_cursor = None
+    if has_next:
+        last = items[-1]
+        next_cursor = encode_cursor([getattr(last, key.key) for key in keys])
+
+    pagination = {
+        'limit': limit,
+        'has_next': has_next,
+        'next_cursor': next_cursor,
+    }
+    if include_total:
+        pagination['total'] = total
+    return items, pagination
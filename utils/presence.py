@@ -0,0 +1,123 @@
+"""
+Presence service: who is online right now, without reading ``users``.
+
+Requests from logged-in users send a heartbeat; a user is online while
+their last heartbeat is younger than ``PRESENCE_TTL``. Heartbeats live in a
+pluggable backend: ``LocalPresence`` keeps them in this process (the stand-in
+when no shared backend is configured) and ``RedisPresence`` keeps them in
+one Redis sorted set so every worker sees every user. Lookups are batched
+through ``who_is_online(user_ids)``.
+"""
+import logging
+import os
+import threading
+import time
+
+# Matches the 5-minute window User.is_online() has always used
+PRESENCE_TTL = 300
+# A user's heartbeat is forwarded to the backend at most this often
+HEARTBEAT_INTERVAL = 30
+
+
+class LocalPresence:
+    """Heartbeats held in this process; other workers' users are not seen"""
+
+    shared = False
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._seen = {}
+
+    def beat(self, user_id, now):
+        self._seen[user_id] = now
+
+    def last_seen_many(self, user_ids):
+        return {user_id: self._seen.get(user_id) for user_id in user_ids}
+
+    def expire(self, before):
+        with self._lock:
+            self._seen = {uid: seen for uid, seen in self._seen.items() if seen >= before}
+
+
+class RedisPresence:
+    """Heartbeats in a Redis sorted set (member = user id, score = time)"""
+
+    shared = True
+    key = 'readingtrail:presence'
+
+    def __init__(self, url):
+        import redis
+        self._redis = redis.Redis.from_url(url, socket_timeout=0.5)
+
+    def beat(self, user_id, now):
+        self._redis.zadd(self.key, {str(user_id): now})
+
+    def last_seen_many(self, user_ids):
+        user_ids = list(user_ids)
+        if not user_ids:
+            return {}
+        scores = self._redis.zmscore(self.key, [str(user_id) for user_id in user_ids])
+        return dict(zip(user_ids, scores))
+
+    def expire(self, before):
+        self._redis.zremrangebyscore(self.key, '-inf', before)
+
+
+class PresenceService:
+    """Heartbeat tracking with TTL expiry on top of a presence backend"""
+
+    def __init__(self, backend, ttl=PRESENCE_TTL, heartbeat_interval=HEARTBEAT_INTERVAL):
+        self.backend = backend
+        self.ttl = ttl
+        self.heartbeat_interval = heartbeat_interval
+        self._sent = {}
+        self._last_expire = time.time()
+
+    def heartbeat(self, user_id):
+        """Mark ``user_id`` online now (throttled per user)"""
+        now = time.time()
+        if now - self._sent.get(user_id, 0) < self.heartbeat_interval:
+            return
+        self._sent[user_id] = now
+        try:
+            self.backend.beat(user_id, now)
+            if now - self._last_expire >= self.ttl:
+                self._last_expire = now
+                self.backend.expire(now - self.ttl)
+                self._sent = {uid: sent for uid, sent in self._sent.items() if sent >= now - self.ttl}
+        except Exception as e:
+            logging.warning(f"Presence heartbeat failed for user {user_id}: {e}")
+
+    def who_is_online(self, user_ids):
+        """The subset of ``user_ids`` with a live heartbeat, in one lookup"""
+        user_ids = [user_id for user_id in dict.fromkeys(user_ids) if user_id]
+        if not user_ids:
+            return set()
+        cutoff = time.time() - self.ttl
+        try:
+            last_seen = self.backend.last_seen_many(user_ids)
+        except Exception as e:
+            logging.warning(f"Presence lookup failed: {e}")
+            return set()
+        return {user_id for user_id, seen in last_seen.items() if seen and seen >= cutoff}
+
+    def is_online(self, user_id):
+        return user_id in self.who_is_online([user_id])
+
+    @property
+    def authoritative(self):
+        """True when the backend sees heartbeats from every worker"""
+        return self.backend.shared
+
+
+def _create_backend():
+    url = os.environ.get('REDIS_URL')
+    if url:
+        try:
+            return RedisPresence(url)
+        except ImportError:
+            logging.warning("REDIS_URL is set but the redis package is not installed; using local presence")
+    return LocalPresence()
+
+
+presence = PresenceService(_create_backend())
@@ -0,0 +1,47 @@
+"""
+Per-request SQL query counter.
+
+Counts the statements executed while handling a request and reports them
+in the ``X-Query-Count`` response header (plus a debug log line), so list
+endpoints can be checked for N+1 query patterns. Only enabled in debug mode
+or with ``QUERY_COUNTER=1``: production responses carry no header and pay
+no per-statement hook.
+"""
+import logging
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+
+
+def init_query_counter(app, engine):
+    """Attach the counter to ``engine`` and report it on every response.
+
+    Does nothing unless ``app.debug`` or the ``QUERY_COUNTER`` config flag
+    is set; returns whether the counter was installed.
+    """
+    if not (app.debug or app.config.get('QUERY_COUNTER')):
+        return False
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def _count_query(conn, cursor, statement, parameters, context, executemany):
+        if has_request_context():
+            g.query_count = g.get('query_count', 0) + 1
+
+    @app.before_request
+    def _reset_query_count():
+        # g belongs to the app context, which can outlive one request
+        g.query_count = 0
+
+    @app.after_request
+    def _report_query_count(response):
+        count = get_query_count()
+        response.headers['X-Query-Count'] = str(count)
+        logging.debug(f"{request.method} {request.path} ran {count} queries")
+        return response
+
+    return True
+
+
+def get_query_count():
+    """Number of SQL statements executed so far in the current request"""
+    return g.get('query_count', 0) if has_request_context() else 0
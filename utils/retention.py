@@ -0,0 +1,148 @@
+"""
+Retention: move cold rows out of the live social tables into archive tables.
+
+Each policy selects rows older than its age limit and moves them in batches
+(INSERT ... SELECT into the archive table, then DELETE, in one transaction
+per batch) so the live tables and their indexes stay small. Archived rows
+keep their ids and stay readable through ``models.archive``: chat and book
+discussion scrollback continue into the archive, and archived
+notifications are listed with ``/api/v1/notifications?archived=true``.
+
+Ages come from the environment (days): ``NOTIFICATION_RETENTION_DAYS``
+(default 90, read notifications only), ``MESSAGE_RETENTION_DAYS`` and
+``DISCUSSION_RETENTION_DAYS`` (default 365). Run ``archive_old_rows.py``
+periodically. On SQLite the live tables must use AUTOINCREMENT (declared on
+the models) so archived ids are never reused; older tables are refused.
+"""
+import logging
+import os
+from datetime import datetime, timedelta
+
+from sqlalchemy import text
+
+from config import db
+from models import (
+    ArchivedDiscussion, ArchivedNotification, ArchivedPrivateMessage,
+    Conversation, Discussion, Notification, PrivateMessage
+)
+
+ARCHIVE_BATCH_SIZE = 1000
+
+
+class RetentionPolicy:
+    """Which rows of ``model`` are cold, and where they go"""
+
+    def __init__(self, name, model, archive_model, age_column, days, condition=None):
+        self.name = name
+        self.model = model
+        self.archive_model = archive_model
+        self.age_column = age_column
+        self.days = days
+        self.condition = condition
+
+    def cold_filter(self, now):
+        conditions = [self.age_column < now - timedelta(days=self.days)]
+        if self.condition is not None:
+            conditions.append(self.condition)
+        return conditions
+
+
+def _days(name, default):
+    return int(os.environ.get(name) or default)
+
+
+def retention_policies():
+    return [
+        RetentionPolicy('notifications', Notification, ArchivedNotification, Notification.created_at,
+                        _days('NOTIFICATION_RETENTION_DAYS', 90), condition=Notification.is_read == True),
+        # By age alone, so archived history is always older than live history
+        # and scrollback can continue from one table into the other
+        RetentionPolicy('private_messages', PrivateMessage, ArchivedPrivateMessage, PrivateMessage.timestamp,
+                        _days('MESSAGE_RETENTION_DAYS', 365)),
+        RetentionPolicy('discussions', Discussion, ArchivedDiscussion, Discussion.created_at,
+                        _days('DISCUSSION_RETENTION_DAYS', 365)),
+    ]
+
+
+def archive_batch(policy, now=None, batch_size=ARCHIVE_BATCH_SIZE):
+    """Move up to ``batch_size`` cold rows of ``policy``; returns the number moved"""
+    now = now or datetime.utcnow()
+    live = policy.model.__table__
+    archive = policy.archive_model.__table__
+    _check_ids_not_reused(live)
+
+    ids = db.session.execute(
+        db.select(live.c.id).where(*policy.cold_filter(now)).order_by(live.c.id).limit(batch_size)
+    ).scalars().all()
+    if not ids:
+        return 0
+
+    try:
+        if policy.model is PrivateMessage:
+            _release_unread_messages(ids)
+
+        columns = [column.name for column in archive.columns if column.name in live.columns]
+        db.session.execute(archive.insert().from_select(
+            columns + ['archived_at'],
+            db.select(*[live.c[name] for name in columns], db.literal(now)).where(live.c.id.in_(ids))
+        ))
+        db.session.execute(live.delete().where(live.c.id.in_(ids)))
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        logging.error(f"Error archiving {policy.name}: {e}")
+        raise
+    return len(ids)
+
+
+def _check_ids_not_reused(table):
+    """Archived rows keep their ids, so live ids must never be handed out
+    again. SQLite reuses the highest rowid after it is deleted unless the
+    table was created with AUTOINCREMENT (older databases were not)."""
+    if db.engine.dialect.name != 'sqlite':
+        return
+    ddl = db.session.execute(
+        text("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = :name"), {'name': table.name}
+    ).scalar()
+    if ddl and 'AUTOINCREMENT' not in ddl.upper():
+        raise RuntimeError(
+            f"{table.name} was created without AUTOINCREMENT; archiving it on SQLite would let "
+            f"new rows reuse archived ids. Recreate the table (or use PostgreSQL) first."
+        )
+
+
+def _release_unread_messages(ids):
+    """Cold messages are archived as read; take them out of inbox unread counts"""
+    unread = db.session.query(
+        PrivateMessage.recipient_id, PrivateMessage.sender_id, db.func.count(PrivateMessage.id)
+    ).filter(
+        PrivateMessage.id.in_(ids), PrivateMessage.is_read == False
+    ).group_by(PrivateMessage.recipient_id, PrivateMessage.sender_id).all()
+
+    for user_id, peer_id, count in unread:
+        Conversation.query.filter_by(user_id=user_id, peer_id=peer_id).update(
+            {Conversation.unread_count: db.case(
+                (Conversation.unread_count > count, Conversation.unread_count - count), else_=0
+            )},
+            synchronize_session=False
+        )
+    if unread:
+        PrivateMessage.query.filter(PrivateMessage.id.in_(ids)).update(
+            {PrivateMessage.is_read: True}, synchronize_session=False
+        )
+
+
+def archive_cold_rows(batch_size=ARCHIVE_BATCH_SIZE, max_batches=None):
+    """Run every policy until nothing is cold; returns ``{name: rows moved}``"""
+    now = datetime.utcnow()
+    moved = {}
+    for policy in retention_policies():
+        total = batches = 0
+        while max_batches is None or batches < max_batches:
+            count = archive_batch(policy, now, batch_size)
+            total += count
+            batches += 1
+            if count < batch_size:
+                break
+        moved[policy.name] = total
+    return moved
@@ -0,0 +1,113 @@
+"""
+Lightweight schema upgrades for databases created by an older db.create_all().
+"""
+import logging
+
+from sqlalchemy import inspect, text
+from sqlalchemy.schema import CreateIndex
+
+from config import db
+
+
+def add_missing_columns():
+    """Add model columns that are missing from existing tables.
+
+    ``db.create_all()`` only creates missing tables, so columns added to a
+    model later are issued here as ``ALTER TABLE ... ADD COLUMN`` (with the
+    column's server default, if any). Returns the list of added columns.
+    """
+    inspector = inspect(db.engine)
+    dialect = db.engine.dialect
+    existing_tables = set(inspector.get_table_names())
+    added = []
+
+    for table in db.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue
+
+        existing_columns = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing_columns:
+                continue
+
+            ddl = f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column.type.compile(dialect=dialect)}'
+            if column.server_default is not None:
+                default = column.server_default.arg
+                if not isinstance(default, str):
+                    default = default.compile(dialect=dialect)
+                ddl += f' DEFAULT {default}'
+
+            try:
+                db.session.execute(text(ddl))
+                db.session.commit()
+                added.append(f'{table.name}.{column.name}')
+            except Exception as e:
+                db.session.rollback()
+                logging.error(f"Error adding column {table.name}.{column.name}: {e}")
+
+    if added:
+        logging.info(f"Added missing columns: {', '.join(added)}")
+    return added
+
+
+def add_missing_indexes(concurrently=None):
+    """Create model-declared indexes that are missing from existing tables.
+
+    Like columns, indexes added to ``__table_args__`` after a table exists
+    are skipped by ``db.create_all()``. On PostgreSQL they are built with
+    ``CREATE INDEX CONCURRENTLY`` (the default there) so writes to large
+    tables are not blocked; an invalid index left by an interrupted
+    concurrent build is dropped and rebuilt. Returns the list of created
+    indexes.
+    """
+    engine = db.engine
+    if concurrently is None:
+        concurrently = engine.dialect.name == 'postgresql'
+
+    inspector = inspect(engine)
+    existing_tables = set(inspector.get_table_names())
+    invalid = _invalid_indexes() if concurrently else set()
+    created = []
+
+    for table in db.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue
+
+        existing_indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name in existing_indexes and index.name not in invalid:
+                continue
+            try:
+                if concurrently:
+                    _create_index_concurrently(index, rebuild=index.name in invalid)
+                else:
+                    index.create(bind=engine, checkfirst=True)
+                created.append(index.name)
+            except Exception as e:
+                logging.error(f"Error creating index {index.name}: {e}")
+
+    if created:
+        logging.info(f"Created missing indexes: {', '.join(created)}")
+    return created
+
+
+def _invalid_indexes():
+    """Names of PostgreSQL indexes marked invalid (failed concurrent builds)"""
+    with db.engine.connect() as conn:
+        return set(conn.execute(text(
+            "SELECT c.relname FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid "
+            "WHERE NOT i.indisvalid"
+        )).scalars())
+
+
+def _create_index_concurrently(index, rebuild=False):
+    # CONCURRENTLY cannot run inside a transaction block
+    options = index.dialect_options['postgresql']
+    options['concurrently'] = True
+    try:
+        with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+            if rebuild:
+                conn.execute(text(f'DROP INDEX CONCURRENTLY IF EXISTS {index.name}'))
+            conn.execute(CreateIndex(index, if_not_exists=True))
+    finally:
+        options['concurrently'] = False
@@ -0,0 +1,372 @@
+"""
+Full-text and fuzzy search over the book catalog and users.
+
+PostgreSQL keeps a generated ``search_vector`` tsvector column on ``books``
+backed by a GIN index; SQLite keeps an external-content FTS5 table
+``books_fts`` in sync with ``books`` through triggers. Any other backend (or
+a database where ``install_search_schema()`` has not run yet) falls back
+to ILIKE. The schema is installed by ``migrate_indexes.py`` at deploy time;
+workers only detect it at start-up.
+
+Accent-insensitive, typo-tolerant matching runs against the normalized
+``*_norm`` columns (see ``utils.text.normalize_text``), which PostgreSQL
+indexes with pg_trgm GIN indexes for both LIKE and similarity lookups.
+SQLite is a development fallback here: its fuzzy matches scan the
+normalized columns, which is fine for a dev catalog but not at production
+sizes.
+"""
+import html
+import logging
+import re
+
+from markupsafe import Markup
+from sqlalchemy import Float, Integer, bindparam, func, literal, text, union_all
+
+from config import db
+from models import Book, User
+from utils.schema import _invalid_indexes
+from utils.text import normalize_text
+
+# Highlight markers used inside the database; swapped for <mark> after escaping
+HIGHLIGHT_START = '\x02'
+HIGHLIGHT_STOP = '\x03'
+
+MAX_SEARCH_TERMS = 8
+BACKFILL_BATCH_SIZE = 500
+
+# Which engine detect_search_backend() found installed for this process
+_search_backend = None
+# Whether pg_trgm indexes are available for similarity operators
+_trigram_enabled = False
+
+
+PG_SEARCH_COLUMN = """
+    ALTER TABLE books ADD COLUMN IF NOT EXISTS search_vector tsvector
+    GENERATED ALWAYS AS (
+        setweight(to_tsvector('simple', coalesce(title, '')), 'A') ||
+        setweight(to_tsvector('simple', coalesce(author, '')), 'B') ||
+        setweight(to_tsvector('simple', coalesce(description, '')), 'C')
+    ) STORED
+"""
+
+PG_SEARCH_INDEXES = {
+    'ix_books_search_vector': 'ON books USING GIN (search_vector)',
+}
+
+PG_TRIGRAM_INDEXES = {
+    'ix_books_title_norm_trgm': 'ON books USING GIN (title_norm gin_trgm_ops)',
+    'ix_books_author_norm_trgm': 'ON books USING GIN (author_norm gin_trgm_ops)',
+    'ix_books_location_norm_trgm': 'ON books USING GIN (location_norm gin_trgm_ops)',
+    'ix_users_search_norm_trgm': 'ON users USING GIN (search_norm gin_trgm_ops)',
+}
+
+SQLITE_SEARCH_SCHEMA = [
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS books_fts USING fts5(
+        title, author, description,
+        content='books', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2'
+    )
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS books_fts_ai AFTER INSERT ON books BEGIN
+        INSERT INTO books_fts(rowid, title, author, description)
+        VALUES (new.id, new.title, new.author, new.description);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS books_fts_ad AFTER DELETE ON books BEGIN
+        INSERT INTO books_fts(books_fts, rowid, title, author, description)
+        VALUES ('delete', old.id, old.title, old.author, old.description);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS books_fts_au AFTER UPDATE OF title, author, description ON books BEGIN
+        INSERT INTO books_fts(books_fts, rowid, title, author, description)
+        VALUES ('delete', old.id, old.title, old.author, old.description);
+        INSERT INTO books_fts(rowid, title, author, description)
+        VALUES (new.id, new.title, new.author, new.description);
+    END
+    """,
+]
+
+
+def install_search_schema():
+    """Install the search schema: column and indexes (PostgreSQL) or FTS5 table (SQLite).
+
+    A deploy step (``migrate_indexes.py``), not a start-up one: adding the
+    generated column rewrites ``books`` under an exclusive lock, so it runs
+    once, and the GIN indexes (full-text and pg_trgm) are built
+    ``CONCURRENTLY`` so writes continue. Safe to re-run; must run inside an
+    app context. Returns the backend that was installed, or None.
+    """
+    dialect = db.engine.dialect.name
+
+    if dialect == 'postgresql':
+        db.session.execute(text(PG_SEARCH_COLUMN))
+        db.session.commit()
+        _create_indexes_concurrently(PG_SEARCH_INDEXES)
+        try:
+            db.session.execute(text('CREATE EXTENSION IF NOT EXISTS pg_trgm'))
+            db.session.commit()
+            _create_indexes_concurrently(PG_TRIGRAM_INDEXES)
+        except Exception as e:
+            db.session.rollback()
+            logging.warning(f"pg_trgm unavailable, fuzzy search limited to LIKE: {e}")
+    elif dialect == 'sqlite':
+        existed = _sqlite_fts_exists()
+        for statement in SQLITE_SEARCH_SCHEMA:
+            db.session.execute(text(statement))
+        if not existed:
+            # Index rows that were inserted before the triggers existed
+            db.session.execute(text("INSERT INTO books_fts(books_fts) VALUES ('rebuild')"))
+        db.session.commit()
+    else:
+        return None
+
+    return detect_search_backend()
+
+
+def detect_search_backend():
+    """Pick the search engines for this process from the installed schema.
+
+    Only reads the catalog, so every worker can call it at start-up; until
+    ``install_search_schema()`` has run, search falls back to ILIKE and
+    fuzzy matching to LIKE. Must run inside an app context.
+    """
+    global _search_backend, _trigram_enabled
+    dialect = db.engine.dialect.name
+    full_text = trigram = False
+
+    try:
+        if dialect == 'postgresql':
+            valid = set(db.session.execute(text(
+                "SELECT c.relname FROM pg_index i "
+                "JOIN pg_class c ON c.oid = i.indexrelid "
+                "WHERE i.indisvalid AND c.relname IN :names"
+            ).bindparams(bindparam('names', expanding=True)), {
+                'names': [*PG_SEARCH_INDEXES, *PG_TRIGRAM_INDEXES],
+            }).scalars())
+            full_text = valid.issuperset(PG_SEARCH_INDEXES)
+            trigram = valid.issuperset(PG_TRIGRAM_INDEXES)
+        elif dialect == 'sqlite':
+            full_text = _sqlite_fts_exists()
+        db.session.rollback()
+    except Exception as e:
+        db.session.rollback()
+        logging.warning(f"Could not detect the search schema: {e}")
+
+    _search_backend = dialect if full_text else None
+    _trigram_enabled = trigram
+    if not full_text:
+        logging.warning("Full-text search schema not installed (run migrate_indexes.py); falling back to ILIKE")
+    return _search_backend
+
+
+def _create_indexes_concurrently(indexes):
+    # CONCURRENTLY cannot run inside a transaction block; an invalid index
+    # left by an interrupted build is dropped and rebuilt
+    invalid = _invalid_indexes()
+    with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+        for name, definition in indexes.items():
+            if name in invalid:
+                conn.execute(text(f'DROP INDEX CONCURRENTLY IF EXISTS {name}'))
+            conn.execute(text(f'CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} {definition}'))
+
+
+def _sqlite_fts_exists():
+    return db.session.execute(text(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'books_fts'"
+    )).first() is not None
+
+
+def backfill_search_fields():
+    """Fill normalized columns for rows written before they existed.
+
+    A maintenance step (``repair_counters.py``); new and edited rows keep
+    their columns current themselves. Returns the number of rows filled.
+    """
+    filled = 0
+    for model, marker in ((Book, Book.title_norm), (User, User.search_norm)):
+        try:
+            while True:
+                rows = model.query.filter(marker.is_(None)).limit(BACKFILL_BATCH_SIZE).all()
+                if not rows:
+                    break
+                for row in rows:
+                    row.refresh_search_fields()
+                db.session.commit()
+                filled += len(rows)
+        except Exception as e:
+            db.session.rollback()
+            logging.error(f"Error backfilling normalized search fields for {model.__name__}: {e}")
+    return filled
+
+
+def search_terms(search):
+    """Split a user query into plain word tokens (no query syntax survives)"""
+    return re.findall(r'\w+', (search or '').lower())[:MAX_SEARCH_TERMS]
+
+
+def fuzzy_filter(column, search):
+    """Accent-insensitive, typo-tolerant match on a normalized ``*_norm`` column.
+
+    Substring LIKE catches partial words; on PostgreSQL the pg_trgm
+    word-similarity operator also catches small typos. Both are served by
+    the trigram GIN index.
+    """
+    normalized = normalize_text(search)
+    condition = column.contains(normalized, autoescape=True)
+    if _trigram_enabled:
+        condition = condition | column.op('%>')(normalized)
+    return condition
+
+
+def _fuzzy_rank(normalized):
+    """Similarity of the query to title/author (0..1), for ranking fuzzy hits"""
+    if _trigram_enabled:
+        return func.greatest(
+            func.word_similarity(normalized, Book.title_norm),
+            func.word_similarity(normalized, Book.author_norm)
+        )
+    return literal(0.0, Float)
+
+
+def _match_subquery(search, terms):
+    """Subquery of (id, rank) for full-text or fuzzy matches, or None"""
+    if _search_backend == 'postgresql':
+        full_text = text(
+            "SELECT id, ts_rank(search_vector, to_tsquery('simple', :q)) AS rank "
+            "FROM books WHERE search_vector @@ to_tsquery('simple', :q)"
+        ).bindparams(q=' & '.join(f'{term}:*' for term in terms))
+    elif _search_backend == 'sqlite':
+        full_text = text(
+            "SELECT rowid AS id, -bm25(books_fts, 10.0, 5.0, 1.0) AS rank "
+            "FROM books_fts WHERE books_fts MATCH :q"
+        ).bindparams(q=' '.join(f'"{term}"*' for term in terms))
+    else:
+        return None
+
+    fuzzy = db.select(
+        Book.id.label('id'),
+        _fuzzy_rank(normalize_text(search)).label('rank')
+    ).where(
+        fuzzy_filter(Book.title_norm, search) | fuzzy_filter(Book.author_norm, search)
+    )
+
+    # The ORM select leads the UNION so its columns name the result
+    matches = union_all(
+        fuzzy, full_text.columns(id=Integer, rank=Float)
+    ).subquery('book_matches')
+    return db.select(
+        matches.c.id, func.max(matches.c.rank).label('rank')
+    ).group_by(matches.c.id).subquery('book_search')
+
+
+def apply_search(query, search):
+    """Restrict a ``Book`` query to full-text or fuzzy matches of ``search``.
+
+    Returns ``(query, rank)`` where ``rank`` is a column to order by
+    (higher is more relevant), or ``None`` when no search engine is
+    available and only the normalized LIKE fallback applies.
+    """
+    terms = search_terms(search)
+    if not terms:
+        return query, None
+
+    matches = _match_subquery(search, terms)
+    if matches is None:
+        return query.filter(
+            fuzzy_filter(Book.title_norm, search) |
+            fuzzy_filter(Book.author_norm, search) |
+            Book.description.icontains(search, autoescape=True)
+        ), None
+
+    return query.join(matches, matches.c.id == Book.id), matches.c.rank
+
+
+def _to_markup(value):
+    """Escape database text and turn the highlight markers into <mark> tags"""
+    escaped = html.escape(value or '')
+    return Markup(
+        escaped.replace(HIGHLIGHT_START, '<mark>').replace(HIGHLIGHT_STOP, '</mark>')
+    )
+
+
+def _highlight_in_python(value, terms, limit=None):
+    """Fallback highlighter for backends without a search engine"""
+    value = value or ''
+    if limit and len(value) > limit:
+        value = value[:limit].rsplit(' ', 1)[0] + '…'
+    pattern = re.compile('|'.join(re.escape(term) for term in terms), re.IGNORECASE)
+    return pattern.sub(lambda m: f'{HIGHLIGHT_START}{m.group(0)}{HIGHLIGHT_STOP}', value)
+
+
+def highlight_books(books, search):
+    """Highlighted title/author and a description snippet for a page of books.
+
+    Returns ``{book_id: {'title': Markup, 'author': Markup, 'snippet': Markup}}``
+    using one query for the whole page.
+    """
+    terms = search_terms(search)
+    if not books or not terms:
+        return {}
+
+    book_ids = [book.id for book in books]
+    rows = []
+
+    try:
+        if _search_backend == 'postgresql':
+            options = f'HighlightAll=true, StartSel="{HIGHLIGHT_START}", StopSel="{HIGHLIGHT_STOP}"'
+            snippet_options = (
+                f'MaxWords=30, MinWords=12, MaxFragments=2, FragmentDelimiter=" … ", '
+                f'StartSel="{HIGHLIGHT_START}", StopSel="{HIGHLIGHT_STOP}"'
+            )
+            rows = db.session.execute(text(
+                "SELECT b.id, "
+                "ts_headline('simple', coalesce(b.title, ''), q, :options), "
+                "ts_headline('simple', coalesce(b.author, ''), q, :options), "
+                "ts_headline('simple', coalesce(b.description, ''), q, :snippet_options) "
+                "FROM books b, to_tsquery('simple', :q) q "
+                "WHERE b.id = ANY(:ids)"
+            ), {
+                'q': ' & '.join(f'{term}:*' for term in terms),
+                'options': options,
+                'snippet_options': snippet_options,
+                'ids': book_ids,
+            }).all()
+        elif _search_backend == 'sqlite':
+            placeholders = ', '.join(f':id{i}' for i in range(len(book_ids)))
+            params = {f'id{i}': book_id for i, book_id in enumerate(book_ids)}
+            params['q'] = ' '.join(f'"{term}"*' for term in terms)
+            rows = db.session.execute(text(
+                "SELECT rowid, "
+                "highlight(books_fts, 0, char(2), char(3)), "
+                "highlight(books_fts, 1, char(2), char(3)), "
+                "snippet(books_fts, 2, char(2), char(3), '…', 24) "
+                f"FROM books_fts WHERE books_fts MATCH :q AND rowid IN ({placeholders})"
+            ), params).all()
+    except Exception as e:
+        db.session.rollback()
+        logging.error(f"Error building search highlights: {e}")
+        rows = []
+
+    highlights = {
+        row[0]: {
+            'title': _to_markup(row[1]),
+            'author': _to_markup(row[2]),
+            'snippet': _to_markup(row[3]),
+        }
+        for row in rows
+    }
+
+    # Books the engine did not return (fallback backend, or an engine error)
+    for book in books:
+        if book.id not in highlights:
+            highlights[book.id] = {
+                'title': _to_markup(_highlight_in_python(book.title, terms)),
+                'author': _to_markup(_highlight_in_python(book.author, terms)),
+                'snippet': _to_markup(_highlight_in_python(book.description, terms, limit=200)),
+            }
+
+    return highlights
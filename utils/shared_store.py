@@ -0,0 +1,109 @@
+"""
+Small key/value store shared by all gunicorn workers when Redis is available.
+
+Set ``REDIS_URL`` (and install the ``redis`` package) to share cached values
+and invalidations across workers and hosts. Without it every worker keeps
+its own in-process copy, and callers bound cross-worker staleness with a
+short TTL (see ``store.shared``). That is only meant for a single worker:
+with several (``WEB_CONCURRENCY``, gunicorn's worker count) an invalidation
+reaches the committing worker alone, so ``warn_if_not_shared()`` flags such
+deployments at start-up.
+"""
+import json
+import logging
+import os
+import threading
+import time
+
+
+class LocalStore:
+    """In-process store with per-key expiry; visible to this worker only"""
+
+    shared = False
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._data = {}
+
+    def get(self, key):
+        item = self._data.get(key)
+        if item is None:
+            return None
+        value, expires_at = item
+        if expires_at is not None and expires_at <= time.monotonic():
+            with self._lock:
+                self._data.pop(key, None)
+            return None
+        return value
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.monotonic() + ttl if ttl else None
+        with self._lock:
+            self._data[key] = (value, expires_at)
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+
+
+class RedisStore:
+    """Redis-backed store; values are stored as JSON"""
+
+    shared = True
+
+    def __init__(self, url, prefix='readingtrail:'):
+        import redis
+        self._redis = redis.Redis.from_url(url, socket_timeout=0.5)
+        self._prefix = prefix
+
+    def get(self, key):
+        try:
+            raw = self._redis.get(self._prefix + key)
+        except Exception as e:
+            logging.warning(f"Shared store get failed for {key}: {e}")
+            return None
+        return json.loads(raw) if raw is not None else None
+
+    def set(self, key, value, ttl=None):
+        try:
+            self._redis.set(self._prefix + key, json.dumps(value), ex=ttl)
+        except Exception as e:
+            logging.warning(f"Shared store set failed for {key}: {e}")
+
+    def delete(self, *keys):
+        if not keys:
+            return
+        try:
+            self._redis.delete(*(self._prefix + key for key in keys))
+        except Exception as e:
+            logging.warning(f"Shared store delete failed for {keys}: {e}")
+
+
+def _create_store():
+    url = os.environ.get('REDIS_URL')
+    if url:
+        try:
+            return RedisStore(url)
+        except ImportError:
+            logging.warning("REDIS_URL is set but the redis package is not installed; using per-worker store")
+    return LocalStore()
+
+
+store = _create_store()
+
+
+def warn_if_not_shared(workers=None):
+    """Warn when several workers run without a shared store; True if warned"""
+    if workers is None:
+        try:
+            workers = int(os.environ.get('WEB_CONCURRENCY') or 1)
+        except ValueError:
+            workers = 1
+    if workers > 1 and not store.shared:
+        logging.warning(
+            f"{workers} workers without a shared store (REDIS_URL): header counts, "
+            f"the discussion feed and presence stay per worker and can be stale for other workers"
+        )
+        return True
+    return False
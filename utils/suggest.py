@@ -0,0 +1,126 @@
+"""
+In-memory typeahead index over book titles and authors.
+
+Every word start of a normalized title/author is a key in one sorted list
+("harry potter" gives "harry potter" and "potter"), so a prefix lookup is
+a binary search plus a short scan and never touches the database. Book
+writes in this process update the index in place; the TTL rebuild picks up
+writes made by other workers.
+"""
+import bisect
+import logging
+import threading
+import time
+
+from models import Book
+from utils.text import normalize_text
+
+# Upper bound on how stale another worker's writes can be in this index
+SUGGEST_INDEX_TTL = 300
+MAX_SUGGESTIONS = 20
+
+
+class SuggestIndex:
+    """Sorted-array prefix index of ``(key, kind, value, book_id)`` entries"""
+
+    def __init__(self, ttl=SUGGEST_INDEX_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = None
+        self._by_book = {}
+        self._loaded_at = 0.0
+
+    def suggest(self, prefix, limit=8):
+        """Titles and authors with a word starting with ``prefix``.
+
+        Returns up to ``limit`` dicts ``{'type': 'title'|'author', 'value',
+        'book_id'}`` in key order; authors are listed once, without a book id.
+        """
+        prefix = normalize_text(prefix)
+        if not prefix:
+            return []
+        limit = max(1, min(limit, MAX_SUGGESTIONS))
+
+        entries = self._ensure_loaded()
+        start = bisect.bisect_left(entries, (prefix,))
+        suggestions = {}
+
+        for key, kind, value, book_id in entries[start:start + limit * 20]:
+            if not key.startswith(prefix):
+                break
+            if (kind, value) not in suggestions:
+                suggestions[(kind, value)] = {
+                    'type': kind,
+                    'value': value,
+                    'book_id': book_id if kind == 'title' else None,
+                }
+                if len(suggestions) == limit:
+                    break
+
+        return list(suggestions.values())
+
+    def add(self, book):
+        """Index a new or edited book (replaces its previous entries)"""
+        with self._lock:
+            if self._entries is None:
+                return
+            self._remove_locked(book.id)
+            entries = self._entries_for(book.id, book.title, book.author)
+            for entry in entries:
+                bisect.insort(self._entries, entry)
+            self._by_book[book.id] = entries
+
+    def remove(self, book_id):
+        """Drop a deleted book from the index"""
+        with self._lock:
+            if self._entries is not None:
+                self._remove_locked(book_id)
+
+    def invalidate(self):
+        """Force a full rebuild on the next lookup"""
+        with self._lock:
+            self._entries = None
+
+    def _ensure_loaded(self):
+        entries = self._entries
+        if entries is not None and time.monotonic() - self._loaded_at < self.ttl:
+            return entries
+
+        with self._lock:
+            if self._entries is None or time.monotonic() - self._loaded_at >= self.ttl:
+                try:
+                    self._rebuild_locked()
+                except Exception as e:
+                    logging.error(f"Error building suggestion index: {e}")
+                    return self._entries or []
+            return self._entries
+
+    def _rebuild_locked(self):
+        by_book = {}
+        rows = Book.query.with_entities(Book.id, Book.title, Book.author).all()
+        for book_id, title, author in rows:
+            by_book[book_id] = self._entries_for(book_id, title, author)
+
+        self._entries = sorted(entry for entries in by_book.values() for entry in entries)
+        self._by_book = by_book
+        self._loaded_at = time.monotonic()
+
+    def _remove_locked(self, book_id):
+        for entry in self._by_book.pop(book_id, []):
+            index = bisect.bisect_left(self._entries, entry)
+            if index < len(self._entries) and self._entries[index] == entry:
+                del self._entries[index]
+
+    @staticmethod
+    def _entries_for(book_id, title, author):
+        entries = []
+        for kind, value in (('title', title), ('author', author)):
+            words = normalize_text(value).split(' ')
+            for i in range(len(words)):
+                key = ' '.join(words[i:])
+                if key:
+                    entries.append((key, kind, value, book_id))
+        return entries
+
+
+book_suggestions = SuggestIndex()
@@ -0,0 +1,19 @@
+"""
+Text normalization helpers for accent-insensitive matching.
+"""
+import unicodedata
+
+# Letters that do not decompose into a base letter + combining mark
+_SPECIAL_LETTERS = str.maketrans({'đ': 'd', 'Đ': 'D', 'ð': 'd', 'Ð': 'D'})
+
+
+def normalize_text(value):
+    """Casefold, strip diacritics and collapse whitespace.
+
+    ``normalize_text('Nguyễn  Nhật Ánh')`` returns ``'nguyen nhat anh'``.
+    """
+    if not value:
+        return ''
+    decomposed = unicodedata.normalize('NFD', value.translate(_SPECIAL_LETTERS))
+    stripped = ''.join(ch for ch in decomposed if not unicodedata.combining(ch))
+    return ' '.join(stripped.casefold().split())
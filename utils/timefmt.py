@@ -0,0 +1,114 @@
+"""
+Shared timestamp formatting: local display time, "time ago" and epoch values.
+
+Timestamps are stored as naive UTC. Timezone objects are built once
+(``get_timezone``) and UTC offsets are cached per 15-minute bucket, so a
+conversion is a dict hit plus an addition instead of a pytz localization.
+A ``TimeFormatter`` fixes "now" once, so a whole list is formatted
+consistently and cheaply:
+
+    fmt = TimeFormatter()
+    data = [message.to_dict(fmt) for message in messages]
+
+With ``epoch=True`` (``?time_format=epoch`` via ``request_formatter()``)
+serializers ship ``epoch`` (UTC seconds) instead of a "time ago" string
+and the client renders relative times itself.
+"""
+from datetime import datetime, timezone
+from functools import lru_cache
+
+import pytz
+
+DEFAULT_TIMEZONE = 'Asia/Ho_Chi_Minh'
+
+_EPOCH = datetime(1970, 1, 1)
+
+# "time ago" wording per style: (days, hours, minutes, just now)
+TIME_AGO_STYLES = {
+    'short': ('{}d ago', '{}h ago', '{}m ago', 'just now'),
+    'vi': ('{} ngày trước', '{} giờ trước', '{} phút trước', 'Vừa xong'),
+    'long': ('{} day{} ago', '{} hour{} ago', '{} minute{} ago', 'Just now'),
+}
+
+
+@lru_cache(maxsize=None)
+def get_timezone(name=DEFAULT_TIMEZONE):
+    return pytz.timezone(name)
+
+
+@lru_cache(maxsize=4096)
+def _utc_offset(tz_name, bucket):
+    # Real-world offset changes happen on quarter hours
+    return pytz.utc.localize(bucket).astimezone(get_timezone(tz_name)).utcoffset()
+
+
+def as_utc(value):
+    """Naive UTC datetime for a naive-UTC or aware ``value``"""
+    if value.tzinfo is not None:
+        return value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def to_local(value, tz_name=DEFAULT_TIMEZONE):
+    """Naive local wall time for a UTC timestamp"""
+    value = as_utc(value)
+    bucket = value.replace(minute=value.minute - value.minute % 15, second=0, microsecond=0)
+    return value + _utc_offset(tz_name, bucket)
+
+
+def format_local(value, tz_name=DEFAULT_TIMEZONE):
+    """``dd/mm/YYYY HH:MM`` in local time (the format used across the app)"""
+    local = to_local(value, tz_name)
+    return f'{local.day:02d}/{local.month:02d}/{local.year} {local.hour:02d}:{local.minute:02d}'
+
+
+def epoch_seconds(value):
+    return int((as_utc(value) - _EPOCH).total_seconds())
+
+
+def time_ago(value, now=None, style='short'):
+    """Relative time such as ``5m ago`` / ``5 phút trước``"""
+    diff = (now or datetime.utcnow()) - as_utc(value)
+    days_text, hours_text, minutes_text, just_now = TIME_AGO_STYLES[style]
+    plural = style == 'long'
+
+    if diff.days > 0:
+        amount, text = diff.days, days_text
+    elif diff.seconds >= 3600:
+        amount, text = diff.seconds // 3600, hours_text
+    elif diff.seconds >= 60:
+        amount, text = diff.seconds // 60, minutes_text
+    else:
+        return just_now
+    return text.format(amount, 's' if amount > 1 else '') if plural else text.format(amount)
+
+
+class TimeFormatter:
+    """Formats many timestamps against one "now" and one timezone"""
+
+    def __init__(self, tz_name=DEFAULT_TIMEZONE, now=None, epoch=False):
+        self.tz_name = tz_name
+        self.now = now or datetime.utcnow()
+        self.epoch = epoch
+
+    def format(self, value):
+        return format_local(value, self.tz_name)
+
+    def time_ago(self, value, style='short'):
+        return time_ago(value, self.now, style)
+
+    def fields(self, value, style='short'):
+        """``formatted_time`` plus ``time_ago`` (or ``epoch`` in epoch mode)"""
+        fields = {'formatted_time': self.format(value)}
+        if self.epoch:
+            fields['epoch'] = epoch_seconds(value)
+        else:
+            fields['time_ago'] = self.time_ago(value, style)
+        return fields
+
+
+def request_formatter():
+    """Formatter for the current request; ``?time_format=epoch`` selects epoch mode"""
+    from flask import has_request_context, request
+    epoch = has_request_context() and request.args.get('time_format') == 'epoch'
+    return TimeFormatter(epoch=epoch)